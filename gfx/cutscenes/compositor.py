@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+'''
+Krita-free compositing of cutscene images with template.kra.
+
+The layer stack of the template is extracted into a recipe: a tree of groups with
+their blend modes, opacities and filter masks. The empty groups are the inputs; the
+images to be composited are placed into them by name (`denoised`, `dequantized`),
+like krita_process.py does with file layers. The recipe is then evaluated on
+float32 NumPy arrays with straight alpha, following Krita's formulas.
+
+Only what the template needs is supported. For anything else `Recipe.from_kra`
+raises UnsupportedTemplate, and the caller should fall back to Krita.
+
+Usage:
+    compositor.py recipe TEMPLATE
+    compositor.py composite TEMPLATE DEQUANTIZED DENOISED OUTPUT
+    compositor.py verify TEMPLATE DEQUANTIZED DENOISED [--reference KRITA_OUTPUT]
+'''
+
+import argparse
+import base64
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+import zipfile
+
+import numpy
+import PIL.Image
+
+
+KRITA_NS = '{http://www.calligra.org/DTD/krita}'
+
+
+class UnsupportedTemplate(RuntimeError):
+    pass
+
+
+def blend_normal(s, d):
+    return s
+
+
+def blend_multiply(s, d):
+    return s * d
+
+
+def blend_screen(s, d):
+    return s + d - s * d
+
+
+def blend_hard_light(s, d):
+    s2 = 2 * s
+    return numpy.where(s > 0.5, blend_screen(s2 - 1, d), blend_multiply(s2, d))
+
+
+def blend_overlay(s, d):
+    return blend_hard_light(d, s)
+
+
+def blend_super_light(s, d):
+    p = 2.875
+    s2 = 2 * s
+    dark = 1 - ((1 - d) ** p + numpy.maximum(1 - s2, 0) ** p) ** (1 / p)
+    light = (d ** p + numpy.maximum(s2 - 1, 0) ** p) ** (1 / p)
+    return numpy.where(s < 0.5, dark, light)
+
+
+# Krita's separable blend modes, by compositeop id
+blend_modes = {
+    'normal':       blend_normal,
+    'multiply':     blend_multiply,
+    'screen':       blend_screen,
+    'hard_light':   blend_hard_light,
+    'overlay':      blend_overlay,
+    'super_light':  blend_super_light,
+}
+
+
+def composite_over(dst, src, op, opacity):
+    '''
+    Composite `src` onto `dst` in place, both straight-alpha float RGBA.
+    '''
+
+    sa = src[..., 3:] * opacity
+    da = dst[..., 3:]
+    na = sa + da - sa * da
+
+    color = (
+        sa * (1 - da) * src[..., :3] +
+        (1 - sa) * da * dst[..., :3] +
+        sa * da * blend_modes[op](src[..., :3], dst[..., :3])
+    )
+
+    numpy.divide(color, na, out=dst[..., :3], where=na > 0)
+    dst[..., 3:] = na
+
+
+# Luma weights of Krita's desaturate filter, by its `type`
+desaturate_weights = {
+    1: (0.2126, 0.7152, 0.0722),    # BT.709 luminosity
+    2: (0.299, 0.587, 0.114),       # BT.601 luminosity
+    3: (1/3, 1/3, 1/3),             # average
+}
+
+
+def filter_desaturate(img, config):
+    kind = int(config.get('type', 1))
+    rgb = img[..., :3]
+
+    if kind == 0:
+        gray = (rgb.max(axis=-1) + rgb.min(axis=-1)) / 2
+    elif kind == 4:
+        gray = rgb.min(axis=-1)
+    elif kind == 5:
+        gray = rgb.max(axis=-1)
+    else:
+        gray = rgb @ numpy.array(desaturate_weights[kind], dtype=numpy.float32)
+
+    img[..., :3] = gray[..., numpy.newaxis]
+
+
+def filter_burn(img, config):
+    kind = int(config.get('type', 1))
+    factor = float(config.get('exposure', 0.5)) * 0.333333
+    rgb = img[..., :3]
+
+    if kind == 0:     # shadows
+        rgb[:] = numpy.where(rgb < factor, 0, (rgb - factor) / (1 - factor))
+    elif kind == 1:   # midtones
+        rgb **= 1 + factor
+    else:             # highlights
+        rgb *= 1 - factor
+
+
+filters = {
+    'desaturate':   filter_desaturate,
+    'burn':         filter_burn,
+}
+
+
+class Input:
+    def __init__(self, name, compositeop='normal', opacity=1.0):
+        self.name = name
+        self.compositeop = compositeop
+        self.opacity = opacity
+
+    def to_dict(self):
+        return {'input': self.name, 'compositeop': self.compositeop, 'opacity': self.opacity}
+
+    def render(self, inputs):
+        return inputs[self.name].copy()
+
+
+class Group:
+    def __init__(self, name, compositeop='normal', opacity=1.0, children=(), masks=()):
+        self.name = name
+        self.compositeop = compositeop
+        self.opacity = opacity
+        self.children = list(children)  # bottom to top
+        self.masks = list(masks)        # (filter name, config) pairs, in order of application
+
+    def to_dict(self):
+        return {
+            'group': self.name,
+            'compositeop': self.compositeop,
+            'opacity': self.opacity,
+            'children': [c.to_dict() for c in self.children],
+            'masks': [{'filter': f, 'config': c} for f, c in self.masks],
+        }
+
+    def render(self, inputs):
+        shape = next(iter(inputs.values())).shape
+        img = numpy.zeros(shape, dtype=numpy.float32)
+
+        # Krita clamps to the channel range after every step
+        for c in self.children:
+            composite_over(img, c.render(inputs), c.compositeop, c.opacity)
+            numpy.clip(img, 0, 1, out=img)
+
+        for f, config in self.masks:
+            filters[f](img, config)
+            numpy.clip(img, 0, 1, out=img)
+
+        return img
+
+
+class Recipe:
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def from_kra(cls, path):
+        '''
+        Extract the recipe from a .kra, raising UnsupportedTemplate if the document uses
+        anything this module can't reproduce.
+        '''
+
+        with zipfile.ZipFile(path) as z:
+            image = ET.fromstring(z.read('maindoc.xml')).find(f'{KRITA_NS}IMAGE')
+            layers_prefix = f'{image.get("name")}/layers/'
+
+            def read_layer_file(name):
+                try:
+                    return z.read(layers_prefix + name)
+                except KeyError:
+                    return None
+
+            if image.get('colorspacename') != 'RGBA':
+                raise UnsupportedTemplate(f'color space {image.get("colorspacename")}')
+
+            bg = image.find(f'{KRITA_NS}ProjectionBackgroundColor')
+
+            # BGRA, 8 bits per channel
+            if bg is not None and base64.b64decode(bg.get('ColorData'))[3:4] not in (b'', b'\0'):
+                raise UnsupportedTemplate('opaque projection background')
+
+            root = parse_group(image, 'root', read_layer_file)
+
+        return cls(root)
+
+    def to_dict(self):
+        return self.root.to_dict()
+
+    def composite(self, inputs):
+        '''
+        Composite a dict of float32 RGBA images of equal size, keyed by input name.
+        '''
+
+        shapes = {img.shape for img in inputs.values()}
+
+        if len(shapes) != 1:
+            raise ValueError(f'Input images differ in size: {shapes}')
+
+        return self.root.render(inputs)
+
+
+def parse_group(elem, name, read_layer_file):
+    layers = elem.find(f'{KRITA_NS}layers')
+    children = []
+    masks = []
+
+    # Krita stores nodes topmost first
+    for e in reversed(list(layers) if layers is not None else []):
+        what = f'`{e.get("name")}` ({e.get("nodetype")})'
+
+        if e.get('visible') == '0':
+            continue
+
+        if e.tag == f'{KRITA_NS}mask':
+            masks.append(parse_mask(e, what, read_layer_file))
+            continue
+
+        if e.get('nodetype') != 'grouplayer':
+            raise UnsupportedTemplate(f'{what}: unsupported layer type')
+
+        if e.get('passthrough') == '1':
+            raise UnsupportedTemplate(f'{what}: pass-through groups are not supported')
+
+        if e.get('channelflags'):
+            raise UnsupportedTemplate(f'{what}: channel flags are not supported')
+
+        if int(e.get('x', 0)) or int(e.get('y', 0)):
+            raise UnsupportedTemplate(f'{what}: offset layers are not supported')
+
+        op = e.get('compositeop', 'normal')
+
+        if op not in blend_modes:
+            raise UnsupportedTemplate(f'{what}: unsupported blend mode `{op}`')
+
+        opacity = int(e.get('opacity', 255)) / 255
+        group = parse_group(e, e.get('name'), read_layer_file)
+
+        if not group.children and not group.masks:
+            children.append(Input(group.name, op, opacity))
+        else:
+            group.compositeop = op
+            group.opacity = opacity
+            children.append(group)
+
+    return Group(name, children=children, masks=masks)
+
+
+def parse_mask(e, what, read_layer_file):
+    if e.get('nodetype') != 'filtermask':
+        raise UnsupportedTemplate(f'{what}: unsupported mask type')
+
+    f = e.get('filtername')
+
+    if f not in filters:
+        raise UnsupportedTemplate(f'{what}: unsupported filter `{f}`')
+
+    # Only masks that select everything: no painted tiles, fully selected by default
+    base = e.get('filename')
+    selection = read_layer_file(f'{base}.pixelselection')
+    default = read_layer_file(f'{base}.pixelselection.defaultpixel')
+
+    if (selection is not None and b'\nDATA 0\n' not in selection) or default not in (None, b'\xff'):
+        raise UnsupportedTemplate(f'{what}: partial selections are not supported')
+
+    config = {}
+    config_xml = read_layer_file(f'{base}.filterconfig')
+
+    if config_xml is not None:
+        for param in ET.fromstring(config_xml).iter('param'):
+            config[param.get('name')] = param.text
+
+    if f == 'desaturate' and int(config.get('type', 1)) not in (0, 1, 2, 3, 4, 5):
+        raise UnsupportedTemplate(f'{what}: unsupported desaturation type')
+
+    return f, config
+
+
+def load(path):
+    with PIL.Image.open(path) as img:
+        return numpy.asarray(img.convert('RGBA'), dtype=numpy.float32) / 255
+
+
+def quantize(img):
+    return numpy.rint(numpy.clip(img, 0, 1) * 255).astype(numpy.uint8)
+
+
+def composite_files(recipe, inputs, dst):
+    '''
+    Composite image files, keyed by input name, into `dst`. Meant to be run in a
+    process pool.
+    '''
+
+    img = recipe.composite({name: load(path) for name, path in inputs.items()})
+    PIL.Image.fromarray(quantize(img), 'RGBA').save(dst, compress_level=1)
+    return dst
+
+
+def verify(recipe, inputs, reference, tolerance=3):
+    '''
+    Compare the composite of image files, keyed by input name, with `reference`, the
+    output of Krita for the same inputs. Returns a description of the difference, and
+    whether it is within `tolerance` (in 8-bit levels per channel).
+    '''
+
+    ours = quantize(recipe.composite({name: load(path) for name, path in inputs.items()}))
+    theirs = quantize(load(reference))
+
+    if ours.shape != theirs.shape:
+        return (f'Size mismatch: {ours.shape[1]}x{ours.shape[0]} vs. '
+            f'{theirs.shape[1]}x{theirs.shape[0]} from Krita'), False
+
+    diff = numpy.abs(ours.astype(numpy.int16) - theirs)
+    msg = (f'Difference from Krita: max {diff.max()}, mean {diff.mean():.3f}, '
+        f'{numpy.count_nonzero(diff.max(axis=-1) > tolerance)} pixels over tolerance')
+
+    return msg, diff.max() <= tolerance
+
+
+def krita_composite(template, dequantized, denoised, dst):
+    script_dir = pathlib.Path(__file__).resolve().parent
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(script_dir), env.get('PYTHONPATH')]))
+
+    subprocess.check_call([
+        'kritarunner',
+        '-s', 'krita_process',
+        '--',
+        template, dequantized, denoised, dst,
+    ], env=env)
+
+
+def __main__(args):
+    parser = argparse.ArgumentParser(description='Composite cutscene images without Krita', prog=args[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('recipe',
+        help='print the recipe extracted from a template',
+    )
+
+    p.add_argument('template',
+        type=pathlib.Path,
+        help='path to the template .kra',
+    )
+
+    for name, help in (
+        ('composite', 'composite a pair of images'),
+        ('verify', "compare the result with Krita's"),
+    ):
+        p = sub.add_parser(name, help=help)
+
+        p.add_argument('template',
+            type=pathlib.Path,
+            help='path to the template .kra',
+        )
+
+        p.add_argument('dequantized',
+            type=pathlib.Path,
+            help='path to the dequantized image',
+        )
+
+        p.add_argument('denoised',
+            type=pathlib.Path,
+            help='path to the denoised image',
+        )
+
+    sub.choices['composite'].add_argument('output',
+        type=pathlib.Path,
+        help='path to the output image',
+    )
+
+    sub.choices['verify'].add_argument('--reference',
+        type=pathlib.Path,
+        default=None,
+        help='previously composited output of Krita (default: run Krita now)',
+    )
+
+    sub.choices['verify'].add_argument('--tolerance',
+        type=int,
+        default=3,
+        help='maximum allowed difference from Krita per channel, in 8-bit levels (default: %(default)s)',
+    )
+
+    args = parser.parse_args(args[1:])
+
+    try:
+        recipe = Recipe.from_kra(args.template)
+    except UnsupportedTemplate as e:
+        print(f'{args.template}: unsupported by the compositor: {e}', file=sys.stderr)
+        return 2
+
+    if args.command == 'recipe':
+        print(json.dumps(recipe.to_dict(), indent=1))
+        return
+
+    inputs = {'dequantized': args.dequantized, 'denoised': args.denoised}
+
+    if args.command == 'composite':
+        composite_files(recipe, inputs, args.output)
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        reference = args.reference
+
+        if reference is None:
+            reference = pathlib.Path(tmpdir) / 'krita.png'
+            krita_composite(args.template, args.dequantized, args.denoised, reference)
+
+        msg, ok = verify(recipe, inputs, reference, args.tolerance)
+
+    print(msg)
+
+    if not ok:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(__main__(sys.argv))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+'''
+JPEG dequantization in the DCT domain, replacing `gmic gcd_unquantize`.
+
+Decoding a JPEG rounds every DCT coefficient to a multiple of its quantization step,
+which shows up as blocking and ringing. All we know about an original coefficient
+is the interval it was rounded from, so the image is restored by alternating between
+smoothing it and projecting every 8x8 block back into the set of images that encode
+to the same JPEG (clamping its coefficients to their quantization intervals).
+
+The quantized coefficients are recovered by re-transforming the planes decoded by
+libjpeg (through Pillow): its IDCT and rounding are precise enough that they round
+back to the stored integers. Images are processed in horizontal strips of blocks,
+with enough overlap for the result to be independent of the strip size.
+
+Components are only constrained when they aren't subsampled (the luma always is);
+subsampled chroma is kept as decoded.
+'''
+
+import argparse
+import pathlib
+import sys
+
+import numpy
+import PIL.Image
+import PIL.JpegImagePlugin
+
+
+# Orthonormal 8-point DCT-II matrix, as used by JPEG
+DCT = numpy.array([
+    [numpy.sqrt((1 if k == 0 else 2) / 8) * numpy.cos((2 * n + 1) * k * numpy.pi / 16) for n in range(8)]
+    for k in range(8)
+], dtype=numpy.float32)
+
+default_iterations = 8
+default_strength = 1.0
+default_tile_rows = 64
+
+
+def block_dct(x):
+    h, w = x.shape
+    return numpy.einsum('ij,ajbl,kl->abik', DCT, x.reshape(h // 8, 8, w // 8, 8), DCT, optimize=True)
+
+
+def block_idct(c):
+    bh, bw = c.shape[:2]
+    return numpy.einsum('ji,abjl,lk->aibk', DCT, c, DCT, optimize=True).reshape(bh * 8, bw * 8)
+
+
+def smooth(x, strength):
+    '''
+    Move `x` towards its 3x3 binomial blur, replicating the edges.
+    '''
+
+    p = numpy.pad(x, 1, mode='edge')
+    v = (p[:-2] + 2 * p[1:-1] + p[2:]) * 0.25
+    b = (v[:, :-2] + 2 * v[:, 1:-1] + v[:, 2:]) * 0.25
+    return x + strength * (b - x)
+
+
+def dequantize_plane(plane, qtable, iterations=default_iterations, strength=default_strength,
+                     tile_rows=default_tile_rows):
+    '''
+    Dequantize a decoded 8-bit plane given its quantization table (64 values in natural
+    order). Blocks cut by the right or bottom edge of the image are left as decoded.
+    '''
+
+    h, w = plane.shape
+    bh, bw = h // 8, w // 8
+    q = numpy.asarray(qtable, dtype=numpy.float32).reshape(8, 8)
+    out = plane.copy()
+
+    # Each iteration spreads changes by at most one block
+    halo = iterations
+
+    for by0 in range(0, bh, tile_rows):
+        by1 = min(by0 + tile_rows, bh)
+        hy0, hy1 = max(by0 - halo, 0), min(by1 + halo, bh)
+
+        x = plane[hy0 * 8:hy1 * 8, :bw * 8].astype(numpy.float32) - 128
+        k = numpy.rint(block_dct(x) / q)
+        lo, hi = (k - 0.5) * q, (k + 0.5) * q
+        del k
+
+        for _ in range(iterations):
+            c = block_dct(smooth(x, strength))
+            numpy.clip(c, lo, hi, out=c)
+            x = block_idct(c)
+
+        x = x[(by0 - hy0) * 8:(by1 - hy0) * 8] + 128
+        out[by0 * 8:by1 * 8, :bw * 8] = numpy.rint(numpy.clip(x, 0, 255))
+
+    return out
+
+
+def dequantize_file(src, dst, iterations=default_iterations, strength=default_strength,
+                    tile_rows=default_tile_rows):
+    '''
+    Dequantize the JPEG `src` into the PNG `dst`. Meant to be run in a process pool.
+    '''
+
+    with PIL.Image.open(src) as img:
+        if img.format != 'JPEG':
+            raise ValueError(f'{src}: not a JPEG image')
+
+        if img.mode not in ('L', 'RGB'):
+            raise ValueError(f'{src}: unsupported JPEG color mode {img.mode}')
+
+        if img.mode == 'RGB':
+            # Decode to YCbCr planes, skipping the color conversion
+            img.draft('YCbCr', img.size)
+
+        subsampled = PIL.JpegImagePlugin.get_sampling(img) not in (-1, 0)
+        tables = [img.quantization[layer[3]] for layer in img.layer]
+        planes = img.split()
+        mode = img.mode
+
+    planes = [
+        PIL.Image.fromarray(dequantize_plane(
+            numpy.asarray(plane), tables[i], iterations, strength, tile_rows))
+        if i == 0 or not subsampled else plane
+        for i, plane in enumerate(planes)
+    ]
+
+    out = PIL.Image.merge(mode, planes)
+
+    if mode == 'YCbCr':
+        out = out.convert('RGB')
+
+    out.save(dst, compress_level=1)
+    return dst
+
+
+def __main__(args):
+    parser = argparse.ArgumentParser(description='Reduce JPEG compression artifacts', prog=args[0])
+
+    parser.add_argument('input',
+        type=pathlib.Path,
+        help='path to the input JPEG',
+    )
+
+    parser.add_argument('output',
+        type=pathlib.Path,
+        help='path to the output PNG',
+    )
+
+    parser.add_argument('--iterations',
+        type=int,
+        default=default_iterations,
+        help='number of smoothing and projection steps (default: %(default)s)',
+    )
+
+    parser.add_argument('--strength',
+        type=float,
+        default=default_strength,
+        help='amount of smoothing per step, between 0 and 1 (default: %(default)s)',
+    )
+
+    parser.add_argument('--tile-rows',
+        type=int,
+        default=default_tile_rows,
+        help='height of the processed strips, in 8-pixel blocks (default: %(default)s)',
+    )
+
+    args = parser.parse_args(args[1:])
+    dequantize_file(args.input, args.output, args.iterations, args.strength, args.tile_rows)
+
+
+if __name__ == '__main__':
+    sys.exit(__main__(sys.argv))
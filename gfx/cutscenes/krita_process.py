@@ -2,6 +2,8 @@
 from krita import *
 from pathlib import Path
 
+import json
+
 kr = Krita.instance()
 kr.setBatchmode(True)
 
@@ -10,13 +12,33 @@ exportConfig.setProperty("saveSRGBProfile", False)
 exportConfig.setProperty("compression", 1)
 
 def __main__(args):
+    '''
+    Usage:
+        krita_process TEMPLATE DEQUANTIZED DENOISED OUTPUT
+        krita_process TEMPLATE --batch JOBS
+
+    where JOBS is a JSON file with a list of [DEQUANTIZED, DENOISED, OUTPUT] triples,
+    all composited with a single instance of the template.
+    '''
+
     template_kra = args[0]
-    dequant_in = args[1]
-    denoise_in = args[2]
-    out = args[3]
     print(args)
 
+    if args[1] == '--batch':
+        with open(args[2]) as f:
+            jobs = json.load(f)
+    else:
+        jobs = [args[1:4]]
+
+    failed = process(template_kra, jobs)
+
+    if failed:
+        print(f'{len(failed)} of {len(jobs)} jobs failed')
+
+
+def process(template_kra, jobs):
     doc = kr.openDocument(template_kra)
+    failed = []
 
     try:
         root = doc.rootNode()
@@ -36,24 +58,47 @@ def __main__(args):
         assert node_denoise is not None
         assert node_dequant is not None
 
-        layer_denoise = doc.createFileLayer("denoise_layer", denoise_in, "None")
-        layer_dequant = doc.createFileLayer("dequant_layer", dequant_in, "None")
+        width, height = doc.width(), doc.height()
+        layer_denoise = None
+        layer_dequant = None
+
+        for dequant_in, denoise_in, out in jobs:
+            print(f'Compositing `{out}`...')
+
+            try:
+                if layer_denoise is None:
+                    layer_denoise = doc.createFileLayer("denoise_layer", denoise_in, "None")
+                    layer_dequant = doc.createFileLayer("dequant_layer", dequant_in, "None")
+
+                    node_denoise.addChildNode(layer_denoise, None)
+                    node_dequant.addChildNode(layer_dequant, None)
+                else:
+                    # Reuse the file layers, just point them at the next image
+                    layer_denoise.setProperties(denoise_in, "None")
+                    layer_dequant.setProperties(dequant_in, "None")
 
-        node_denoise.addChildNode(layer_denoise, None)
-        node_dequant.addChildNode(layer_dequant, None)
+                doc.waitForDone()
 
-        bounds = node_denoise.bounds()
-        doc.resizeImage(bounds.x(), bounds.y(), bounds.width(), bounds.height())
+                bounds = node_denoise.bounds()
+                doc.resizeImage(bounds.x(), bounds.y(), bounds.width(), bounds.height())
 
-        doc.waitForDone()
-        doc.refreshProjection()
-        doc.waitForDone()
+                doc.waitForDone()
+                doc.refreshProjection()
+                doc.waitForDone()
 
-        root.save(out, 1, 1, exportConfig, bounds)
+                root.save(out, 1, 1, exportConfig, bounds)
+                doc.waitForDone()
+            except Exception as e:
+                print(f'Failed to composite `{out}`: {e!r}')
+                failed.append(out)
+            finally:
+                # Back to the template's canvas for the next image
+                doc.resizeImage(0, 0, width, height)
+                doc.waitForDone()
     finally:
         doc.close()
 
-    pass
+    return failed
 
 '''
 __main__([
@@ -1,18 +1,83 @@
 #!/usr/bin/env python3
 
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import shutil
 import subprocess
 import multiprocessing
 import os
+import sys
+import tempfile
+import time
 
 root_path = Path(__file__).resolve().parent
+
+sys.path.append(str(root_path.parent / 'utils'))
+
+import diskcache
+from scheduler import Scheduler
+
+import compositor
+import jpegdequant
+
 raw_path = root_path / 'raw'
 template_kra = root_path / 'template.kra'
+krita_script = root_path / 'krita_process.py'
+compositor_script = root_path / 'compositor.py'
+dequantizer_script = root_path / 'jpegdequant.py'
 sources = tuple(x.relative_to(raw_path) for x in raw_path.glob('**/*.jpg'))
 # sources = [Path('locations/hakurei.jpg')]
 
+# Stage results are kept here between runs. Set TAISEI_CUTSCENE_CACHE to override.
+cache_path = Path(os.environ.get('TAISEI_CUTSCENE_CACHE') or diskcache.default_cache_dir('cutscenes'))
+
+num_cpus = multiprocessing.cpu_count()
+
+# Set TAISEI_CUTSCENE_DEQUANTIZER=gmic to dequantize with G'MIC instead of jpegdequant.py
+use_gmic = os.environ.get('TAISEI_CUTSCENE_DEQUANTIZER', '').strip().lower() == 'gmic'
+
+# Concurrency limits of the pipeline stages. Most of the tools are multithreaded
+# themselves, so every process gets an equal share of the CPUs as its thread budget.
+stages = {
+    'dequantize':   max(1, num_cpus // 4) if use_gmic else num_cpus,
+    'denoise':      1,
+    'kritaprocess': 1,  # Krita with the template open takes several GiB of memory
+    'composite':    num_cpus,
+    'postprocess':  max(1, num_cpus // 2),
+    'encodebasis':  max(1, num_cpus // 2),
+}
+
+
+def thread_budget(stage):
+    return max(1, num_cpus // stages[stage])
+
+
+# Arguments that determine the output of each tool, apart from the input and output paths
+dequantize_args = ['gcd_unquantize', '6,1,1,5,15']
+denoise_args = ['-m', 'noise', '-p', '0', '--noise-level', '2']
+postprocess_args = [
+    '-colorspace', 'Gray',
+    '-filter', 'RobidouxSharp',
+    '-resize', 'x1200',
+    '-gravity', 'Center',
+    '-crop', '1600x1200+0x0',
+    '+repage',
+]
+encodebasis_args = ['--linear', '--r']
+
+# How to ask each tool for its version
+version_args = {
+    'gmic': ['--version'],
+    'waifu2x-converter-cpp': ['--version'],
+    'kritarunner': None,
+    'convert': ['-version'],
+    'mkbasis': ['--version'],
+}
+
 
 def mkpath(root, p, suffix=None):
     if suffix is not None:
@@ -28,13 +93,107 @@ def cmd(cmd, *args, **kwargs):
     subprocess.check_call(cmd, *args, **kwargs)
 
 
+def file_digest(path):
+    h = hashlib.blake2b()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(tool):
+    '''
+    Identify the installed version of `tool` by its executable and --version output.
+    '''
+
+    exe = shutil.which(tool)
+
+    if exe is None:
+        return None
+
+    version = [file_digest(exe)]
+    args = version_args.get(tool)
+
+    if args is not None:
+        try:
+            version.append(subprocess.run(
+                [exe] + args, capture_output=True, text=True, timeout=60).stdout)
+        except (OSError, subprocess.SubprocessError):
+            pass
+
+    return version
+
+
+def stage_entry(stage, tool, args, inputs, suffix, extra_files=()):
+    '''
+    Path of the cached result of a stage for this combination of input contents, tool
+    arguments and tool version (and `extra_files` contents).
+    '''
+
+    key = hashlib.blake2b(json.dumps([
+        stage,
+        [str(a) for a in args],
+        tool_version(tool),
+        [file_digest(i) for i in inputs],
+        [file_digest(f) for f in extra_files],
+    ]).encode()).hexdigest()
+
+    return cache_path / stage / key[:2] / f'{key}{suffix}'
+
+
+def store_entry(src, entry):
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(src, entry)
+
+
+def cached_stage(stage, tool, args, inputs, suffix, run, extra_files=()):
+    '''
+    Memoize a pipeline stage. `run(*inputs, dst)` is only called if there's no cached
+    result for it; otherwise the cached file is returned directly.
+    '''
+
+    entry = stage_entry(stage, tool, args, inputs, suffix, extra_files)
+
+    if entry.is_file():
+        print(f'CACHED: {stage} {" ".join(map(str, inputs))}')
+        return entry
+
+    # Write under a temporary name next to the entry, so that an interrupted
+    # run never leaves a partial result behind.
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=entry.parent, prefix='.tmp-', suffix=suffix)
+    os.close(fd)
+
+    try:
+        run(*inputs, Path(tmp))
+        store_entry(tmp, entry)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+    return entry
+
+
+def install(src, dst):
+    shutil.copyfile(src, dst)
+    return dst
+
+
 def dequantize(src, dst):
+    if not use_gmic:
+        process_pools['dequantize'].submit(jpegdequant.dequantize_file, src, dst).result()
+        return dst
+
     cmd([
         'gmic',
         src,
-        'gcd_unquantize', '6,1,1,5,15',
+    ] + dequantize_args + [
         '-o', dst,
-    ])
+    ], env=dict(os.environ, OMP_NUM_THREADS=str(thread_budget('dequantize'))))
     return dst
 
 
@@ -43,30 +202,69 @@ def denoise(src, dst):
         'waifu2x-converter-cpp',
         '-i', src,
         '-o', dst,
-        '-m', 'noise',
-        '-p', '0',
-        '--noise-level', '2',
-    ])
+        '-j', str(thread_budget('denoise')),
+    ] + denoise_args)
     return dst
 
 
-def kritaprocess(src_dequant, src_denoise, dst):
+def kritaprocess(jobs):
+    '''
+    Composite (dequantized, denoised) image pairs with the template, all in a single
+    Krita session. `jobs` maps output paths to input pairs.
+    '''
+
     e = dict(**os.environ)
     if 'PYTHONPATH' in e:
         e['PYTHONPATH'] = str(root_path) + os.pathsep + e['PYTHONPATH']
     else:
         e['PYTHONPATH'] = str(root_path)
 
-    cmd([
-        'kritarunner',
-        '-s', 'krita_process',
-        '--',
-        template_kra,
-        src_dequant,
-        src_denoise,
-        dst,
-    ], env=e)
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as jobs_file:
+        json.dump([[str(dq), str(dn), str(dst)] for dst, (dq, dn) in jobs.items()], jobs_file)
+        jobs_file.flush()
+
+        cmd([
+            'kritarunner',
+            '-s', 'krita_process',
+            '--',
+            template_kra,
+            '--batch', jobs_file.name,
+        ], env=e)
+
+
+def cached_kritaprocess(inputs):
+    '''
+    Memoized `kritaprocess` for a dict of (dequantized, denoised) pairs. Returns the
+    cached composite for every key whose compositing succeeded.
+    '''
+
+    entries = {
+        k: stage_entry('kritaprocess', 'kritarunner', [], pair, '.png', [template_kra, krita_script])
+        for k, pair in inputs.items()
+    }
 
+    missing = [k for k, entry in entries.items() if not entry.is_file()]
+    print(f'CACHED: kritaprocess for {len(entries) - len(missing)} of {len(entries)} images')
+
+    if missing:
+        cache_path.mkdir(parents=True, exist_ok=True)
+
+        with tempfile.TemporaryDirectory(dir=cache_path, prefix='.tmp-') as tmpdir:
+            outputs = {k: Path(tmpdir) / f'{i}.png' for i, k in enumerate(missing)}
+            kritaprocess({outputs[k]: inputs[k] for k in missing})
+
+            for k in missing:
+                if outputs[k].is_file():
+                    store_entry(outputs[k], entries[k])
+
+    return {k: entry for k, entry in entries.items() if entry.is_file()}
+
+
+def composite(src_dequant, src_denoise, dst):
+    process_pools['composite'].submit(compositor.composite_files, recipe, {
+        'dequantized': src_dequant,
+        'denoised': src_denoise,
+    }, dst).result()
     return dst
 
 
@@ -75,54 +273,155 @@ def postprocess(src, dst):
         'convert',
         '-verbose',
         src,
-        '-colorspace', 'Gray',
-        '-filter', 'RobidouxSharp',
-        '-resize', 'x1200',
-        '-gravity', 'Center',
-        '-crop', '1600x1200+0x0',
-        '+repage',
+    ] + postprocess_args + [
         '-print', '%w %h\n',
         dst,
-    ])
+    ], env=dict(os.environ, MAGICK_THREAD_LIMIT=str(thread_budget('postprocess'))))
     return dst
 
 
 def encodebasis(src, dst):
     cmd([
         'mkbasis',
-        '--linear',
-        '--r',
+    ] + encodebasis_args + [
         src,
         '-o', dst,
     ])
     return dst
 
 
-with TemporaryDirectory() as tmpdir:
-    tmpdir = Path(tmpdir)
+# Composite with NumPy if the template is simple enough, otherwise with Krita.
+# Set TAISEI_CUTSCENE_COMPOSITOR=krita to always use Krita.
+recipe = None
+
+# Before compositing with NumPy, the result for one image is checked against Krita's.
+# Set TAISEI_CUTSCENE_VERIFY=0 to skip that, e.g. where Krita is not available.
+verify_compositor = os.environ.get('TAISEI_CUTSCENE_VERIFY', '').strip().lower() not in ('0', 'off', 'no', 'false')
+
+if os.environ.get('TAISEI_CUTSCENE_COMPOSITOR', '').strip().lower() != 'krita':
+    try:
+        recipe = compositor.Recipe.from_kra(template_kra)
+    except compositor.UnsupportedTemplate as e:
+        print(f'Compositing with Krita, the template is not supported by the compositor: {e}')
+
+# The dequantizer and the compositor are pure Python, so they run in worker processes.
+# Each of their stages gets a pool of as many workers as it runs tasks at once, so that
+# the stage limits bound the work actually done, not just the threads waiting for it.
+# Have them forked right away: forking later, from a scheduler thread, would leak the
+# pipes of concurrently spawned subprocesses into the workers and hang those threads.
+process_pools = {}
+
+for stage, needed in (('dequantize', not use_gmic), ('composite', recipe is not None)):
+    if needed:
+        process_pools[stage] = concurrent.futures.ProcessPoolExecutor(stages[stage])
+        process_pools[stage].submit(int).result()
+
+sched = Scheduler(stages)
+final_tasks = {}
+t_begin = time.monotonic()
+
+input_tasks = {}
+
+for p in sources:
+    src = raw_path / p
+
+    if use_gmic:
+        t_dequant = sched.add('dequantize', cached_stage,
+            'dequantize', 'gmic', dequantize_args, [src], '.png', dequantize, name=str(p))
+    else:
+        t_dequant = sched.add('dequantize', cached_stage,
+            'dequantize', 'python3', [], [src], '.png', dequantize,
+            extra_files=[dequantizer_script], name=str(p))
+
+    t_denoise = sched.add('denoise', cached_stage,
+        'denoise', 'waifu2x-converter-cpp', denoise_args, [src], '.png', denoise, name=str(p))
+
+    input_tasks[p] = (t_dequant, t_denoise)
+
+
+if recipe is None:
+    # One Krita session for all images. Images whose inputs failed are left out,
+    # rather than failing the whole batch.
+    @sched.task('kritaprocess', deps=[t for pair in input_tasks.values() for t in pair],
+        name='batch', ignore_failed_deps=True)
+    def t_krita():
+        return cached_kritaprocess({
+            p: (t_dequant.result(), t_denoise.result())
+            for p, (t_dequant, t_denoise) in input_tasks.items()
+            if t_dequant.error is None and t_denoise.error is None
+        })
+
+    def composited(p):
+        try:
+            return t_krita.result()[p]
+        except KeyError:
+            raise RuntimeError(f'{p}: compositing failed')
+
+    composite_tasks = dict.fromkeys(sources, t_krita)
+else:
+    composite_tasks = {}
+    verify_tasks = []
+
+    if verify_compositor and sources:
+        verify_source = min(sources)
+
+        @sched.task('kritaprocess', deps=input_tasks[verify_source], name=f'verify {verify_source}')
+        def t_verify(t_dequant=input_tasks[verify_source][0], t_denoise=input_tasks[verify_source][1]):
+            pair = (t_dequant.result(), t_denoise.result())
+            reference = cached_kritaprocess({verify_source: pair}).get(verify_source)
+
+            if reference is None:
+                raise RuntimeError(f'{verify_source}: Krita failed to composite the reference image')
+
+            msg, ok = compositor.verify(recipe, dict(zip(('dequantized', 'denoised'), pair)), reference)
+            print(f'Compositor check on {verify_source}: {msg}')
+
+            if not ok:
+                raise RuntimeError('The compositor does not match Krita, '
+                    'set TAISEI_CUTSCENE_COMPOSITOR=krita to composite with Krita instead')
+
+        verify_tasks.append(t_verify)
+
+    for p, (t_dequant, t_denoise) in input_tasks.items():
+        @sched.task('composite', deps=[t_dequant, t_denoise] + verify_tasks, name=str(p))
+        def t_composite(t_dequant=t_dequant, t_denoise=t_denoise):
+            return cached_stage('composite', 'python3', [], [t_dequant.result(), t_denoise.result()],
+                '.png', composite, extra_files=[template_kra, compositor_script])
 
-    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as ex:
+        composite_tasks[p] = t_composite
 
-        futures = []
+    def composited(p):
+        return composite_tasks[p].result()
 
-        for p in sources:
-            src = raw_path / p
 
-            f_dequant = ex.submit(dequantize, src, mkpath(tmpdir / 'dequant', p, '.png'))
-            f_denoise = ex.submit(denoise, src, mkpath(tmpdir / 'denoise', p, '.png'))
+for p in sources:
+    @sched.task('postprocess', deps=[composite_tasks[p]], name=str(p))
+    def t_post(p=p):
+        src = cached_stage('postprocess', 'convert', postprocess_args, [composited(p)], '.png', postprocess)
+        install(src, mkpath(root_path / 'out-png', p, '.png'))
+        return src
 
-            def future(p=p, f_dequant=f_dequant, f_denoise=f_denoise):
-                src = kritaprocess(
-                    f_dequant.result(),
-                    f_denoise.result(),
-                    mkpath(tmpdir / 'kritaprocess', p, '.png')
-                )
+    @sched.task('encodebasis', deps=[t_post], name=str(p))
+    def t_basis(p=p, t_post=t_post):
+        src = cached_stage('encodebasis', 'mkbasis', encodebasis_args, [t_post.result()], '.basis', encodebasis)
+        return install(src, mkpath(root_path / 'out-basis', p, '.basis'))
 
-                src = postprocess(src, mkpath(root_path / 'out-png', p, '.png'))
-                return encodebasis(src, mkpath(root_path / 'out-basis', p, '.basis'))
+    final_tasks[p] = t_basis
 
-            futures.append(ex.submit(future))
+try:
+    sched.wait()
+finally:
+    for pool in process_pools.values():
+        pool.shutdown()
+    sched.report()
+    print('Critical paths:')
 
-        for fut in futures:
-            print(fut.result())
+    for p, task in final_tasks.items():
+        if task.error is not None:
+            continue
 
+        path, total = task.critical_path()
+        print(
+            f'  {p}: {total:.1f}s ({" -> ".join(f"{t.stage} {t.duration:.1f}s" for t in path)}), '
+            f'done after {task.finished_at - t_begin:.1f}s'
+        )
@@ -2,38 +2,26 @@
 
 import argparse
 import contextlib
+import fnmatch
 import io
 import itertools
+import json
 import multiprocessing
 import operator
 import os
 import pathlib
-import re
 import shutil
 import subprocess
 import sys
-import tempfile
 
-from concurrent.futures import (
-    ThreadPoolExecutor,
-    wait,
-    FIRST_EXCEPTION
-)
+sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent.parent / 'utils'))
 
+import diskcache
+import exportcache
+import imagepipeline
+import optimize_cache
 
-class Geometry:
-    regex = re.compile(r'(\d+)x(\d+)([+-]\d+)([+-]\d+)')
-
-    def __init__(self, g):
-        (
-            self.width,
-            self.height,
-            self.offset_x,
-            self.offset_y,
-        ) = (int(s) for s in Geometry.regex.findall(g)[0])
-
-    def __str__(self):
-        return '{}x{}{:+}{:+}'.format(self.width, self.height, self.offset_x, self.offset_y)
+from scheduler import Scheduler
 
 
 class Padding:
@@ -82,9 +70,18 @@ resize_scale = 1000.0 / 3072.0
 sprite_size_factor = 0.5
 
 
+# Concurrency limits of the export stages. Krita renders with multiple threads on its
+# own; full-resolution layers take a few hundred megabytes each while being resized.
+stages = {
+    'krita':    max(1, multiprocessing.cpu_count() // 4),
+    'image':    multiprocessing.cpu_count(),
+    'optimize': multiprocessing.cpu_count(),
+}
+
+
 class Character:
-    def __init__(self, *, im_args=None, offset_x=0, offset_y=0):
-        self.im_args = im_args if im_args else []
+    def __init__(self, *, flop=False, offset_x=0, offset_y=0):
+        self.flop = flop
         self.offset_x = offset_x
         self.offset_y = offset_y
 
@@ -95,16 +92,22 @@ characters = {
     'hina':    Character(),
     'iku':     Character(),
     'kurumi':  Character(),
-    'marisa':  Character(im_args=['-flop']),
-    'reimu':   Character(im_args=['-flop']),
+    'marisa':  Character(flop=True),
+    'reimu':   Character(flop=True),
     'scuttle': Character(offset_x=-16),
     'wriggle': Character(),
-    'youmu':   Character(im_args=['-flop'], offset_x=32),
+    'youmu':   Character(flop=True, offset_x=32),
     'yumemi':  Character(offset_y=120),
 }
 
 
-def export_layers(kra, outdir, legacy):
+def export_layers(kra, outdir, legacy, jobs=1, only=None, plan=None):
+    '''
+    Export the layers of `kra` with `jobs` kritarunner processes, each rendering an
+    equal share of the export targets (or just those named in `only`). If `plan` is
+    given, only write the export plan into that file instead.
+    '''
+
     kra = str(kra.resolve())
     outdir = str(outdir.resolve())
     cwd = str(pathlib.Path(__file__).parent)
@@ -115,7 +118,20 @@ def export_layers(kra, outdir, legacy):
     if legacy:
         cmd.append('--legacy')
 
-    subprocess.call(cmd, cwd=cwd)
+    if plan is not None:
+        subprocess.call(cmd + ['--plan', str(plan.resolve())], cwd=cwd)
+        return
+
+    for target in only or ():
+        cmd += ['--only', target]
+
+    procs = [
+        subprocess.Popen(cmd + ['--shard', f'{shard}/{jobs}'], cwd=cwd)
+        for shard in range(jobs)
+    ]
+
+    for proc in procs:
+        proc.wait()
 
 
 def try_remove_file(path):
@@ -155,7 +171,7 @@ def calculate_relative_padding(g_base, g_object):
     return m
 
 
-def export_char(name, args, executor, futures, temp_dir):
+def export_char(sched, name, args, optimizer):
     taisei = args.taisei
     char = characters[name]
     kra = pathlib.Path(__file__).parent / f'{name}.kra'
@@ -163,158 +179,170 @@ def export_char(name, args, executor, futures, temp_dir):
     sprite_overrides = taisei / 'atlas' / 'overrides' / 'dialog'
     offset_padding = Padding.from_offset(char.offset_x, char.offset_y)
 
-    resize_args = [
-        '-colorspace', 'LAB',
-        '-filter', resize_filter,
-        '-resize', f'{100 * resize_scale}%',
-        '-colorspace', 'sRGB',
-    ]
+    cache = exportcache.ExportCache(args.cache_dir / name)
+    temp_dir = cache.layers_dir
+    temp_dir.mkdir(parents=True, exist_ok=True)
+
+    # The plan also depends on which overrides exist and on the planner itself
+    script_dir = pathlib.Path(__file__).parent
+    overrides = sorted(p.name for p in (script_dir / 'export-overrides').glob('*') if p.is_file())
+    kra_digest = exportcache.digest(
+        exportcache.file_digest(kra), args.legacy, overrides,
+        exportcache.file_digest(script_dir / 'krita_exportlayers.py'))
+
+    if args.force or cache.kra != kra_digest or cache.plan is None:
+        plan_path = cache.path / 'plan.json'
+        export_layers(kra, temp_dir, args.legacy, plan=plan_path)
+        plan = json.loads(plan_path.read_text())
+        contents = exportcache.KraContents(kra)
+
+        for t in plan:
+            t['signature'] = exportcache.digest(contents.signature(t['layers']), t['node'], args.legacy)
+
+        cache.set_plan(kra_digest, plan)
 
-    preprocess_args = resize_args + ['-depth', '8'] + char.im_args
+    render_sigs = {}
+
+    for t in cache.plan:
+        override = t['override'] and exportcache.file_digest(t['override'])
+        render_sigs[t['name']] = exportcache.digest(t['signature'], override)
+
+    cache.prune(render_sigs)
 
     for p in itertools.chain(dest_dir.glob(f'{name}_*.*'), dest_dir.glob(f'{name}.*')):
-        p.unlink()
+        if p.name not in render_sigs:
+            p.unlink()
 
-    def optimize_image(path):
-        if not args.fast:
-            subprocess.check_call([taisei / 'scripts' / 'optimize-img.sh', path])
+    dirty = [
+        n for n, sig in render_sigs.items()
+        if args.force or cache.target(n).get('render') != sig or not (temp_dir / n).is_file()
+    ]
 
-    def parallel_task(*args, **kwargs):
-        futures.append(executor.submit(*args, **kwargs))
+    print(f'[{name}] {len(dirty)} of {len(render_sigs)} layers need to be exported')
 
-    temp_dir = temp_dir / name
-    temp_dir.mkdir()
+    if dirty:
+        for n in dirty:
+            try_remove_file(temp_dir / n)
 
-    export_layers(kra, temp_dir, args.legacy)
+        export_layers(kra, temp_dir, args.legacy, jobs=min(args.krita_jobs, len(dirty)), only=dirty)
+
+        for n in dirty:
+            if (temp_dir / n).is_file():
+                cache.update(n, render=render_sigs[n])
+
+    def optimize_image(path):
+        if optimizer is not None:
+            optimizer(path)
 
     variants = [
-        x.stem[len(f'{name}_variant_'):]
-        for x in temp_dir.glob(f'{name}_variant_*.png')
-        if '.' not in x.stem
+        n[len(f'{name}_variant_'):-len('.png')]
+        for n in render_sigs
+        if fnmatch.fnmatch(n, f'{name}_variant_*.png') and '.' not in n[:-len('.png')]
     ]
 
-    def imagemagick(args, get_output=False):
-        args = ['convert'] + args
-        print('[run imagemagick]   ' + repr(args))
-
-        if get_output:
-            output = subprocess.check_output(args, text=True)
-            print('[imagemagick output]   ' + str(output))
-            return output
-        else:
-            return subprocess.check_call(args, text=True)
-
-    def export_trimmed(img_name):
-        img_in   = temp_dir / img_name
-        img_out  = dest_dir / img_name
-
-        geom = Geometry(imagemagick([
-            img_in,
-        ] + preprocess_args + [
-            '-trim',
-            '-print', '%wx%h%O',
-            img_out,
-        ], get_output=True))
-        print(f'Exported `{img_out}`')
-        parallel_task(optimize_image, img_out)
-        return geom
+    faces = [n for n in render_sigs if fnmatch.fnmatch(n, '*_face_*.png') or fnmatch.fnmatch(n, '*_misc_*.png')]
+
+    preprocess_sig = exportcache.digest(resize_scale, resize_filter, char.flop, args.fuzz, args.fast)
 
-    def export_cropped(img_name, crop_geometry):
-        img_in   = temp_dir / img_name
-        img_out  = dest_dir / img_name
+    def output_signature(img_name, geom_from=None):
+        return exportcache.digest(
+            render_sigs[img_name], preprocess_sig, geom_from and output_signature(geom_from))
+
+    def is_current(img_name, sig):
+        return (
+            not args.force and
+            cache.target(img_name).get('output') == sig and
+            (dest_dir / img_name).is_file()
+        )
 
-        imagemagick([
-            img_in,
-        ] + preprocess_args + [
-            '-crop', str(crop_geometry),
-            img_out,
-        ])
+    def preprocess(img_name):
+        return imagepipeline.Layer(imagepipeline.preprocess(
+            temp_dir / img_name, resize_scale, resize_filter, char.flop))
+
+    def write_cropped(img_name, layer, geom, sig):
+        img_out = dest_dir / img_name
+        imagepipeline.save(img_out, imagepipeline.crop(layer.pixels, geom))
         print(f'Exported `{img_out}`')
-        parallel_task(optimize_image, img_out)
-
-    def export_difference(img_name, ref_name):
-        img_in   = temp_dir / img_name
-        img_ref  = temp_dir / ref_name
-        crop_geom = localize_difference(img_in, img_ref)
-        parallel_task(export_cropped, img_name, crop_geom)
-        return crop_geom
-
-    def localize_difference(img1, img2):
-        def make_input(img):
-            return [
-                '(',
-                    img,
-                    ] + preprocess_args + [
-                    '(',
-                        '+clone',
-                        '-alpha', 'extract',
-                    ')',
-                    '-alpha', 'off',
-                    '-compose', 'multiply',
-                    '-composite',
-                ')',
-            ]
-
-        geom = Geometry(imagemagick([
-        ] + make_input(img1) + [
-        ] + make_input(img2) + [
-            '-compose', 'difference',
-            '-composite',
-            '-trim',
-            '-print', '%wx%h%O',
-            '/dev/null',
-        ], get_output=True))
 
+        def finish():
+            optimize_image(img_out)
+            cache.update(img_name, output=sig,
+                geometry=[geom.width, geom.height, geom.offset_x, geom.offset_y])
+
+        sched.add('optimize', finish, name=f'optimize {img_name}')
+
+    def export_trimmed(img_name, sig):
+        layer = preprocess(img_name)
+        geom = imagepipeline.trim_geometry(layer, args.fuzz / 100)
+        write_cropped(img_name, layer, geom, sig)
         return geom
 
-    g_base = export_trimmed(f'{name}.png')
+    def export_cropped(img_name, crop_geometry, sig):
+        write_cropped(img_name, preprocess(img_name), crop_geometry, sig)
 
-    if (temp_dir / f'{name}.alphamap.png').is_file():
-        parallel_task(export_cropped, f'{name}.alphamap.png', g_base)
+    def export_cropped_like(img_name, geom_task, sig):
+        export_cropped(img_name, geom_task.result(), sig)
+
+    def cached_geometry(img_name):
+        return imagepipeline.Geometry(*cache.target(img_name)['geometry'])
+
+    def image_task(func, img_name, *args, deps=()):
+        return sched.add('image', func, img_name, *args, deps=deps, name=img_name)
+
+    def trimmed_task(img_name):
+        sig = output_signature(img_name)
+
+        if is_current(img_name, sig):
+            return image_task(cached_geometry, img_name)
+
+        return image_task(export_trimmed, img_name, sig)
+
+    def alphamap_task(img_name, geom_task, geom_from):
+        if img_name not in render_sigs:
+            return
+
+        sig = output_signature(img_name, geom_from)
+
+        if not is_current(img_name, sig):
+            image_task(export_cropped_like, img_name, geom_task, sig, deps=[geom_task])
+
+    base = trimmed_task(f'{name}.png')
+    alphamap_task(f'{name}.alphamap.png', base, f'{name}.png')
+
+    @sched.task('image', deps=[base], name=f'{name}.spr')
+    def base_sprite_def():
+        g_base = base.result()
+        update_sprite_def(
+            sprite_overrides / f'{name}.spr',
+            g_base.width * sprite_size_factor, g_base.height * sprite_size_factor,
+            offset_padding
+        )
+
+    def update_relative_sprite_def(sprite_name, g_task):
+        g_base = base.result()
+        g_object = g_task.result()
+        pad = calculate_relative_padding(g_base, g_object) * sprite_size_factor
+
+        update_sprite_def(
+            sprite_overrides / f'{sprite_name}.spr',
+            g_object.width * sprite_size_factor,
+            g_object.height * sprite_size_factor,
+            pad + offset_padding
+        )
 
     for var in variants:
-        @parallel_task
-        def export_variant(var=var):
-            '''
-            if (temp_dir / f'{name}_variant_{var}.alphamap.png').is_file():
-                g_var = export_trimmed(f'{name}_variant_{var}.png')
-                parallel_task(export_cropped, f'{name}_variant_{var}.alphamap.png', g_var)
-            else:
-                g_var = export_difference(f'{name}_variant_{var}.png', f'{name}.png')
-            '''
-
-            g_var = export_trimmed(f'{name}_variant_{var}.png')
-
-            if (temp_dir / f'{name}_variant_{var}.alphamap.png').is_file():
-                parallel_task(export_cropped, f'{name}_variant_{var}.alphamap.png', g_var)
-
-            pad = calculate_relative_padding(g_base, g_var) * sprite_size_factor
-
-            update_sprite_def(
-                sprite_overrides / f'{name}_variant_{var}.spr',
-                g_var.width * sprite_size_factor, g_var.height * sprite_size_factor,
-                pad + offset_padding
-            )
-
-    update_sprite_def(
-        sprite_overrides / f'{name}.spr',
-        g_base.width * sprite_size_factor, g_base.height * sprite_size_factor,
-        offset_padding
-    )
+        var_task = trimmed_task(f'{name}_variant_{var}.png')
+        alphamap_task(f'{name}_variant_{var}.alphamap.png', var_task, f'{name}_variant_{var}.png')
 
-    for face in itertools.chain(temp_dir.glob('*_face_*.png'), temp_dir.glob('*_misc_*.png')):
-        @parallel_task
-        def face_task(face=face):
-            face_sprite_name = face.stem
-            g_face = export_trimmed(f'{face_sprite_name}.png')
-            pad = calculate_relative_padding(g_base, g_face) * sprite_size_factor
+        sched.add('image', update_relative_sprite_def, f'{name}_variant_{var}', var_task,
+            deps=[base, var_task], name=f'{name}_variant_{var}.spr')
 
-            update_sprite_def(
-                sprite_overrides / f'{face_sprite_name}.spr',
-                g_face.width * sprite_size_factor,
-                g_face.height * sprite_size_factor,
-                pad + offset_padding
-            )
+    for face in faces:
+        face_sprite_name = face[:-len('.png')]
+        face_task = trimmed_task(face)
+
+        sched.add('image', update_relative_sprite_def, face_sprite_name, face_task,
+            deps=[base, face_task], name=f'{face_sprite_name}.spr')
 
 
 def main(args):
@@ -339,6 +367,32 @@ def main(args):
         help='do not optimize images',
     )
 
+    parser.add_argument('--fuzz',
+        type=float,
+        default=0,
+        metavar='PERCENT',
+        help='treat colors within this distance as equal when trimming (like ImageMagick -fuzz)',
+    )
+
+    parser.add_argument('--krita-jobs',
+        type=int,
+        default=2,
+        metavar='N',
+        help='number of Krita processes to export the layers of each character with (default: 2)',
+    )
+
+    parser.add_argument('--cache-dir',
+        type=pathlib.Path,
+        default=diskcache.default_cache_dir('portraits'),
+        help='where to keep exported layers and signatures between runs (default: %(default)s)',
+    )
+
+    parser.add_argument('--force',
+        default=False,
+        action='store_true',
+        help='ignore the cache and export everything',
+    )
+
     parser.add_argument('--legacy',
         default=False,
         action='store_true',
@@ -354,16 +408,23 @@ def main(args):
         if 'all' in args.characters:
             args.characters = set(characters.keys())
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_dir = pathlib.Path(temp_dir)
-        futures = []
+    if args.fast:
+        optimizer = None
+    else:
+        optimizer = optimize_cache.Optimizer.from_environment(args.taisei / 'scripts' / 'optimize-img.sh')
+
+    sched = Scheduler(stages)
+
+    for name in args.characters:
+        sched.add('krita', export_char, sched, name, args, optimizer, name=name)
 
-        with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count() + 2) as ex:
-            for name in args.characters:
-                futures.append(ex.submit(export_char, name, args, ex, futures, temp_dir))
+    try:
+        sched.wait()
+    finally:
+        sched.report()
 
-            while futures:
-                futures.pop().result()
+        if optimizer is not None:
+            print(f'Optimization: {optimizer.stats}')
 
     print("Export finished, don't forget to regenerate the portraits atlas.")
     return 0
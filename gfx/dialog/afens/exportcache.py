@@ -0,0 +1,169 @@
+'''
+Persistent state for incremental portrait exports.
+
+Every character gets a directory in the cache holding the layers rendered by Krita
+(`layers/`) and a manifest. The manifest records the export plan of the .kra (see
+`krita_exportlayers.py --plan`) and, for every export target, two signatures:
+
+  - `render`: the content of the layers visible while the target is rendered, their
+    stacking order and the export override, if any. The Krita export is redone
+    when it changes.
+  - `output`: the render signature plus everything that affects the processed
+    image (preprocessing parameters, Character settings, and the render signature
+    of whichever target the crop geometry comes from). The image is reprocessed
+    and optimized when it changes.
+
+The per-layer content digests come straight from the .kra archive, so editing one
+layer only invalidates the targets in which that layer is visible.
+'''
+
+import hashlib
+import json
+import pathlib
+import threading
+import xml.etree.ElementTree as ET
+import zipfile
+
+
+KRITA_NS = '{http://www.calligra.org/DTD/krita}'
+
+# Layer attributes that don't affect the rendered image. Visibility is accounted for
+# by the export plan instead.
+UNRENDERED_ATTRS = {'visible', 'selected', 'collapsed', 'locked', 'colorlabel', 'intimeline'}
+
+# Layers whose content lives elsewhere: a clone of another (possibly hidden) layer,
+# or an external file.
+OPAQUE_NODE_TYPES = {'clonelayer', 'filelayer'}
+
+
+def digest(*parts):
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(path):
+    h = hashlib.blake2b()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class KraContents:
+    '''
+    Digests of the parts of a .kra document that affect how its layers render.
+    '''
+
+    def __init__(self, path):
+        self.whole = file_digest(path)
+
+        with zipfile.ZipFile(path) as z:
+            doc = ET.fromstring(z.read('maindoc.xml'))
+            image = doc.find(f'{KRITA_NS}IMAGE')
+            layers_prefix = f'{image.get("name")}/layers/'
+            annotations_prefix = f'{image.get("name")}/annotations/'
+
+            data = {}
+            annotations = hashlib.blake2b()
+
+            for info in sorted(z.infolist(), key=lambda i: i.filename):
+                if info.filename.startswith(layers_prefix):
+                    # layer5, layer5.defaultpixel, mask3.pixelselection.defaultpixel, ...
+                    base = info.filename[len(layers_prefix):].split('.', 1)[0]
+                    h = data.setdefault(base, hashlib.blake2b())
+                elif info.filename.startswith(annotations_prefix):
+                    h = annotations
+                else:
+                    continue
+
+                h.update(info.filename.encode())
+
+                with z.open(info) as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        h.update(chunk)
+
+        self.document = digest(dict(image.attrib), annotations.hexdigest())
+        self.nodes = {}
+        self.opaque = set()
+
+        for elem in image.iter():
+            if elem.tag not in (f'{KRITA_NS}layer', f'{KRITA_NS}mask'):
+                continue
+
+            uuid = elem.get('uuid')
+            attrs = {k: v for k, v in elem.attrib.items() if k not in UNRENDERED_ATTRS}
+            content = data.get(elem.get('filename'))
+            self.nodes[uuid] = digest(attrs, content.hexdigest() if content else None)
+
+            if elem.get('nodetype') in OPAQUE_NODE_TYPES:
+                self.opaque.add(uuid)
+
+    def signature(self, layers):
+        '''
+        Signature of the image rendered from `layers`, a list of (path, uuid) pairs.
+        '''
+
+        if any(uuid not in self.nodes or uuid in self.opaque for path, uuid in layers):
+            # Can't tell what this depends on; assume everything
+            return digest(self.whole, layers)
+
+        return digest(self.document, [(path, self.nodes[uuid]) for path, uuid in layers])
+
+
+class ExportCache:
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.layers_dir = self.path / 'layers'
+        self.manifest_path = self.path / 'manifest.json'
+        self.lock = threading.Lock()
+
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+
+        self.kra = manifest.get('kra')
+        self.plan = manifest.get('plan')
+        self.targets = manifest.get('targets', {})
+
+    def set_plan(self, kra_digest, plan):
+        with self.lock:
+            self.kra = kra_digest
+            self.plan = plan
+            self._save()
+
+    def target(self, name):
+        with self.lock:
+            return dict(self.targets.get(name, {}))
+
+    def update(self, name, **kwargs):
+        with self.lock:
+            self.targets.setdefault(name, {}).update(kwargs)
+            self._save()
+
+    def prune(self, names):
+        '''
+        Forget about targets not in `names`, and remove their rendered layers.
+        '''
+
+        with self.lock:
+            for name in list(self.targets):
+                if name not in names:
+                    del self.targets[name]
+
+            self._save()
+
+        for p in self.layers_dir.glob('*.png'):
+            if p.name not in names:
+                p.unlink()
+
+    def _save(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        tmp.write_text(json.dumps({
+            'kra': self.kra,
+            'plan': self.plan,
+            'targets': self.targets,
+        }, indent=1, sort_keys=True))
+        tmp.replace(self.manifest_path)
@@ -0,0 +1,257 @@
+'''
+In-process replacement for the ImageMagick invocations of the portrait exporter.
+
+Images are handled as NumPy arrays of shape (height, width, 4), RGBA with straight
+(non-premultiplied) alpha and the first row at the top. The preprocessing step
+(`preprocess`) reproduces what used to be
+
+    convert IMAGE -colorspace LAB -filter RobidouxSharp -resize SCALE% -colorspace sRGB -depth 8
+
+so that every source image is decoded and resized exactly once, while trimming and
+cropping work on the result in memory.
+'''
+
+import numpy
+import PIL.Image
+
+
+# Keys's cubic filter family: (B, C) parameters
+cubic_filters = {
+    'RobidouxSharp': (0.2620145123990142, 0.3689927438004929),
+    'Robidoux':      (0.3782157550939987, 0.3108921224530007),
+    'Catrom':        (0.0, 0.5),
+    'Mitchell':      (1/3, 1/3),
+}
+
+
+def cubic_bc(x, b, c):
+    x = numpy.abs(x)
+    x2 = x * x
+    x3 = x2 * x
+
+    near = ((12 - 9*b - 6*c) * x3 + (-18 + 12*b + 6*c) * x2 + (6 - 2*b)) / 6
+    far = ((-b - 6*c) * x3 + (6*b + 30*c) * x2 + (-12*b - 48*c) * x + (8*b + 24*c)) / 6
+
+    return numpy.where(x < 1, near, numpy.where(x < 2, far, 0))
+
+
+def resize_taps(src_size, dst_size, filter):
+    '''
+    Source indices and normalized filter weights, each of shape (dst_size, taps), for
+    resampling one axis, following ImageMagick's -resize: the filter support is widened
+    by the inverse scale factor when minifying, and taps outside the image are dropped.
+    '''
+
+    b, c = cubic_filters[filter]
+    factor = dst_size / src_size
+    scale = max(1 / factor, 1)
+
+    centers = (numpy.arange(dst_size) + 0.5) / factor
+    taps = int(numpy.ceil(4 * scale)) + 1
+    first = numpy.floor(centers - 2 * scale).astype(numpy.int64)
+    idx = first[:, numpy.newaxis] + numpy.arange(taps)
+    w = cubic_bc((idx + 0.5 - centers[:, numpy.newaxis]) / scale, b, c)
+    w[(idx < 0) | (idx >= src_size)] = 0
+    w /= w.sum(axis=1, keepdims=True)
+
+    return numpy.clip(idx, 0, src_size - 1), w.astype(numpy.float32)
+
+
+def resize_axis(img, dst_size, axis, filter):
+    idx, w = resize_taps(img.shape[axis], dst_size, filter)
+    shape = [1] * img.ndim
+    shape[axis] = dst_size
+    out = numpy.zeros(img.shape[:axis] + (dst_size,) + img.shape[axis + 1:], dtype=numpy.float32)
+
+    for t in range(idx.shape[1]):
+        out += numpy.take(img, idx[:, t], axis=axis) * w[:, t].reshape(shape)
+
+    return out
+
+
+def srgb_to_linear(v):
+    return numpy.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_srgb(v):
+    v = numpy.maximum(v, 0)
+    return numpy.where(v <= 0.0031308, v * 12.92, 1.055 * v ** (1 / 2.4) - 0.055)
+
+
+RGB_TO_XYZ = numpy.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+], dtype=numpy.float32)
+
+XYZ_TO_RGB = numpy.linalg.inv(RGB_TO_XYZ).astype(numpy.float32)
+
+D65 = numpy.array([0.95047, 1.0, 1.08883], dtype=numpy.float32)
+
+LAB_EPSILON = 216 / 24389
+LAB_KAPPA = 24389 / 27
+
+
+def srgb_to_lab(rgb):
+    xyz = srgb_to_linear(rgb) @ RGB_TO_XYZ.T / D65
+    f = numpy.where(xyz > LAB_EPSILON, numpy.cbrt(xyz), (LAB_KAPPA * xyz + 16) / 116)
+
+    lab = numpy.empty_like(rgb)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def lab_to_srgb(lab):
+    fy = (lab[..., 0] + 16) / 116
+    f = numpy.stack((fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200), axis=-1)
+    f3 = f ** 3
+    xyz = numpy.where(f3 > LAB_EPSILON, f3, (116 * f - 16) / LAB_KAPPA) * D65
+    return linear_to_srgb(xyz @ XYZ_TO_RGB.T)
+
+
+def load(path):
+    with PIL.Image.open(path) as img:
+        img = img.convert('RGBA')
+        return numpy.asarray(img, dtype=numpy.float32) / 255
+
+
+def save(path, img):
+    PIL.Image.fromarray(img, 'RGBA').save(path, compress_level=1)
+
+
+def quantize(img):
+    return numpy.rint(numpy.clip(img, 0, 1) * 255).astype(numpy.uint8)
+
+
+def resize(img, scale, filter):
+    '''
+    Resize a float RGBA image in the CIELAB colorspace, weighting colors by alpha.
+    '''
+
+    h, w = img.shape[:2]
+    dst_w, dst_h = max(1, round(w * scale)), max(1, round(h * scale))
+
+    alpha = img[..., 3:]
+    premul = numpy.concatenate((srgb_to_lab(img[..., :3]) * alpha, alpha), axis=-1)
+
+    # Vertical pass first: it gathers whole rows, and shrinks the horizontal pass
+    out = resize_axis(premul, dst_h, 0, filter)
+    del premul
+    out = resize_axis(out, dst_w, 1, filter)
+
+    alpha = numpy.clip(out[..., 3:], 0, 1)
+    color = numpy.divide(out[..., :3], alpha, out=numpy.zeros_like(out[..., :3]), where=alpha > 0)
+
+    return numpy.concatenate((lab_to_srgb(color), alpha), axis=-1)
+
+
+def preprocess(path, scale, filter, flop=False):
+    '''
+    Decode and resize an image, returning an 8-bit RGBA array.
+    '''
+
+    img = quantize(resize(load(path), scale, filter))
+
+    if flop:
+        img = img[:, ::-1]
+
+    return numpy.ascontiguousarray(img)
+
+
+def premultiplied(img):
+    '''
+    Multiply the colors of an 8-bit RGBA image by its alpha, keeping the alpha channel.
+    '''
+
+    pm = img.copy()
+    pm[..., :3] = img[..., :3].astype(numpy.uint16) * img[..., 3:] // 255
+    return pm
+
+
+class Geometry:
+    '''
+    A rectangle in the format of ImageMagick's %wx%h%O.
+    '''
+
+    def __init__(self, width, height, offset_x=0, offset_y=0):
+        self.width = width
+        self.height = height
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+
+    @classmethod
+    def from_box(cls, box):
+        x0, y0, x1, y1 = box
+        return cls(x1 - x0, y1 - y0, x0, y0)
+
+    def __str__(self):
+        return '{}x{}{:+}{:+}'.format(self.width, self.height, self.offset_x, self.offset_y)
+
+
+class Layer:
+    '''
+    A preprocessed 8-bit RGBA image, along with its alpha-premultiplied version.
+    '''
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.premultiplied = premultiplied(pixels)
+
+    @property
+    def alpha(self):
+        return self.pixels[..., 3]
+
+
+def content_box(mask):
+    '''
+    Bounding box (x0, y0, x1, y1) of the true values of a 2D mask, or None if empty.
+    '''
+
+    rows = numpy.flatnonzero(mask.any(axis=1))
+
+    if not rows.size:
+        return None
+
+    cols = numpy.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def differs(a, b, fuzz=0):
+    '''
+    Mask of the pixels of `a` that differ from `b` by more than `fuzz`, a fraction of
+    the full intensity range. Like ImageMagick's -fuzz, the distance is Euclidean over
+    all channels of the (premultiplied) 8-bit pixels.
+    '''
+
+    if fuzz <= 0:
+        return numpy.any(a != b, axis=-1)
+
+    d = a.astype(numpy.int32) - b
+    return numpy.einsum('...c,...c->...', d, d) > (fuzz * 255) ** 2
+
+
+def box_geometry(mask):
+    box = content_box(mask)
+
+    # ImageMagick trims an empty image down to a single pixel
+    return Geometry.from_box(box if box is not None else (0, 0, 1, 1))
+
+
+def trim_geometry(layer, fuzz=0):
+    '''
+    Geometry of everything that differs from the top-left pixel, like -trim.
+    Fully transparent pixels compare equal regardless of their color.
+    '''
+
+    pm = layer.premultiplied
+    return box_geometry(differs(pm, pm[0, 0], fuzz))
+
+
+def crop(img, geom):
+    h_img, w_img = img.shape[:2]
+    x0, y0 = max(geom.offset_x, 0), max(geom.offset_y, 0)
+    x1 = min(geom.offset_x + geom.width, w_img)
+    y1 = min(geom.offset_y + geom.height, h_img)
+    return img[y0:y1, x0:x1]
@@ -1,4 +1,3 @@
-
 from krita import *
 from contextlib import contextmanager
 
@@ -7,6 +6,9 @@ import tempfile
 import shutil
 import re
 import argparse
+import json
+
+from collections import defaultdict
 
 
 kr = Krita.instance()
@@ -19,6 +21,18 @@ exportConfig.setProperty("compression", 1)
 export_overrides = pathlib.Path(__file__).parent / 'export-overrides'
 
 
+class ExportTarget:
+    def __init__(self, fname, node_path, visible, what):
+        self.fname = fname
+        self.node_path = node_path
+        self.visible = visible
+        self.what = what
+
+    def override(self):
+        override = export_overrides / self.fname
+        return override if override.is_file() else None
+
+
 def __main__(args):
     p = argparse.ArgumentParser(description='Export layers from character art for further processing', prog=__file__)
 
@@ -38,11 +52,30 @@ def __main__(args):
         help='export single variant with static face (for v1.3.x)',
     )
 
+    p.add_argument('--plan',
+        type=pathlib.Path,
+        default=None,
+        help='write the export targets and their visible layers to this JSON file and exit without rendering',
+    )
+
+    p.add_argument('--only',
+        metavar='NAME',
+        action='append',
+        default=None,
+        help='only export the target with this output file name (may be given multiple times)',
+    )
+
+    p.add_argument('--shard',
+        type=parseShard,
+        default=(0, 1),
+        metavar='K/N',
+        help='only export the K-th of N equal parts of the export targets (K counts from 0)',
+    )
+
     args = p.parse_args(args)
 
     kra_path = args.kra
     out_path = args.output
-    is_legacy = args.legacy
 
     basename = kra_path.stem
 
@@ -50,245 +83,337 @@ def __main__(args):
     doc.setBatchmode(True)
     bounds = doc.bounds()
     root = doc.rootNode()
+    index = NodeIndex(root)
 
     def msg(*args):
         print(f'[{basename}]', *args)
 
-    def export(node, suffix='', doc=doc):
-        fname = f'{basename}{suffix}.png'
-        out = str(out_path / fname)
-        override = export_overrides / fname
+    targets = planExports(index, basename, args.legacy)
 
-        if override.is_file():
+    if args.only is not None:
+        targets = [t for t in targets if t.fname in args.only]
+
+    targets = orderTargets(targets, index.initial_visible)
+
+    if args.plan is not None:
+        args.plan.write_text(json.dumps([{
+            'name': t.fname,
+            'node': index.fullName(t.node_path),
+            'visible': sorted(index.fullName(p) for p in t.visible),
+            'layers': [[list(p), index.uuids[p]] for p in sorted(t.visible)],
+            'override': str(t.override()) if t.override() else None,
+        } for t in targets], indent=1))
+        msg(f'Wrote export plan with {len(targets)} targets to `{args.plan}`')
+        return
+
+    shard, num_shards = args.shard
+    targets = targets[shard * len(targets) // num_shards:(shard + 1) * len(targets) // num_shards]
+
+    visible = index.initial_visible
+    synced = False
+    num_toggled = 0
+    num_synced = 0
+
+    for t in targets:
+        msg(f'Exporting {t.what}...')
+        out = str(out_path / t.fname)
+        override = t.override()
+
+        if override:
             shutil.copy(override, out)
             msg(f'Copied `{override}` as `{out}`')
-        else:
-            sync(doc=doc)
-            node.save(out, 1, 1, exportConfig, bounds)
-            doc.waitForDone()
-            msg(f'Exported `{out}`')
+            continue
 
-    def sync(doc=doc):
-        doc.waitForDone()
-        doc.refreshProjection()
+        # Only touch the layers that differ from the previous export
+        for p in visible ^ t.visible:
+            index.nodes[p].setVisible(p in t.visible)
+
+        if visible != t.visible or not synced:
+            num_toggled += len(visible ^ t.visible)
+            num_synced += 1
+            sync(doc)
+            visible = t.visible
+            synced = True
+
+        node = index.nodes[t.node_path] if t.node_path else root
+        node.save(out, 1, 1, exportConfig, bounds)
         doc.waitForDone()
+        msg(f'Exported `{out}`')
+
+    msg(f'Done ({len(targets)} targets, {num_toggled} visibility toggles, {num_synced} projection refreshes)')
+    # import code; code.interact(local=locals())
+
+
+def planExports(index, basename, is_legacy):
+    '''
+    Walk through the export procedure without rendering anything, recording every
+    export target along with the set of layers visible while it's exported.
+    Visibility is tracked in a set of node paths rather than on the document itself.
+    '''
+
+    targets = []
+    visible = set(index.initial_visible)
+    root = ()
+
+    def export(node, suffix, what):
+        targets.append(ExportTarget(f'{basename}{suffix}.png', node, frozenset(visible), what))
+
+    def setVisibleAll(nodes, val):
+        if val:
+            visible.update(nodes)
+        else:
+            visible.difference_update(nodes)
+
+    def filterVisible(nodes):
+        return [n for n in nodes if n in visible]
+
+    def filterHidden(nodes):
+        return [n for n in nodes if n not in visible]
+
+    def name(node):
+        return index.names[node]
 
     @contextmanager
-    def conditions(*cond_list, root=root):
-        cond_disabled = findConditionallyDisabled(root, cond_list)
+    def conditions(*cond_list):
+        cond_disabled = filterVisible(index.conditionallyDisabled(cond_list))
         setVisibleAll(cond_disabled, False)
-        cond_enabled = findConditionallyEnabled(root, cond_list)
+        cond_enabled = filterHidden(index.conditionallyEnabled(cond_list))
         setVisibleAll(cond_enabled, True)
         yield
         setVisibleAll(cond_enabled, False)
         setVisibleAll(cond_disabled, True)
 
     @contextmanager
-    def hideExtraneous(*keep_list, root=root):
-        trash, _ = findExtraneous(root, keep_list)
-        trash = filterVisible(trash)
+    def hideExtraneous(*keep_list):
+        trash = filterVisible(index.findExtraneous(keep_list))
         setVisibleAll(trash, False)
         yield
         setVisibleAll(trash, True)
 
     @contextmanager
     def temporarilyVisible(*nodes):
-        for n in nodes: n.setVisible(True)
+        setVisibleAll(nodes, True)
         yield
-        for n in nodes: n.setVisible(False)
+        setVisibleAll(nodes, False)
 
     if is_legacy:
-        expressions = findNode(root.childNodes(), 'expression')
+        expressions = index.findChild(root, 'expression')
 
         if expressions:
-            expressions_children = expressions.childNodes()
+            expressions_children = index.children[expressions]
             setVisibleAll(expressions_children, False)
 
-            normal_face = findNode(expressions_children, 'normal')
+            normal_face = index.findChild(expressions, 'normal')
 
             if normal_face:
-                normal_face.setVisible(True)
+                setVisibleAll([normal_face], True)
 
-        variants = findNode(root.childNodes(), 'variant')
+        variants = index.findChild(root, 'variant')
 
         if variants:
-            setVisibleAll(variants.childNodes(), False)
+            setVisibleAll(index.children[variants], False)
 
-        alphamap = findNode(root.childNodes(), 'alphamap')
+        alphamap = index.findChild(root, 'alphamap')
 
         with conditions('novariant', 'face=normal'):
             if alphamap:
                 with temporarilyVisible(alphamap):
-                    msg('Exporting alphamap...')
-                    export(alphamap, '.alphamap')
-
-            msg('Exporting base...')
-            export(root)
+                    export(alphamap, '.alphamap', 'alphamap')
 
-        msg('Done')
+            export(root, '', 'base')
 
-        return
+        return targets
 
-    expressions, exp_overlay = findWithOverlay(root, 'expression')
+    expressions, exp_overlay = index.findWithOverlay(root, 'expression')
 
     if expressions:
         with temporarilyVisible(expressions):
-            setVisibleAll(expressions.childNodes(), False)
+            setVisibleAll(index.children[expressions], False)
             exp_overlay = filterVisible(exp_overlay)
-            for face in expressions.childNodes():
-                msg(f'Exporting face `{face.name()}`...')
-                with hideExtraneous(*exp_overlay, face), conditions(f'face={face.name()}'), temporarilyVisible(face):
-                    export(root, f'_face_{face.name()}')
+            for face in index.children[expressions]:
+                with hideExtraneous(*exp_overlay, face), conditions(f'face={name(face)}'), temporarilyVisible(face):
+                    export(root, f'_face_{name(face)}', f'face `{name(face)}`')
 
-    alphamap = findNode(root.childNodes(), 'alphamap')
+    alphamap = index.findChild(root, 'alphamap')
 
     if alphamap:
-        alphamap.setVisible(False)
+        setVisibleAll([alphamap], False)
 
-    variants, _ = findWithOverlay(root, 'variant')
+    variants, _ = index.findWithOverlay(root, 'variant')
     if variants:
         with temporarilyVisible(variants):
-            setVisibleAll(variants.childNodes(), False)
-            for var in variants.childNodes():
-                with temporarilyVisible(var), conditions(f'variant={var.name()}', 'body'):
+            setVisibleAll(index.children[variants], False)
+            for var in index.children[variants]:
+                with temporarilyVisible(var), conditions(f'variant={name(var)}', 'body'):
                     if alphamap:
                         with temporarilyVisible(alphamap):
                             # BUG: broken due to https://bugs.kde.org/show_bug.cgi?id=409949
-                            msg(f'Exporting variant `{var.name()}` alphamap...')
-                            export(alphamap, f'_variant_{var.name()}.alphamap')
+                            export(alphamap, f'_variant_{name(var)}.alphamap', f'variant `{name(var)}` alphamap')
 
-                    msg(f'Exporting variant `{var.name()}`...')
-                    export(root, f'_variant_{var.name()}')
+                    export(root, f'_variant_{name(var)}', f'variant `{name(var)}`')
 
     with conditions('novariant', 'body'):
         if alphamap:
             with temporarilyVisible(alphamap):
-                msg('Exporting alphamap...')
-                export(alphamap, '.alphamap')
+                export(alphamap, '.alphamap', 'alphamap')
 
-        msg('Exporting base...')
-        export(root)
+        export(root, '', 'base')
 
-    misc = findNode(root.childNodes(), 'misc_exports')
+    misc = index.findChild(root, 'misc_exports')
 
     if misc:
         with temporarilyVisible(misc):
-            setVisibleAll(misc.childNodes(), False)
+            setVisibleAll(index.children[misc], False)
 
-            for n in misc.childNodes():
+            for n in index.children[misc]:
                 with temporarilyVisible(n), hideExtraneous(n), conditions('novariant'):
-                    msg(f'Exporting misc target `{n.name()}`...')
-                    export(root, f'_misc_{n.name()}')
+                    export(root, f'_misc_{name(n)}', f'misc target `{name(n)}`')
 
             if variants:
-                for var in variants.childNodes():
-                    for n in misc.childNodes():
-                        with temporarilyVisible(n), hideExtraneous(n), conditions(f'variant={var.name()}'):
-                            msg(f'Exporting misc target `{n.name()}` (variant `{var.name()}`)...')
-                            export(root, f'_misc_{n.name()}_variant_{var.name()}')
+                for var in index.children[variants]:
+                    for n in index.children[misc]:
+                        with temporarilyVisible(n), hideExtraneous(n), conditions(f'variant={name(var)}'):
+                            export(root, f'_misc_{name(n)}_variant_{name(var)}', f'misc target `{name(n)}` (variant `{name(var)}`)')
 
-    msg('Done')
-    # import code; code.interact(local=locals())
+    return targets
 
 
-def findNode(nodes, name):
-    for node in nodes:
-        if node.name() == name:
-            return node
+def orderTargets(targets, initial_visible):
+    '''
+    Order the targets so that consecutive exports differ in as few layers as possible:
+    greedily pick the target closest to the previous one, starting from the initial
+    visibility state of the document. Overrides don't render anything and go last.
+    '''
 
+    remaining = [t for t in targets if not t.override()]
+    ordered = []
+    visible = initial_visible
 
-def findWithOverlay(root, name):
-    siblings = []
+    while remaining:
+        i = min(range(len(remaining)), key=lambda i: len(visible ^ remaining[i].visible))
+        t = remaining.pop(i)
+        ordered.append(t)
+        visible = t.visible
 
-    for n in reversed(root.childNodes()):
-        if n.name() == name:
-            return n, siblings
+    return ordered + [t for t in targets if t.override()]
 
-        x, sib = findWithOverlay(n, name)
 
-        if x:
-            return x, siblings + sib
+def parseShard(s):
+    k, n = (int(x) for x in s.split('/'))
 
-        siblings.append(n)
+    if not 0 <= k < n:
+        raise ValueError(s)
 
-    return None, []
+    return k, n
 
 
-def strLayers(layers):
-    try:
-        return repr(layers.name())
-    except AttributeError:
-        return repr([l.name() for l in layers])
+def sync(doc):
+    doc.waitForDone()
+    doc.refreshProjection()
+    doc.waitForDone()
 
 
-def findExtraneous(root, keepset, indent=0):
-    trash = []
-    found_kept = False
+class NodeIndex:
+    '''
+    One-time index of the document tree. Nodes are identified by their path from the
+    root, as a tuple of child indices; the root itself is the empty tuple.
+    '''
 
-    # print('\t'*indent + "findExtraneous(%s, %s)" % (strLayers(root), strLayers(keepset)))
+    disable_regex = re.compile(r'@disable-if\[(.*?)\]')
+    enable_regex = re.compile(r'@enable-if\[(.*?)\]')
 
-    if root in keepset:
-        return trash, True
+    def __init__(self, root):
+        self.nodes = {}
+        self.names = {(): root.name()}
+        self.uuids = {}
+        self.children = {}
+        self.disabled_by = defaultdict(list)
+        self.enabled_by = defaultdict(list)
 
-    for n in root.childNodes():
-        nested_trash, nested_found_kept = findExtraneous(n, keepset, indent+1)
+        def walk(node, path):
+            self.children[path] = []
 
-        if nested_found_kept:
-            found_kept = True
-            trash += nested_trash
-        else:
-            trash.append(n)
+            for i, n in enumerate(node.childNodes()):
+                p = path + (i,)
+                name = n.name()
+                self.nodes[p] = n
+                self.names[p] = name
+                self.uuids[p] = n.uniqueId().toString()
+                self.children[path].append(p)
 
-    # print('\t'*indent + "  --> %s, found_kept=%s" % (strLayers(trash), found_kept))
-    return trash, found_kept
+                for c in self.disable_regex.findall(name):
+                    self.disabled_by[c].append(p)
 
+                for c in self.enable_regex.findall(name):
+                    self.enabled_by[c].append(p)
 
-def walkNodes(root):
-    for n in root.childNodes():
-        yield n
+                walk(n, p)
 
-        for s in walkNodes(n):
-            yield s
+        walk(root, ())
+        self.initial_visible = frozenset(p for p, n in self.nodes.items() if n.visible())
 
+    @staticmethod
+    def parent(path):
+        return path[:-1]
 
-def findConditionallyDisabled(root, true_conds):
-    r = re.compile(r'@disable-if\[(.*?)\]')
-    ret = []
+    def siblings(self, path):
+        return [p for p in self.children[self.parent(path)] if p != path]
 
-    for n in walkNodes(root):
-        if not n.visible():
-            continue
+    def fullName(self, path):
+        return '/'.join(self.names[path[:i]] for i in range(1, len(path) + 1))
 
-        nconds = r.findall(n.name())
+    def findChild(self, path, name):
+        for p in self.children[path]:
+            if self.names[p] == name:
+                return p
 
-        for c in nconds:
-            if c in true_conds:
-                ret.append(n)
+    def findWithOverlay(self, path, name):
+        '''
+        Find the topmost node called `name` under `path`, along with the nodes above it
+        that are not its ancestors.
+        '''
 
-    return ret
+        siblings = []
 
+        for p in reversed(self.children[path]):
+            if self.names[p] == name:
+                return p, siblings
 
-def findConditionallyEnabled(root, true_conds):
-    r = re.compile(r'@enable-if\[(.*?)\]')
-    ret = []
+            x, sib = self.findWithOverlay(p, name)
 
-    for n in walkNodes(root):
-        if n.visible():
-            continue
+            if x:
+                return x, siblings + sib
+
+            siblings.append(p)
+
+        return None, []
+
+    def findExtraneous(self, keep_list):
+        '''
+        Find the nodes that neither contain nor are contained in any of `keep_list`:
+        the siblings of the kept nodes and of their ancestors.
+        '''
+
+        keep = set(keep_list)
+        keep = {k for k in keep if not any(k[:i] in keep for i in range(len(k)))}
 
-        nconds = r.findall(n.name())
+        if not keep:
+            return list(self.children[()])
 
-        for c in nconds:
-            if c in true_conds:
-                ret.append(n)
+        ancestors = {k[:i] for k in keep for i in range(len(k))}
+        trash = set()
 
-    return ret
+        for k in keep:
+            p = k
 
+            while p:
+                trash.update(s for s in self.siblings(p) if s not in keep and s not in ancestors)
+                p = self.parent(p)
 
-def filterVisible(nodes):
-    return [n for n in nodes if n.visible()]
+        return sorted(trash)
 
+    def conditionallyDisabled(self, true_conds):
+        return [p for c in true_conds for p in self.disabled_by.get(c, ())]
 
-def setVisibleAll(nodes, val):
-    for n in nodes:
-        n.setVisible(val)
+    def conditionallyEnabled(self, true_conds):
+        return [p for c in true_conds for p in self.enabled_by.get(c, ())]
@@ -2,25 +2,49 @@
 
 import sys
 import os
+import argparse
+import json
+import math
 import pathlib
 
+from fractions import Fraction
+
 script = pathlib.Path(__file__)
 
+
+def kritaEnv():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([str(script.parent)] + list(filter(None, env.get('PYTHONPATH', '').split(os.pathsep))))
+    return env
+
+
+def kritaCommand(args):
+    return ['kritarunner', '-s', script.stem, '--', *args]
+
+
 try:
     from krita import *
 except ImportError:
-    basedir = str(script.parent)
-    module = script.stem
-    os.environ['PYTHONPATH'] = os.pathsep.join([basedir] + list(filter(None, os.environ.get('PYTHONPATH', '').split(os.pathsep))))
-    os.execlp('kritarunner', 'kritarunner', '-s', module, *sys.argv[1:])
+    # Outside of Krita: render in kritarunner instances (see `coordinate`)
+    in_krita = False
+else:
+    from PyQt5.QtCore import QRect
+    in_krita = True
 
+sys.path.append(str(script.resolve().parent.parent / 'utils'))
 
-kr = Krita.instance()
-kr.setBatchmode(True)
+import optimize_cache
 
-exportConfig = InfoObject()
-exportConfig.setProperty("saveSRGBProfile", False)
-exportConfig.setProperty("compression", 1)
+
+if in_krita:
+    kr = Krita.instance()
+    kr.setBatchmode(True)
+
+    exportConfig = InfoObject()
+    exportConfig.setProperty("saveSRGBProfile", False)
+    exportConfig.setProperty("compression", 1)
+
+kra = script.parent / 'bullets.kra'
 
 resize_filter = 'RobidouxSharp'
 resize_scale = 0.75 / 4
@@ -30,8 +54,26 @@ supersampling = 2.0
 sprite_size_factor /= supersampling
 resize_scale *= supersampling
 
+# Bullets are rendered cropped to their own bounds plus this margin, in pixels of the
+# document. The margin grows while there's anything visible near the edge of the
+# crop, e.g. from layer styles.
+crop_margin = 32
+
+# Crops are aligned to the period of the resize, so that the cropped image resamples
+# exactly like the corresponding part of the whole document would.
+crop_alignment = Fraction(resize_scale).limit_denominator(1000).denominator
+
+# Width of the edge that must be empty: the support of the resize filter
+crop_guard = math.ceil(2 / resize_scale)
+
+
+def process(kra, temp_dir, exported, shard=(0, 1)):
+    '''
+    Export the bullets (of the given shard) into `temp_dir`, calling
+    `exported(name, path, offset)` as soon as each one is saved. `offset` is the
+    position of the exported image in the document, in its pixels.
+    '''
 
-def process(kra, taisei_dir, temp_dir, executor, futures):
     doc = kr.openDocument(str(kra))
     doc.setBatchmode(True)
 
@@ -46,20 +88,106 @@ def process(kra, taisei_dir, temp_dir, executor, futures):
     bullets = findNode(root.childNodes(), 'bullets').childNodes()
     setVisibleAll(bullets, False)
 
-    for bullet in bullets:
+    k, n = shard
+
+    for bullet in bullets[k::n]:
         name = bullet.name()
         export_path = temp_dir / f'{name}.png'
-        print(f'Exporting `{name}` as `{export_path}`...')
         bullet.setVisible(True)
-        doc.refreshProjection()
+        sync()
+        rect = cropRect(doc, root, bullet.bounds(), bounds)
+        print(f'Exporting `{name}` as `{export_path}` ({rect.width()}x{rect.height()}{rect.x():+}{rect.y():+})...')
+        root.save(str(export_path), 1, 1, exportConfig, rect)
         doc.waitForDone()
-        root.save(str(export_path), 1, 1, exportConfig, bounds)
-        doc.waitForDone()
-        futures.append(executor.submit(postprocess, name, export_path, taisei_dir))
+        exported(name, export_path, (rect.x() - bounds.x(), rect.y() - bounds.y()))
         bullet.setVisible(False)
 
 
-def postprocess(name, export_path, taisei_dir):
+def cropRect(doc, root, node_bounds, doc_bounds):
+    '''
+    Find the area to export for the visible bullet: its bounds plus a margin, grown
+    until nothing is rendered near the edges that aren't the edges of the document.
+    '''
+
+    if node_bounds.isEmpty():
+        return doc_bounds
+
+    margin = crop_margin
+
+    while True:
+        rect = alignRect(node_bounds.adjusted(-margin, -margin, margin, margin), doc_bounds)
+
+        if rect == doc_bounds or isEdgeTransparent(doc, root, rect, doc_bounds):
+            return rect
+
+        margin *= 2
+
+
+def alignRect(rect, doc_bounds):
+    '''
+    Grow `rect` to the alignment grid of the document, keeping it within the document.
+    '''
+
+    a = crop_alignment
+    ox, oy = doc_bounds.x(), doc_bounds.y()
+    x0 = ox + (rect.x() - ox) // a * a
+    y0 = oy + (rect.y() - oy) // a * a
+    x1 = ox - (ox - rect.x() - rect.width()) // a * a
+    y1 = oy - (oy - rect.y() - rect.height()) // a * a
+    return QRect(x0, y0, x1 - x0, y1 - y0).intersected(doc_bounds)
+
+
+def isEdgeTransparent(doc, root, rect, doc_bounds):
+    '''
+    Check the projection for visible pixels within `crop_guard` of the edges of `rect`
+    that are inside the document.
+    '''
+
+    g = crop_guard
+    x, y, w, h = rect.x(), rect.y(), rect.width(), rect.height()
+    strips = []
+
+    if x > doc_bounds.left():
+        strips.append((x, y, g, h))
+
+    if y > doc_bounds.top():
+        strips.append((x, y, w, g))
+
+    if x + w < doc_bounds.x() + doc_bounds.width():
+        strips.append((x + w - g, y, g, h))
+
+    if y + h < doc_bounds.y() + doc_bounds.height():
+        strips.append((x, y + h - g, w, g))
+
+    # Alpha is the last of 4 channels
+    channel_size = {'U8': 1, 'U16': 2, 'F16': 2, 'F32': 4}[doc.colorDepth()]
+    pixel_size = 4 * channel_size
+
+    for strip in strips:
+        data = bytes(root.projectionPixelData(*strip))
+
+        for i in range(3 * channel_size, 4 * channel_size):
+            if any(data[i::pixel_size]):
+                return False
+
+    return True
+
+
+# Set in every post-processing worker by initWorker
+optimizer = None
+
+
+def initWorker(taisei_dir):
+    global optimizer
+    optimizer = optimize_cache.Optimizer.from_environment(taisei_dir / 'scripts' / 'optimize-img.sh')
+
+
+def postprocess(name, export_path, taisei_dir, offset=(0, 0)):
+    '''
+    Resize and trim an exported bullet into the atlas. `offset` is the position of the
+    exported image in the document, in its pixels.
+    '''
+
     import subprocess
 
     print(f'Begin post-process for `{export_path}`')
@@ -73,7 +201,7 @@ def postprocess(name, export_path, taisei_dir):
     for suffix in ('png', 'webp'):
         tryRemoveFile(out_dir / f'{name}.{suffix}')
 
-    w, h = subprocess.check_output([
+    w, h, x, y = subprocess.check_output([
         'convert',
         export_path,
         '-filter', resize_filter,
@@ -82,41 +210,163 @@ def postprocess(name, export_path, taisei_dir):
         '-colorspace', 'sRGB',
         '-depth', '8',
         '-trim',
-        '-print', '%w %h',
+        '-print', '%w %h %X %Y',
         out_path,
     ], text=True).split()
 
     w, h = float(w) * sprite_size_factor, float(h) * sprite_size_factor
 
+    # Where the trimmed sprite is in the whole (resized) document
+    x = offset[0] * resize_scale + int(x)
+    y = offset[1] * resize_scale + int(y)
+
     tryRemoveFile(override_dir / f'{name}.spr.renameme')
     (override_dir / f'{name}.spr').write_text('\nw = {:g}\nh = {:g}'.format(w, h))
 
-    subprocess.check_call([taisei_dir / 'scripts' / 'optimize-img.sh', out_path])
+    result = optimizer(out_path)
+
+    print(f'End post-process for `{export_path}` (trimmed to {w:g}x{h:g} at {x:+g}{y:+g})')
+    return result
+
 
-    print(f'End post-process for `{export_path}`')
+# Marks the lines through which shards report exported bullets to the coordinator
+exported_tag = '@exported '
+
+
+def parseArgs(args):
+    p = argparse.ArgumentParser(description='Export bullet sprites into a Taisei repository', prog=script.name)
+
+    p.add_argument('taisei',
+        type=pathlib.Path,
+        help='path to the Taisei repository',
+    )
+
+    p.add_argument('--jobs',
+        type=int,
+        default=1,
+        help='number of Krita instances to render with (default: %(default)s)',
+    )
+
+    p.add_argument('--shard',
+        type=parseShard,
+        default=None,
+        help=argparse.SUPPRESS,
+    )
+
+    p.add_argument('--export-dir',
+        type=pathlib.Path,
+        default=None,
+        help=argparse.SUPPRESS,
+    )
+
+    args = p.parse_args(args)
+
+    assert kra.is_file()
+    assert args.taisei.is_dir()
+
+    return args
+
+
+def parseShard(s):
+    k, n = (int(x) for x in s.split('/'))
+
+    if not 0 <= k < n:
+        raise ValueError(s)
+
+    return k, n
+
+
+def makeExecutor(taisei_dir):
+    from concurrent.futures import ProcessPoolExecutor as Executor
+
+    ex = Executor(initializer=initWorker, initargs=(taisei_dir,))
+
+    # Fork the workers before any other thread or subprocess is around
+    ex.submit(int).result()
+    return ex
+
+
+def collect(futures):
+    stats = optimize_cache.OptimizeStats()
+
+    for fut in futures:
+        stats.add(fut.result())
+
+    print(f'Optimization: {stats}')
 
 
 def __main__(args):
     import tempfile
-    from concurrent.futures import ProcessPoolExecutor as Executor
 
-    kra = script.parent / 'bullets.kra'
-    taisei = pathlib.Path(args[0])
+    args = parseArgs(args)
 
-    assert kra.is_file()
-    assert taisei.is_dir()
+    if args.shard is not None:
+        # Rendering for `coordinate`, which does the post-processing
+        def exported(name, path, offset):
+            print(exported_tag + json.dumps([name, str(path), offset]), flush=True)
+
+        process(kra, args.export_dir, exported, args.shard)
+        return
 
     futures = []
 
-    with tempfile.TemporaryDirectory() as temp_dir, Executor() as ex:
-        process(kra, taisei, pathlib.Path(temp_dir), ex, futures)
+    with tempfile.TemporaryDirectory() as temp_dir, makeExecutor(args.taisei) as ex:
+        def exported(name, path, offset):
+            futures.append(ex.submit(postprocess, name, path, args.taisei, offset))
 
-        for fut in futures:
-            fut.result()
+        process(kra, pathlib.Path(temp_dir), exported)
+        collect(futures)
 
         # import code; code.interact(local=locals())
 
 
+def coordinate(args):
+    '''
+    Render the bullets with `args.jobs` instances of Krita, each opening the document
+    once and exporting an equal share of them. Bullets are post-processed as soon as
+    any instance reports them exported.
+    '''
+
+    import subprocess
+    import tempfile
+    import threading
+
+    futures = []
+    lock = threading.Lock()
+
+    def relay(proc):
+        for line in proc.stdout:
+            if line.startswith(exported_tag):
+                name, path, offset = json.loads(line[len(exported_tag):])
+
+                with lock:
+                    futures.append(ex.submit(postprocess, name, pathlib.Path(path), args.taisei, offset))
+            else:
+                sys.stdout.write(line)
+
+    with tempfile.TemporaryDirectory() as temp_dir, makeExecutor(args.taisei) as ex:
+        procs = [subprocess.Popen(kritaCommand([
+            str(args.taisei),
+            '--shard', f'{k}/{args.jobs}',
+            '--export-dir', temp_dir,
+        ]), env=kritaEnv(), stdout=subprocess.PIPE, text=True) for k in range(args.jobs)]
+
+        relays = [threading.Thread(target=relay, args=(proc,)) for proc in procs]
+
+        for t in relays:
+            t.start()
+
+        for t in relays:
+            t.join()
+
+        failed = [k for k, proc in enumerate(procs) if proc.wait() != 0]
+
+        collect(futures)
+
+    if failed:
+        raise RuntimeError(f'Krita failed to export shards {failed} of {args.jobs}')
+
+
 def findNode(nodes, name):
     for node in nodes:
         if node.name() == name:
@@ -133,3 +383,7 @@ def tryRemoveFile(path):
         pathlib.Path(path).unlink()
     except FileNotFoundError:
         pass
+
+
+if __name__ == '__main__' and not in_krita:
+    coordinate(parseArgs(sys.argv[1:]))
@@ -0,0 +1,118 @@
+'''
+Helpers for the on-disk caches of the exporters, which are shared between concurrent
+exporter processes.
+
+Entries are written under a temporary name and renamed into place, so that nobody
+observes a partially written file. They are evicted in least-recently-used order,
+keyed on mtime (atime is unreliable on noatime mounts), once the total size of the
+cache exceeds its limit.
+'''
+
+import contextlib
+import os
+import pathlib
+import shutil
+import tempfile
+
+
+def parse_size(s):
+    '''
+    Parse a size in bytes; K/M/G/T suffixes are accepted.
+    '''
+
+    s = str(s).strip().upper()
+    mult = 1
+
+    for suffix, m in (('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30), ('T', 1 << 40)):
+        if s.endswith(suffix):
+            s = s[:-1]
+            mult = m
+            break
+
+    return int(float(s) * mult)
+
+
+def is_disabled(value):
+    '''
+    Whether an environment setting of a cache directory turns the cache off.
+    '''
+
+    return value is not None and value.strip().lower() in ('', '0', 'off', 'no', 'false')
+
+
+def default_cache_dir(name):
+    xdg = os.environ.get('XDG_CACHE_HOME')
+
+    if xdg:
+        base = pathlib.Path(xdg)
+    else:
+        base = pathlib.Path.home() / '.cache'
+
+    return base / 'taisei-rawmedia' / name
+
+
+def copy_atomic(src, dst):
+    dst = pathlib.Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix='.tmp-', suffix=dst.suffix)
+
+    try:
+        with os.fdopen(fd, 'wb') as fout, open(src, 'rb') as fin:
+            shutil.copyfileobj(fin, fout)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, dst)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+def touch(path):
+    '''
+    Mark an entry as recently used. Returns False if it has been evicted meanwhile.
+    '''
+
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def evict(paths, max_size):
+    '''
+    Delete the least recently used of `paths` until the rest fit into `max_size` bytes.
+    Files whose names start with a dot (temporary files) are ignored.
+    Returns the number of files and bytes evicted.
+    '''
+
+    entries = []
+
+    for p in paths:
+        if p.name.startswith('.'):
+            continue
+
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+
+        entries.append((st.st_mtime, st.st_size, p))
+
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    evicted = evicted_bytes = 0
+
+    for mtime, size, p in entries:
+        if total <= max_size:
+            break
+
+        with contextlib.suppress(FileNotFoundError):
+            p.unlink()
+            evicted += 1
+            evicted_bytes += size
+
+        total -= size
+
+    return evicted, evicted_bytes
@@ -0,0 +1,139 @@
+'''
+Memoization for Taisei's scripts/optimize-img.sh, shared by the exporters.
+
+Optimized images are stored in a bounded on-disk cache keyed by the hash of the
+decoded pixels of the input and the optimizer version, so that re-exporting an
+image that hasn't changed just copies the previously optimized file into place.
+
+The optimizer version is the content of optimize-img.sh; set
+TAISEI_OPTIMIZER_VERSION to invalidate the cache when only the tools it calls
+were upgraded.
+
+Environment:
+    TAISEI_OPTIMIZE_CACHE: cache directory, or one of `off`, `0`, `no` to disable the cache.
+    TAISEI_OPTIMIZE_CACHE_SIZE: maximum cache size in bytes; K/M/G/T suffixes are accepted.
+'''
+
+import hashlib
+import os
+import pathlib
+import subprocess
+import threading
+
+import PIL.Image
+
+import diskcache
+
+
+class OptimizeResult:
+    def __init__(self, hit, size_before, size_after):
+        self.hit = hit
+        self.size_before = size_before
+        self.size_after = size_after
+
+
+class OptimizeStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.size_before = 0
+        self.size_after = 0
+        self.lock = threading.Lock()
+
+    def add(self, result):
+        with self.lock:
+            if result.hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            self.size_before += result.size_before
+            self.size_after += result.size_after
+
+    def __str__(self):
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        saved = (self.size_before - self.size_after) / (1 << 20)
+
+        return (
+            f'{self.hits} of {total} optimized images from cache ({rate:.0f}% hit rate), '
+            f'{saved:.1f} MiB saved by optimization'
+        )
+
+
+class Optimizer:
+    DEFAULT_MAX_SIZE = 2 << 30
+
+    def __init__(self, script, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        '''
+        Runs `script` on images, memoizing the results in `cache_dir` unless it is None.
+        '''
+
+        self.script = pathlib.Path(script)
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir is not None else None
+        self.max_size = max_size
+        self.stats = OptimizeStats()
+
+        h = hashlib.blake2b()
+        h.update(self.script.read_bytes())
+        h.update(os.environ.get('TAISEI_OPTIMIZER_VERSION', '').encode())
+        self.version = h.digest()
+
+    @classmethod
+    def from_environment(cls, script):
+        cache_dir = os.environ.get('TAISEI_OPTIMIZE_CACHE')
+
+        if diskcache.is_disabled(cache_dir):
+            return cls(script)
+
+        max_size = os.environ.get('TAISEI_OPTIMIZE_CACHE_SIZE')
+        max_size = cls.DEFAULT_MAX_SIZE if max_size is None else diskcache.parse_size(max_size)
+
+        return cls(script, cache_dir or diskcache.default_cache_dir('optimized'), max_size)
+
+    def key(self, path):
+        h = hashlib.blake2b(self.version)
+
+        with PIL.Image.open(path) as img:
+            h.update(f'{img.format} {img.mode} {img.width}x{img.height}\n'.encode())
+            h.update(img.tobytes())
+            # The palette and tRNS transparency are not part of the raw pixel data
+            h.update(repr((img.getpalette(), img.info.get('transparency'))).encode())
+
+        return h.hexdigest()
+
+    def entry_path(self, key, suffix):
+        return self.cache_dir / key[:2] / f'{key}{suffix}'
+
+    def optimize(self, path):
+        path = pathlib.Path(path)
+        size_before = path.stat().st_size
+
+        if self.cache_dir is None:
+            subprocess.check_call([self.script, path])
+            result = OptimizeResult(False, size_before, path.stat().st_size)
+            self.stats.add(result)
+            return result
+
+        entry = self.entry_path(self.key(path), path.suffix)
+
+        try:
+            diskcache.copy_atomic(entry, path)
+        except FileNotFoundError:
+            hit = False
+            subprocess.check_call([self.script, path])
+            diskcache.copy_atomic(path, entry)
+            self.evict()
+        else:
+            # A concurrent exporter may evict the entry right after it was copied
+            hit = True
+            diskcache.touch(entry)
+
+        result = OptimizeResult(hit, size_before, path.stat().st_size)
+        self.stats.add(result)
+        return result
+
+    __call__ = optimize
+
+    def evict(self):
+        diskcache.evict(self.cache_dir.glob('??/*'), self.max_size)
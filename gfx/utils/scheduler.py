@@ -0,0 +1,226 @@
+'''
+A small dependency-aware task scheduler for the export pipelines.
+
+Tasks belong to a stage (resource class), and every stage runs on its own thread
+pool with a fixed concurrency limit, so that slow stages can't starve the others
+and CPU-heavy stages don't oversubscribe the machine. A task starts once all of
+its dependencies have finished successfully; if any of them fails, the task is
+cancelled along with everything that depends on it. Tasks may add more tasks
+while running.
+'''
+
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TaskCancelled(RuntimeError):
+    pass
+
+
+class Task:
+    def __init__(self, stage, name, func, args, kwargs, deps):
+        self.stage = stage
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.deps = list(deps)
+        self.ignore_failed_deps = False
+        self.dependents = []
+        self.waiting = 0
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def duration(self):
+        if self.started_at is None:
+            return 0.0
+
+        return self.finished_at - self.started_at
+
+    def critical_path(self):
+        '''
+        The chain of dependencies that took the longest to run, ending with this task,
+        and its total run time (not counting time spent waiting for a free slot).
+        '''
+
+        path, total = [], 0.0
+
+        for dep in self.deps:
+            p, t = dep.critical_path()
+
+            if t > total:
+                path, total = p, t
+
+        return path + [self], total + self.duration
+
+    def result(self):
+        assert self.finished, self
+
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+    def __repr__(self):
+        return f'<Task {self.stage}: {self.name}>'
+
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.busy = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    @property
+    def wall(self):
+        if self.first_start is None:
+            return 0.0
+
+        return self.last_end - self.first_start
+
+
+class Scheduler:
+    def __init__(self, stages):
+        '''
+        `stages` maps stage names to the maximum number of concurrently running tasks.
+        '''
+
+        self.pools = {
+            stage: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=stage)
+            for stage, limit in stages.items()
+        }
+
+        self.stats = {stage: StageStats() for stage in stages}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0
+        self.failed = []
+        self.cancelled = []
+
+    def add(self, stage, func, *args, deps=(), name=None, ignore_failed_deps=False, **kwargs):
+        '''
+        Add a task running `func(*args, **kwargs)` once all of `deps` have finished.
+        With `ignore_failed_deps`, the task runs even if some of them failed; it can
+        check their `error` attribute.
+        '''
+
+        task = Task(stage, name or func.__name__, func, args, kwargs, deps)
+        task.ignore_failed_deps = ignore_failed_deps
+
+        with self.lock:
+            self.pending += 1
+
+            for dep in task.deps:
+                if not dep.finished:
+                    task.waiting += 1
+                    dep.dependents.append(task)
+                elif dep.error is not None and not ignore_failed_deps:
+                    self._cancel(task, dep)
+                    return task
+
+            if not task.waiting:
+                self._submit(task)
+
+        return task
+
+    def task(self, stage, *, deps=(), name=None, ignore_failed_deps=False):
+        '''
+        Decorator form of `add`, for tasks without arguments.
+        '''
+
+        def decorator(func):
+            return self.add(stage, func, deps=deps, name=name, ignore_failed_deps=ignore_failed_deps)
+
+        return decorator
+
+    def _submit(self, task):
+        self.pools[task.stage].submit(self._run, task)
+
+    def _run(self, task):
+        stats = self.stats[task.stage]
+        t_begin = time.monotonic()
+
+        try:
+            value, error = task.func(*task.args, **task.kwargs), None
+        except Exception as e:
+            value, error = None, e
+
+        t_end = time.monotonic()
+        task.started_at = t_begin
+        task.finished_at = t_end
+
+        with self.lock:
+            stats.count += 1
+            stats.busy += t_end - t_begin
+
+            if stats.first_start is None or t_begin < stats.first_start:
+                stats.first_start = t_begin
+
+            if stats.last_end is None or t_end > stats.last_end:
+                stats.last_end = t_end
+
+            if error is not None:
+                print(f'[{task.stage}] {task.name} failed: {error!r}')
+                self.failed.append(task)
+
+            self._finish(task, value, error)
+
+    def _finish(self, task, value, error):
+        task.value = value
+        task.error = error
+        task.finished = True
+        self.pending -= 1
+
+        for t in task.dependents:
+            if t.finished:
+                continue
+
+            if error is not None and not t.ignore_failed_deps:
+                self._cancel(t, task)
+            else:
+                t.waiting -= 1
+
+                if not t.waiting:
+                    self._submit(t)
+
+        if not self.pending:
+            self.idle.notify_all()
+
+    def _cancel(self, task, cause):
+        self.cancelled.append(task)
+        self._finish(task, None, TaskCancelled(f'{task.name}: dependency {cause.name} failed'))
+
+    def wait(self):
+        '''
+        Wait for all tasks, including those added in the meantime, then shut down the
+        pools. Raises the error of the first failed task, if any.
+        '''
+
+        with self.lock:
+            while self.pending:
+                self.idle.wait()
+
+        for pool in self.pools.values():
+            pool.shutdown()
+
+        if self.cancelled:
+            print(f'{len(self.cancelled)} tasks cancelled due to failed dependencies')
+
+        if self.failed:
+            raise self.failed[0].error
+
+    def report(self):
+        print('Stage timings:')
+
+        for stage, stats in self.stats.items():
+            print(
+                f'  {stage:<10} {stats.count:4} tasks, {stats.busy:8.1f}s busy, '
+                f'{stats.wall:8.1f}s wall'
+            )
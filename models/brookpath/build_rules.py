@@ -0,0 +1,59 @@
+TYPES = 'diffuse normal ambient roughness'.split()
+
+mkbasis_args = {
+    'normal':       ['--normal'],
+    'diffuse':      ['--rgb'],
+    'ambient':      ['--rgb'],
+    'roughness':    ['--gray-alpha', '--linear', '--no-multiply-alpha'],
+}
+
+def baked_textures(names):
+    return {(name, kind): f'textures/{name}_baked_{kind}.png' for name in names for kind in TYPES}
+
+def rules(b):
+    path_baked = baked_textures(['ground', 'rocks'])
+    path_models = [f'models/{m}.iqm' for m in ('ground', 'rocks', 'grass')]
+
+    b.blender('path.blend', 'scripts/export_models.py',
+        list(path_baked.values()) + path_models, background=False)
+
+    branch_baked = baked_textures(['branch', 'leaves'])
+    branch_models = [f'models/{m}.iqm' for m in ('branch', 'leaves')]
+
+    b.blender('branch.blend', 'scripts/export_branch.py',
+        list(branch_baked.values()) + branch_models,
+        inputs=['textures/leaf_diffuse.png', 'textures/leaf_normal.png'], background=False)
+
+    grass = 'textures/grass.png'
+    grass_baked = baked_textures(['grass'])
+
+    b.command([grass_baked['grass', 'normal']], [],
+        'convert', '-size', '256x256', 'xc:rgb(128,128,128)', grass_baked['grass', 'normal'])
+    b.command([grass_baked['grass', 'roughness']], [grass],
+        'convert', grass, '-grayscale', 'Rec709Luminance', grass_baked['grass', 'roughness'])
+    b.command([grass_baked['grass', 'diffuse']], [grass],
+        'cp', grass, grass_baked['grass', 'diffuse'])
+    b.command([grass_baked['grass', 'ambient']], [grass],
+        'convert', grass, grass_baked['grass', 'ambient'])
+
+    leaves_roughness = 'textures/leaves_composite_roughness.png'
+    b.command([leaves_roughness], [branch_baked['leaves', 'roughness']],
+        'convert', branch_baked['leaves', 'roughness'],
+        '-morphology', 'Erode', 'disk:1', '-transparent', 'black',  # trick 17
+        leaves_roughness)
+
+    basis_files = []
+
+    for (name, kind), png in (path_baked | branch_baked | grass_baked).items():
+        if (name, kind) == ('leaves', 'roughness'):
+            png = leaves_roughness
+
+        basis = f'textures/{name}_{kind}.basis'
+        b.mkbasis(basis, png, *mkbasis_args[kind])
+        basis_files.append(basis)
+
+    b.mkbasis('textures/water_floor.basis', 'textures/water_floor.png', '--rgb')
+    basis_files.append('textures/water_floor.basis')
+
+    b.install(basis_files, 'gfx/stage2/')
+    b.install(path_models + branch_models, 'models/stage2/')
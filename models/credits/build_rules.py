@@ -0,0 +1,26 @@
+TYPES = 'diffuse normal ambient roughness'.split()
+
+mkbasis_args = {
+    'normal':       ['--normal'],
+    'diffuse':      ['--rgb'],
+    'ambient':      ['--rgb'],
+    'roughness':    ['--gray-alpha', '--linear', '--no-multiply-alpha'],
+}
+
+def rules(b):
+    baked = {kind: f'textures/tower_baked_{kind}.png' for kind in TYPES}
+    model_files = [f'models/{m}.iqm' for m in ('tower', 'metal_columns')]
+
+    b.blender('creditstower.blend', 'scripts/export_models.py',
+        list(baked.values()) + model_files,
+        inputs=['../towertop/textures/sky.hdr'], background=False)
+
+    basis_files = []
+
+    for kind, png in baked.items():
+        basis = f'textures/tower_{kind}.basis'
+        b.mkbasis(basis, png, *mkbasis_args[kind])
+        basis_files.append(basis)
+
+    b.install(basis_files, 'gfx/credits/')
+    b.install(model_files, 'models/credits/')
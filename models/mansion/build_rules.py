@@ -0,0 +1,53 @@
+TEX_BAKED = 'textures/baked'
+TEX_BASIS = 'textures/basis'
+
+LANCZOS_HALF = ' -colorspace RGB -filter lanczos -resize 50% -colorspace sRGB '
+
+mkbasis_args = {
+    'normal':       ['--normal'],
+    'diffuse':      ['--rgb', '--preprocess-late', LANCZOS_HALF],
+    'ambient':      ['--rgb'],
+    'ambient_uastc': ['--rgb', '--uastc', '--uastc-rdo', '1.5', '--preprocess-late', LANCZOS_HALF],
+    'roughness':    ['--r', '--linear', '--preprocess-late', ' -filter catrom -resize 50% '],
+    'depth':        ['--r', '--linear', '--preprocess-late', ' -filter catrom -resize 50% '],
+    'ao':           ['--r', '--linear', '--preprocess-late', ' -filter gaussian -resize 50% '],
+}
+
+def basis_rules(b, name, kinds, uastc_kinds=()):
+    pngs = []
+    basis_files = []
+
+    for kind in kinds:
+        png = f'{TEX_BAKED}/{name}_{kind}.png'
+        basis = f'{TEX_BASIS}/{name}_{kind}.basis'
+        b.mkbasis(basis, png, *mkbasis_args[kind])
+        pngs.append(png)
+        basis_files.append(basis)
+
+    for kind in uastc_kinds:
+        png = f'{TEX_BAKED}/{name}_{kind}.png'
+        basis = f'{TEX_BASIS}/{name}_{kind}.basis.zst'
+        b.mkbasis(basis, png, *mkbasis_args[f'{kind}_uastc'])
+        pngs.append(png)
+        basis_files.append(basis)
+
+    return pngs, basis_files
+
+def rules(b):
+    corridor_pngs, corridor_basis = basis_rules(b, 'corridor',
+        ['diffuse', 'normal', 'ambient', 'roughness'])
+    ground_pngs, ground_basis = basis_rules(b, 'ground',
+        ['diffuse', 'normal', 'ambient', 'roughness', 'depth'])
+    mansion_pngs, mansion_basis = basis_rules(b, 'mansion',
+        ['diffuse', 'normal', 'roughness'], uastc_kinds=['ambient'])
+
+    corridor_models = ['models/corridor.iqm']
+    mansion_models = ['models/mansion.iqm', 'models/ground.iqm']
+
+    b.blender('mansion.blend', 'scripts/export_mansion.py',
+        mansion_pngs + ground_pngs + mansion_models, args=['--debug-cycles'])
+    b.blender('corridor.blend', 'scripts/export_corridor.py',
+        corridor_pngs + corridor_models, args=['--debug-cycles'])
+
+    b.install(mansion_basis + ground_basis + corridor_basis, 'gfx/stage4/')
+    b.install(mansion_models + corridor_models, 'models/stage4/')
@@ -0,0 +1,48 @@
+TYPES = 'diffuse normal ambient roughness'.split()
+
+mkbasis_args = {
+    'normal':       ['--normal'],
+    'diffuse':      ['--rgb', '--no-multiply-alpha'],
+    'ambient':      ['--rgb', '--no-multiply-alpha'],
+    'roughness':    ['--gray-alpha', '--linear', '--no-multiply-alpha'],
+}
+
+def rules(b):
+    veins = 'textures/veins.png'
+    leaf_textures = [
+        'textures/leaf.png',
+        'textures/leaf_normal/Image0001.png',
+        'textures/leaf_uv/Image0001.png',
+    ]
+
+    b.blender('leaf_texture.blend', 'scripts/render_leaftex.py', leaf_textures, inputs=[veins])
+
+    baked = {
+        (name, kind): f'textures/{name}_baked_{kind}.png'
+        for name in ('ground', 'rocks', 'trees', 'leaves') for kind in TYPES
+    }
+    leaves_alpha = 'textures/leaves_alpha_.png'
+    model_files = [f'models/{m}.iqm' for m in ('ground', 'rocks', 'leaves', 'trees')]
+
+    b.blender('mountain.blend', 'scripts/export_models.py',
+        list(baked.values()) + [leaves_alpha] + model_files,
+        inputs=leaf_textures + [veins], background=False)
+
+    leaves_roughness = 'textures/leaves_composite_roughness.png'
+    b.command([leaves_roughness], [baked['leaves', 'roughness'], leaves_alpha],
+        'convert', baked['leaves', 'roughness'],
+        '(', leaves_alpha, '-colorspace', 'gray', '-alpha', 'off', '-morphology', 'Erode', 'disk:1', ')',
+        '-compose', 'copy-opacity', '-composite', leaves_roughness)
+
+    basis_files = []
+
+    for (name, kind), png in baked.items():
+        if (name, kind) == ('leaves', 'roughness'):
+            png = leaves_roughness
+
+        basis = f'textures/{name}_{kind}.basis'
+        b.mkbasis(basis, png, *mkbasis_args[kind])
+        basis_files.append(basis)
+
+    b.install(basis_files, 'gfx/stage3/')
+    b.install(model_files, 'models/stage3/')
@@ -0,0 +1,44 @@
+TEX_BAKED = 'textures/baked'
+TEX_BASIS = 'textures/basis'
+
+texture_sets = {
+    'stairs':   'diffuse normal ambient ao roughness',
+    'wall':     'diffuse normal ambient ao roughness depth',
+    'metal':    '                       ao roughness',
+}
+
+models = 'wall stairs metal'.split()
+
+mkbasis_args = {
+    'normal':       ['--normal'],
+    'diffuse':      ['--rgb', '--preprocess-late', ' -colorspace RGB -filter lanczos -resize 50% -colorspace sRGB '],
+    'ambient':      ['--rgb'],
+    'roughness':    ['--r', '--linear', '--preprocess-late', ' -filter catrom -resize 50% '],
+    'depth':        ['--r', '--linear', '--preprocess-late', ' -filter catrom -resize 50% '],
+    'ao':           ['--r', '--linear', '--preprocess-late', ' -filter gaussian -resize 50% '],
+    'metal_ao':     ['--r', '--linear', '--preprocess-late', ' -brightness-contrast 50,25 -filter gaussian -resize 50% '],
+}
+
+def rules(b):
+    baked = {
+        (name, kind): f'{TEX_BAKED}/{name}_{kind}.png'
+        for name, kinds in texture_sets.items() for kind in kinds.split()
+    }
+    model_files = [f'models/{m}.iqm' for m in models]
+
+    b.blender('staircase.blend', 'scripts/export_models.py', list(baked.values()) + model_files)
+
+    envmap = f'{TEX_BAKED}/envmap.png'
+    envmap_basis = f'{TEX_BASIS}/envmap.basis'
+    b.blender('staircase.blend', 'scripts/export_envmap.py', [envmap])
+    b.mkbasis(envmap_basis, envmap, '--rgb', '--equirect-cubemap')
+
+    basis_files = [envmap_basis]
+
+    for (name, kind), png in baked.items():
+        basis = f'{TEX_BASIS}/{name}_{kind}.basis'
+        b.mkbasis(basis, png, *mkbasis_args.get(f'{name}_{kind}', mkbasis_args[kind]))
+        basis_files.append(basis)
+
+    b.install(basis_files, 'gfx/stage5/')
+    b.install(model_files, 'models/stage5/')
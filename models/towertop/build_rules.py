@@ -0,0 +1,56 @@
+TEX_BAKED = 'textures/baked'
+TEX_BASIS = 'textures/basis'
+
+texture_sets = {
+    'rim':          'diffuse normal ambient ao roughness depth',
+    'spires':       '        normal         ao roughness',
+    'stairs':       'diffuse normal ambient ao roughness',
+    'tower_bottom': 'diffuse normal ambient ao roughness depth',
+    'tower':        'diffuse normal ambient ao roughness depth',
+    'floor':        '        normal         ao',
+}
+
+models = 'tower stairs rim tower_bottom spires floor'.split()
+
+# Do not question these incantations. You will not have a good time.
+
+mkbasis_args = {
+    'normal':       ['--normal', '--incredibly-slow'],
+    'diffuse':      ['--rgb'],
+    'ambient':      ['--rgb'],
+    'roughness':    ['--r', '--linear'],
+    'depth':        ['--r', '--linear', '--preprocess-late', ' -normalize '],
+    'ao':           ['--r', '--linear', '--preprocess-late', ' -filter gaussian -resize 50% '],
+}
+
+def rules(b):
+    sky_texture = 'textures/sky.hdr'
+    sky_basis = f'{TEX_BASIS}/sky.basis.zst'
+
+    b.blender('sky.blend', 'scripts/render_sky.py', [sky_texture])
+    b.mkbasis(sky_basis, sky_texture,
+        '--uastc', '--incredibly-slow', '--rgb', '--equirect-cubemap',
+        '--preprocess', ' -colorspace sRGB ')
+
+    baked = {
+        (name, kind): f'{TEX_BAKED}/{name}_{kind}.png'
+        for name, kinds in texture_sets.items() for kind in kinds.split()
+    }
+    model_files = [f'models/{m}.iqm' for m in models]
+
+    b.blender('towertop.blend', 'scripts/export_models.py',
+        list(baked.values()) + model_files, inputs=[sky_texture])
+
+    quintic = 'models/calabi-yau-quintic.iqm'
+    b.blender('calabi-yau-quintic.blend', 'scripts/calabi-yau-quintic.py', [quintic],
+        background=False)
+
+    basis_files = [sky_basis]
+
+    for (name, kind), png in baked.items():
+        basis = f'{TEX_BASIS}/{name}_{kind}.basis'
+        b.mkbasis(basis, png, *mkbasis_args[kind])
+        basis_files.append(basis)
+
+    b.install(basis_files, 'gfx/stage6/')
+    b.install(model_files + [quintic], 'models/stage6/')
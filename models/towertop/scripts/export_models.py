@@ -101,20 +101,26 @@ def makesize(q):
         'default': q,
     }
 
-# NOTE: Additional downsampling is done when encoding to Basis (see makefile)
-# This gives vastly superior results over just baking at low resolution
+# NOTE: Diffuse, roughness and depth are baked at twice the resolution they are written
+# out at. AO is already baked at half size (see makesize) and gets halved once more when
+# encoding to Basis (see build_rules.py).
+downsample = {
+    ('diffuse', 'roughness', 'depth'): 0.5,
+}
 
 bake_objects(
     {
         'object': top_plate,
         'size': makesize(q >> 1),
+        'scale': downsample,
         'exclude_passes': {'ambient', 'diffuse', 'roughness'},
     },
     {
         'object': rim,
         'size': makesize(q >> 0),
-        'margin' : {
-            'roughness': q,
+        'scale': downsample,
+        'dilate' : {
+            'roughness': m.inf,
         },
     },
     {
@@ -123,30 +129,34 @@ bake_objects(
             'roughness': q >> 2,
             'default': q >> 1,
         },
-        'margin' : {
-            'roughness': q,
+        'scale': downsample,
+        'dilate' : {
+            'roughness': m.inf,
         },
         'exclude_passes': {'ambient', 'diffuse'},
     },
     {
         'object': stairs,
         'size': makesize(q >> 1),
-        'margin' : {
-            ('diffuse', 'roughness'): q,
+        'scale': downsample,
+        'dilate' : {
+            ('diffuse', 'roughness'): m.inf,
         },
     },
     {
         'object': tower,
         'size': makesize(q >> 0),
-        'margin' : {
-            'roughness': q,
+        'scale': downsample,
+        'dilate' : {
+            'roughness': m.inf,
         },
     },
     {
         'object': tower_bottom,
         'size': makesize(q >> 1),
-        'margin' : {
-            'roughness': q,
+        'scale': downsample,
+        'dilate' : {
+            'roughness': m.inf,
         },
     },
 )
@@ -0,0 +1,139 @@
+import contextlib
+import os
+import pathlib
+import shutil
+import tempfile
+
+# NOTE: this module must not depend on bpy, so that the cache can be inspected
+# and pruned from outside of Blender.
+
+def parse_size(s):
+    s = str(s).strip().upper()
+    mult = 1
+
+    for suffix, m in (('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30), ('T', 1 << 40)):
+        if s.endswith(suffix):
+            s = s[:-1]
+            mult = m
+            break
+
+    return int(float(s) * mult)
+
+def default_cache_dir():
+    xdg = os.environ.get('XDG_CACHE_HOME')
+
+    if xdg:
+        base = pathlib.Path(xdg)
+    else:
+        base = pathlib.Path.home() / '.cache'
+
+    return base / 'taisei-rawmedia' / 'bake'
+
+class BakeCache:
+    DEFAULT_MAX_SIZE = 8 << 30
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        if path is None:
+            path = default_cache_dir()
+
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+    @classmethod
+    def from_environment(cls):
+        '''
+        TAISEI_BAKE_CACHE: cache directory, or one of `off`, `0`, `no` to disable the cache.
+        TAISEI_BAKE_CACHE_SIZE: maximum cache size in bytes; K/M/G/T suffixes are accepted.
+        '''
+
+        path = os.environ.get('TAISEI_BAKE_CACHE')
+
+        if path is not None and path.strip().lower() in ('', '0', 'off', 'no', 'false'):
+            return None
+
+        max_size = os.environ.get('TAISEI_BAKE_CACHE_SIZE')
+        max_size = cls.DEFAULT_MAX_SIZE if max_size is None else parse_size(max_size)
+
+        return cls(path or None, max_size)
+
+    def entry_path(self, key):
+        return self.path / key[:2] / f'{key}.png'
+
+    def fetch(self, key, dst):
+        src = self.entry_path(key)
+
+        try:
+            shutil.copyfile(src, dst)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+
+        # Entries are evicted in least-recently-used order, keyed on mtime
+        # (atime is unreliable on noatime mounts). A concurrent baker may evict the
+        # entry right after it was copied.
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(src)
+
+        self.hits += 1
+        return True
+
+    def store(self, key, src):
+        dst = self.entry_path(key)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write under a temporary name and rename, so that concurrent bakers
+        # never observe a partially written entry.
+        fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix='.tmp-', suffix='.png')
+
+        try:
+            with os.fdopen(fd, 'wb') as fout, open(src, 'rb') as fin:
+                shutil.copyfileobj(fin, fout)
+            os.replace(tmp, dst)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+
+        self.evict()
+
+    def entries(self):
+        for p in self.path.glob('??/*.png'):
+            if p.name.startswith('.'):
+                continue
+
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+
+            yield st.st_mtime, st.st_size, p
+
+    def evict(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+
+        for mtime, size, p in entries:
+            if total <= max_size:
+                break
+
+            with contextlib.suppress(FileNotFoundError):
+                p.unlink()
+                self.evicted += 1
+                self.evicted_bytes += size
+
+            total -= size
+
+    def stats_str(self):
+        s = f'{self.hits} hits, {self.misses} misses'
+
+        if self.evicted:
+            s += f', {self.evicted} evicted ({self.evicted_bytes / (1 << 20):.1f} MiB)'
+
+        return s
@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+import bake_image
+
+# Post-bake denoising, run in worker processes after the bake.
+# NOTE: this module must not depend on bpy; it operates on plain NumPy arrays, and
+# runs as a script outside of Blender (see main).
+#
+# Images are denoised with Open Image Denoise if its `oidnDenoise` tool is available,
+# otherwise with a joint bilateral filter in NumPy. Either way, the diffuse and normal
+# bakes of the same texture set guide the filter, when they exist: texels are only
+# averaged with neighbours that have a similar albedo and normal.
+
+def find_oidn():
+    return shutil.which(os.environ.get('OIDN_DENOISE', 'oidnDenoise'))
+
+def denoiser_from_environment():
+    '''
+    The denoiser to use: 'oidn' or 'numpy', as set by $TAISEI_BAKE_DENOISER, or 'oidn'
+    if available and 'numpy' otherwise.
+    '''
+
+    name = os.environ.get('TAISEI_BAKE_DENOISER', '').strip().lower()
+
+    if name in ('oidn', 'numpy'):
+        return name
+
+    if name:
+        raise ValueError(f'Unknown denoiser `{name}`, expected `oidn` or `numpy`')
+
+    return 'oidn' if find_oidn() is not None else 'numpy'
+
+def write_pfm(path, rgb):
+    h, w = rgb.shape[:2]
+
+    with open(path, 'wb') as f:
+        # Negative scale means little-endian
+        f.write(f'PF\n{w} {h}\n-1.0\n'.encode('ascii'))
+        f.write(numpy.ascontiguousarray(rgb, dtype='<f4').tobytes())
+
+def read_pfm(path):
+    with open(path, 'rb') as f:
+        kind = f.readline().strip()
+        w, h = (int(x) for x in f.readline().split())
+        scale = float(f.readline())
+        channels = {b'PF': 3, b'Pf': 1}[kind]
+        dtype = '<f4' if scale < 0 else '>f4'
+        data = numpy.fromfile(f, dtype=dtype, count=w * h * channels)
+
+    return data.astype(numpy.float32).reshape(h, w, channels)
+
+def denoise_oidn(color, albedo=None, normal=None):
+    '''
+    Denoise an RGB image with `oidnDenoise`, exchanging images through PFM files.
+    OIDN only takes normals together with an albedo.
+    '''
+
+    with tempfile.TemporaryDirectory(prefix='taisei-denoise-') as tmpdir:
+        def tmp(name):
+            return os.path.join(tmpdir, f'{name}.pfm')
+
+        write_pfm(tmp('color'), color)
+        cmd = [find_oidn(), '--ldr', tmp('color')]
+
+        if albedo is not None:
+            write_pfm(tmp('albedo'), albedo)
+            cmd += ['--alb', tmp('albedo')]
+
+            if normal is not None:
+                write_pfm(tmp('normal'), normal)
+                cmd += ['--nrm', tmp('normal')]
+
+        cmd += ['-o', tmp('output')]
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        return read_pfm(tmp('output'))
+
+def denoise_bilateral(color, albedo=None, normal=None, radius=3, sigma_spatial=2.0,
+                      sigma_color=0.1, sigma_albedo=0.05, sigma_normal=0.1, band_rows=256):
+    '''
+    Denoise an RGB image with a joint bilateral filter over a window of (2 * radius + 1)²
+    texels, weighting neighbours by distance and by their difference in color and in
+    each of the guides. Vectorised over the window offsets, in bands of `band_rows` rows.
+    '''
+
+    h, w = color.shape[:2]
+    guides = [(color, sigma_color)]
+
+    if albedo is not None:
+        guides.append((albedo, sigma_albedo))
+
+    if normal is not None:
+        guides.append((normal, sigma_normal))
+
+    padded = [numpy.pad(g, ((radius, radius), (radius, radius), (0, 0)), mode='edge') for g, s in guides]
+    out = numpy.empty_like(color)
+
+    for y0 in range(0, h, band_rows):
+        y1 = min(y0 + band_rows, h)
+        center = [p[y0 + radius:y1 + radius, radius:radius + w] for p in padded]
+        acc = numpy.zeros((y1 - y0, w, color.shape[2]), dtype=numpy.float32)
+        total = numpy.zeros((y1 - y0, w, 1), dtype=numpy.float32)
+
+        for dy in range(-radius, radius + 1):
+            for dx in range(-radius, radius + 1):
+                shifted = [
+                    p[y0 + radius + dy:y1 + radius + dy, radius + dx:radius + dx + w]
+                    for p in padded
+                ]
+
+                e = numpy.full((y1 - y0, w, 1), (dx * dx + dy * dy) / (2 * sigma_spatial ** 2),
+                               dtype=numpy.float32)
+
+                for (g, sigma), c, s in zip(guides, center, shifted):
+                    e += numpy.square(s - c).sum(axis=-1, keepdims=True) / (2 * sigma * sigma)
+
+                weight = numpy.exp(-e)
+                acc += weight * shifted[0]
+                total += weight
+
+        out[y0:y1] = acc / total
+
+    return out
+
+def denoise_bake(color, out_path, channels, srgb=False, albedo=None, normal=None,
+                 denoiser='numpy'):
+    '''
+    Denoise a baked image and write it into `out_path` as a PNG with `channels` channels.
+    Meant to be run in a process pool, see denoise_jobs.
+
+    `color`, and the optional `albedo` (sRGB encoded) and tangent-space `normal` guides
+    are 8-bit RGBA arrays, bottom-up as read from Blender images. Set `srgb` if `color`
+    is sRGB encoded. The guides are resampled to the size of `color` if needed. Alpha is
+    kept as is.
+    '''
+
+    h, w = color.shape[:2]
+
+    def prepare(img):
+        img = img[..., :3].astype(numpy.float32) / 255
+
+        if img.shape[:2] != (h, w):
+            img = bake_image.resample(img, w, h, 'box')
+
+        return img
+
+    rgb = prepare(color)
+
+    if srgb:
+        rgb = bake_image.srgb_to_linear(rgb)
+
+    if albedo is not None:
+        albedo = bake_image.srgb_to_linear(prepare(albedo))
+
+    if normal is not None:
+        normal = prepare(normal) * 2 - 1
+
+    if denoiser == 'oidn':
+        rgb = denoise_oidn(rgb, albedo, normal)
+    else:
+        rgb = denoise_bilateral(rgb, albedo, normal)
+
+    if srgb:
+        rgb = bake_image.linear_to_srgb(rgb)
+
+    result = numpy.concatenate((
+        bake_image.quantize(rgb),
+        color[..., 3:],
+    ), axis=-1)[..., :channels]
+
+    # Blender images are stored bottom-up, PNG rows go top-down
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp = out_path + '.tmp'
+
+    try:
+        bake_image.write_png(tmp, w, h, channels, [result[::-1]])
+        os.replace(tmp, out_path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return out_path
+
+def denoise_jobs(jobs, workers=None):
+    '''
+    Run denoise_bake in a pool of `workers` processes (default: one per CPU) for every
+    job, a dict of its arguments, with the images given as paths of .npy files. Returns
+    a list of error messages, with None for the jobs that succeeded.
+    '''
+
+    def load(path):
+        return None if path is None else numpy.load(path)
+
+    with ProcessPoolExecutor(workers) as ex:
+        futures = [
+            ex.submit(
+                denoise_bake, load(job['color']), job['out_path'], job['channels'],
+                srgb=job['srgb'], albedo=load(job['albedo']), normal=load(job['normal']),
+                denoiser=job['denoiser'])
+            for job in jobs
+        ]
+
+        errors = []
+
+        for fut in futures:
+            try:
+                fut.result()
+            except Exception as e:
+                errors.append(f'{type(e).__name__}: {e}')
+            else:
+                errors.append(None)
+
+    return errors
+
+def main(args):
+    '''
+    Denoise the jobs listed in a JSON file (see denoise_jobs), writing the list of
+    errors into another. This runs as a separate Python process, since forking the
+    worker processes from within Blender is not safe.
+    '''
+
+    parser = argparse.ArgumentParser(description='Denoise baked textures', prog=args[0])
+    parser.add_argument('jobs', help='JSON file with the list of jobs')
+    parser.add_argument('results', help='where to write the JSON list of errors')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    args = parser.parse_args(args[1:])
+
+    with open(args.jobs) as f:
+        jobs = json.load(f)
+
+    with open(args.results, 'w') as f:
+        json.dump(denoise_jobs(jobs, args.workers), f)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
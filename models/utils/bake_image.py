@@ -0,0 +1,342 @@
+import struct
+import zlib
+
+import numpy
+
+# Image processing helpers for baked textures.
+# NOTE: this module must not depend on bpy; it operates on plain NumPy arrays.
+# Arrays are indexed as [row, column, channel], with the first row at the top.
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+def quantize(pixels, bit_depth=8):
+    maxval = (1 << bit_depth) - 1
+    dtype = numpy.uint8 if bit_depth == 8 else numpy.uint16
+    return numpy.rint(numpy.clip(pixels, 0, 1) * maxval).astype(dtype)
+
+def estimate_noise(mean, mean_samples, batch, batch_samples, channels=3):
+    '''
+    Estimate the RMS error of the combination of two independent Monte Carlo estimates
+    of the same image: `mean` (averaged over `mean_samples` samples per texel) and
+    `batch` (`batch_samples` samples per texel). Both are flat RGBA float arrays.
+
+    The per-texel variance is derived from the difference between the two estimates:
+    Var(batch - mean) = σ² * (1/batch_samples + 1/mean_samples). Texels left empty
+    by both estimates (outside of the UV islands and margin) are ignored.
+    '''
+
+    mean = mean.reshape(-1, 4)[:, :channels]
+    batch = batch.reshape(-1, 4)[:, :channels]
+
+    covered = numpy.any(mean != 0, axis=1) | numpy.any(batch != 0, axis=1)
+
+    if not numpy.any(covered):
+        return 0.0
+
+    diff = batch[covered] - mean[covered]
+    variance = numpy.mean(numpy.square(diff)) / (1 / mean_samples + 1 / batch_samples)
+    return float(numpy.sqrt(variance / (mean_samples + batch_samples)))
+
+def _png_chunk(f, tag, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(tag)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag))))
+
+def _png_filter_rows(rows, prev_row, bpp):
+    '''
+    Apply the PNG None, Sub or Up filter to each row of `rows`, whichever produces the
+    smallest sum of absolute differences (the usual libpng heuristic, minus Paeth).
+    `rows` is a uint8 array of shape (num_rows, row_bytes).
+    '''
+
+    rows = rows.astype(numpy.int16)
+    prev = numpy.vstack((prev_row[numpy.newaxis].astype(numpy.int16), rows[:-1]))
+
+    sub = rows.copy()
+    sub[:, bpp:] -= rows[:, :-bpp]
+
+    candidates = numpy.stack((
+        rows,
+        sub,
+        rows - prev,
+    ))
+
+    def score(c):
+        c = (c & 0xFF).astype(numpy.int8)
+        return numpy.abs(c.astype(numpy.int16)).sum(axis=-1)
+
+    scores = numpy.stack([score(c) for c in candidates])
+    choice = numpy.argmin(scores, axis=0)
+    filtered = candidates[choice, numpy.arange(rows.shape[0])].astype(numpy.uint8)
+
+    # Filter type bytes: 0 = None, 1 = Sub, 2 = Up
+    filter_types = choice.astype(numpy.uint8)
+    return numpy.hstack((filter_types[:, numpy.newaxis], filtered))
+
+def write_png(path, width, height, channels, bands, bit_depth=8, compression=6):
+    '''
+    Write a PNG file from an iterable of image bands, top to bottom.
+
+    Each band is an array of shape (rows, width, channels) holding a horizontal
+    strip of the image, so the whole image never has to be in memory at once.
+    '''
+
+    compressor = zlib.compressobj(compression)
+    bpp = channels * (bit_depth // 8)
+    prev_row = numpy.zeros(width * bpp, dtype=numpy.uint8)
+    rows_written = 0
+
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        _png_chunk(f, b'IHDR', struct.pack(
+            '>IIBBBBB', width, height, bit_depth, PNG_COLOR_TYPES[channels], 0, 0, 0))
+
+        for band in bands:
+            band = numpy.asarray(band)
+
+            if band.ndim == 2:
+                band = band[..., numpy.newaxis]
+
+            assert band.shape[1:] == (width, channels), band.shape
+
+            if bit_depth == 16:
+                band = band.astype('>u2')
+
+            rows = numpy.ascontiguousarray(band).view(numpy.uint8).reshape(band.shape[0], -1)
+            data = compressor.compress(_png_filter_rows(rows, prev_row, bpp).tobytes())
+            prev_row = rows[-1]
+            rows_written += band.shape[0]
+
+            if data:
+                _png_chunk(f, b'IDAT', data)
+
+        assert rows_written == height, (rows_written, height)
+
+        _png_chunk(f, b'IDAT', compressor.flush())
+        _png_chunk(f, b'IEND', b'')
+
+def rasterize_coverage(triangles, width, height, chunk_texels=1 << 22):
+    '''
+    Rasterize triangles into a boolean coverage mask of shape (height, width).
+    `triangles` is an array of shape (n, 3, 2) of vertex coordinates in texels. As with
+    Cycles bakes, a texel is covered if its centre is inside (or on the edge of) any of
+    the triangles.
+
+    Triangles are processed in chunks of up to `chunk_texels` texels of bounding boxes.
+    '''
+
+    mask = numpy.zeros((height, width), dtype=bool)
+    tris = numpy.asarray(triangles, dtype=numpy.float64).reshape(-1, 3, 2)
+
+    a, b, c = tris[:, 0], tris[:, 1], tris[:, 2]
+    area = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])
+
+    # Bounding boxes in texel indices, from the first to one past the last texel centre
+    x0 = numpy.clip(numpy.ceil(tris[..., 0].min(axis=1) - 0.5), 0, width).astype(numpy.int64)
+    x1 = numpy.clip(numpy.floor(tris[..., 0].max(axis=1) - 0.5) + 1, 0, width).astype(numpy.int64)
+    y0 = numpy.clip(numpy.ceil(tris[..., 1].min(axis=1) - 0.5), 0, height).astype(numpy.int64)
+    y1 = numpy.clip(numpy.floor(tris[..., 1].max(axis=1) - 0.5) + 1, 0, height).astype(numpy.int64)
+    bw = numpy.maximum(x1 - x0, 0)
+    counts = bw * numpy.maximum(y1 - y0, 0)
+
+    keep = (counts > 0) & (area != 0)
+    tris, area, x0, y0, bw, counts = tris[keep], area[keep], x0[keep], y0[keep], bw[keep], counts[keep]
+
+    # Edge functions A*x + B*y + C, non-negative inside of the triangle, of shape (3, n)
+    p, q = tris.transpose(1, 2, 0), numpy.roll(tris, -1, axis=1).transpose(1, 2, 0)
+    sign = numpy.sign(area)
+    ea = (p[:, 1] - q[:, 1]) * sign
+    eb = (q[:, 0] - p[:, 0]) * sign
+    # Grown by a tiny fraction of a texel, so that texel centres on an edge shared by two
+    # triangles don't end up outside of both through rounding
+    ec = -(ea * p[:, 0] + eb * p[:, 1]) + 1e-6 * numpy.hypot(ea, eb)
+
+    ends = numpy.cumsum(counts)
+    begin = 0
+
+    while begin < len(tris):
+        base = ends[begin] - counts[begin]
+        end = max(begin + 1, int(numpy.searchsorted(ends, base + chunk_texels, side='right')))
+        n = counts[begin:end]
+
+        tri = numpy.repeat(numpy.arange(begin, end), n)
+        offset = numpy.arange(ends[end - 1] - base) - numpy.repeat(ends[begin:end] - n - base, n)
+        px = x0[tri] + offset % bw[tri]
+        py = y0[tri] + offset // bw[tri]
+        cx, cy = px + 0.5, py + 0.5
+
+        inside = numpy.ones(len(tri), dtype=bool)
+
+        for i in range(3):
+            inside &= ea[i, tri] * cx + eb[i, tri] * cy + ec[i, tri] >= 0
+
+        mask[py[inside], px[inside]] = True
+        begin = end
+
+    return mask
+
+def nearest_seed(seeds, band_cols=1024):
+    '''
+    Exact Euclidean distance transform of the boolean mask `seeds`. Returns the squared
+    distance from every texel to the nearest seed texel, and the row and column of that
+    seed. Texels are infinitely far away if there are no seeds at all.
+
+    The nearest seed within each row is found first, with cumulative scans. Columns are
+    then solved as lower envelopes of parabolas (Felzenszwalb & Huttenlocher), vectorised
+    over bands of `band_cols` columns, so only the rows are iterated over in Python.
+    '''
+
+    h, w = seeds.shape
+    far = numpy.int32(2 * (h + w))
+    cols = numpy.arange(w, dtype=numpy.int32)
+
+    left = numpy.maximum.accumulate(numpy.where(seeds, cols, -far), axis=1)
+    right = numpy.minimum.accumulate(numpy.where(seeds, cols, far)[:, ::-1], axis=1)[:, ::-1]
+    row_seed = numpy.where(cols - left <= right - cols, left, right)
+    del left, right
+
+    dist2 = numpy.empty((h, w), dtype=numpy.float32)
+    seed_y = numpy.empty((h, w), dtype=numpy.int32)
+
+    for c0 in range(0, w, band_cols):
+        c1 = min(c0 + band_cols, w)
+        n = c1 - c0
+        band = numpy.arange(n)
+
+        # Lower envelope of every column: parabola vertices `v`, their heights `f` and
+        # the boundaries between them `z`, indexed by k * n + column
+        k = numpy.full(n, -1, dtype=numpy.int64)
+        v = numpy.zeros(h * n, dtype=numpy.int64)
+        f = numpy.zeros(h * n, dtype=numpy.float64)
+        z = numpy.zeros((h + 1) * n, dtype=numpy.float64)
+
+        for q in range(h):
+            dx = row_seed[q, c0:c1] - cols[c0:c1]
+            act = numpy.flatnonzero(numpy.abs(dx) < far // 2)
+
+            if not act.size:
+                continue
+
+            fq = numpy.square(dx[act], dtype=numpy.float64)
+            kk = k[act]
+
+            while True:
+                i = numpy.maximum(kk, 0) * n + act
+                vk = v[i]
+                s = ((fq + q * q) - (f[i] + vk * vk)) / numpy.maximum(2 * (q - vk), 1)
+                pop = (kk > 0) & (s <= z[i])
+
+                if not pop.any():
+                    break
+
+                kk = kk - pop
+
+            s[kk < 0] = -numpy.inf
+            kk += 1
+            i = kk * n + act
+            v[i] = q
+            f[i] = fq
+            z[i] = s
+            z[i + n] = numpy.inf
+            k[act] = kk
+
+        has_seeds = k >= 0
+        k = numpy.zeros(n, dtype=numpy.int64)
+
+        for p in range(h):
+            while True:
+                adv = has_seeds & (z[(k + 1) * n + band] < p)
+
+                if not adv.any():
+                    break
+
+                k += adv
+
+            i = k * n + band
+            vk = v[i]
+            seed_y[p, c0:c1] = vk
+            dist2[p, c0:c1] = numpy.where(has_seeds, numpy.square(p - vk) + f[i], numpy.inf)
+
+    seed_x = numpy.take_along_axis(row_seed, seed_y, axis=0)
+    return dist2, seed_y, seed_x
+
+def dilate(pixels, coverage, margin=0, distance=numpy.inf):
+    '''
+    Extend the texels covered by `coverage` (boolean, same shape as `pixels` minus the
+    channels) outwards, in place: every texel further than `margin` and at most
+    `distance` texels away from the coverage takes the value of the nearest covered texel.
+    Texels within `margin` are left alone, as they were already filled by the bake.
+    '''
+
+    if distance <= margin or not coverage.any():
+        return pixels
+
+    dist2, seed_y, seed_x = nearest_seed(coverage)
+    fill = (dist2 > margin * margin) & (dist2 <= float(distance) ** 2)
+    pixels[fill] = pixels[seed_y[fill], seed_x[fill]]
+    return pixels
+
+def srgb_to_linear(c):
+    return numpy.where(c <= 0.04045, c / 12.92, numpy.power((c + 0.055) / 1.055, 2.4)).astype(c.dtype)
+
+def linear_to_srgb(c):
+    c = numpy.maximum(c, 0)
+    return numpy.where(c <= 0.0031308, c * 12.92, 1.055 * numpy.power(c, 1 / 2.4) - 0.055).astype(c.dtype)
+
+# Resampling filters, as in ImageMagick: (support, kernel)
+RESAMPLE_FILTERS = {
+    'box':      (0.5, lambda x: (numpy.abs(x) <= 0.5).astype(numpy.float64)),
+    'gaussian': (1.5, lambda x: numpy.exp(-2 * x * x)),
+    'catrom':   (2.0, lambda x: numpy.select(
+        [numpy.abs(x) < 1, numpy.abs(x) < 2],
+        [1.5 * numpy.abs(x) ** 3 - 2.5 * x * x + 1,
+         -0.5 * numpy.abs(x) ** 3 + 2.5 * x * x - 4 * numpy.abs(x) + 2])),
+    'lanczos':  (3.0, lambda x: numpy.sinc(x) * numpy.sinc(x / 3) * (numpy.abs(x) < 3)),
+}
+
+def _resample_taps(n_in, n_out, filter):
+    '''
+    Source indices and weights, each of shape (n_out, taps), for resampling a line of
+    `n_in` texels to `n_out` texels. When downsampling, the filter is widened to cover
+    the texels each output texel is made of. Edge texels are repeated.
+    '''
+
+    support, kernel = RESAMPLE_FILTERS[filter]
+    stretch = max(n_in / n_out, 1)
+    centers = (numpy.arange(n_out) + 0.5) * (n_in / n_out)
+    taps = int(numpy.ceil(2 * support * stretch)) + 1
+    first = numpy.floor(centers - support * stretch).astype(numpy.int64)
+    idx = first[:, numpy.newaxis] + numpy.arange(taps)
+    weights = kernel((idx + 0.5 - centers[:, numpy.newaxis]) / stretch)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return numpy.clip(idx, 0, n_in - 1), weights.astype(numpy.float32)
+
+def resample(pixels, width, height, filter='lanczos'):
+    '''
+    Resample an image array of shape (rows, columns, channels) to `width` x `height`
+    with a separable filter from RESAMPLE_FILTERS. Values are filtered as they are, so
+    anything non-linear (like sRGB) should be converted beforehand.
+    '''
+
+    def resample_axis(a, n_out, axis):
+        idx, weights = _resample_taps(a.shape[axis], n_out, filter)
+        shape = [1] * a.ndim
+        shape[axis] = n_out
+        out = numpy.zeros(a.shape[:axis] + (n_out,) + a.shape[axis + 1:], dtype=numpy.float32)
+
+        for t in range(idx.shape[1]):
+            out += numpy.take(a, idx[:, t], axis=axis) * weights[:, t].reshape(shape)
+
+        return out
+
+    pixels = numpy.asarray(pixels, dtype=numpy.float32)
+
+    if pixels.shape[1] != width:
+        pixels = resample_axis(pixels, width, 1)
+
+    if pixels.shape[0] != height:
+        pixels = resample_axis(pixels, height, 0)
+
+    return pixels
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+
+'''
+Incremental build driver for the model export pipelines.
+
+Every scene directory has a `build_rules.py` defining `rules(b)`, which declares
+the build steps on a `Build`: Blender export scripts, Basis encoding, and
+arbitrary commands. Run this script from a scene directory:
+
+    python3 ../utils/build.py [-j JOBS] [target ...]
+    python3 ../utils/build.py --install PREFIX
+    python3 ../utils/build.py --clean
+
+Steps are rebuilt when the content of their inputs or their command changes, or
+when one of their outputs is missing. Independent steps run in parallel, with
+Blender steps limited to one at a time since they use all cores on their own.
+
+$BLENDER and $MKBASIS override the tools to run, and $MKBASIS_ARGS adds arguments
+to every mkbasis call.
+
+Blender steps are also incremental internally: export_utils records a fingerprint
+of the objects behind every exported .iqm and of every baked texture in an export
+manifest, and skips outputs whose fingerprint hasn't changed. When only some
+outputs of a Blender step are needed, only those are exported.
+'''
+
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib.util
+import json
+import os
+import pathlib
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+utils_dir = pathlib.Path(__file__).resolve().parent
+
+# Changes to these affect the output of every Blender step
+blender_support_files = tuple(
+    utils_dir / f for f in ('export_utils.py', 'bake_cache.py', 'bake_image.py', 'bake_denoise.py'))
+
+STATE_FILE = '.build-state.json'
+
+
+class BuildError(RuntimeError):
+    pass
+
+
+class Step:
+    def __init__(self, outputs, inputs, command, pool='default', env=None, name=None):
+        self.outputs = [pathlib.Path(p) for p in outputs]
+        self.inputs = [pathlib.Path(p) for p in inputs]
+        self.command = command
+        self.pool = pool
+        self.env = env or {}
+        self.name = name or str(self.outputs[0])
+        self.deps = set()
+
+    def __repr__(self):
+        return f'<Step {self.name}>'
+
+
+class FileHasher:
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+        self.lock = threading.Lock()
+
+    def digest(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        stamp = [st.st_size, st.st_mtime_ns]
+        key = str(path)
+
+        with self.lock:
+            entry = self.known.get(key)
+
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+        h = hashlib.blake2b()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+
+        digest = h.hexdigest()
+
+        with self.lock:
+            self.known[key] = (stamp, digest)
+
+        return digest
+
+
+class Build:
+    def __init__(self, root):
+        self.root = pathlib.Path(root).resolve()
+        self.steps = []
+        self.producers = {}
+        self.installs = []
+        self.pool_limits = {'blender': 1}
+
+    def path(self, p):
+        return self.root / p
+
+    def step(self, outputs, inputs, command, **kwargs):
+        step = Step(outputs, inputs, command, **kwargs)
+
+        for out in step.outputs:
+            if out in self.producers:
+                raise BuildError(f'Output `{out}` produced by multiple steps')
+            self.producers[out] = step
+
+        self.steps.append(step)
+        return step
+
+    def blender(self, blend, script, outputs, inputs=(), background=True, args=()):
+        cmd = [os.environ.get('BLENDER', 'blender')]
+
+        if background:
+            cmd.append('--background')
+
+        cmd += [str(blend)] + list(args) + ['--python', str(script)]
+        manifest = f'.export-manifest.{pathlib.Path(blend).stem}.json'
+
+        return self.step(
+            outputs,
+            [blend, script] + list(inputs) + list(blender_support_files),
+            cmd,
+            pool='blender',
+            env={'TAISEI_EXPORT_MANIFEST': manifest},
+        )
+
+    def mkbasis(self, output, input, *args):
+        cmd = [os.environ.get('MKBASIS', 'mkbasis'), str(input)] + list(args)
+        # Extra arguments for every mkbasis call, like the MKBASIS_ARGS of the old makefiles
+        cmd += shlex.split(os.environ.get('MKBASIS_ARGS', ''))
+        return self.step([output], [input], cmd + ['-o', str(output)])
+
+    def command(self, outputs, inputs, *cmd, shell=False):
+        if shell:
+            cmd = ['sh', '-c', ' '.join(cmd)]
+
+        return self.step(outputs, inputs, list(cmd))
+
+    def install(self, files, dest):
+        self.installs.append((dest, [pathlib.Path(f) for f in files]))
+
+    def _resolve_deps(self):
+        for step in self.steps:
+            step.deps = {self.producers[i] for i in step.inputs if i in self.producers}
+
+    def _select(self, targets):
+        '''
+        Find the steps needed to build `targets`, and which of their outputs are needed.
+        '''
+
+        needed = {}
+        queue = []
+
+        for t in targets:
+            t = pathlib.Path(t)
+
+            try:
+                step = self.producers[t]
+            except KeyError:
+                raise BuildError(f'No rule to build `{t}`')
+
+            queue.append((step, t))
+
+        while queue:
+            step, out = queue.pop()
+            outs = needed.setdefault(step, set())
+
+            if out in outs:
+                continue
+
+            outs.add(out)
+
+            for i in step.inputs:
+                if i in self.producers:
+                    queue.append((self.producers[i], i))
+
+        return needed
+
+    def default_targets(self):
+        targets = []
+
+        for dest, files in self.installs:
+            targets += files
+
+        return targets
+
+    def run(self, targets=None, jobs=None, dry_run=False):
+        self._resolve_deps()
+
+        if not targets:
+            targets = self.default_targets()
+
+        needed = self._select(targets)
+        jobs = jobs or os.cpu_count() or 1
+
+        state_path = self.path(STATE_FILE)
+
+        try:
+            state = json.loads(state_path.read_text())
+        except (FileNotFoundError, ValueError):
+            state = {}
+
+        hasher = FileHasher(state.get('files'))
+        signatures = state.setdefault('steps', {})
+        state_lock = threading.Lock()
+
+        def save_state():
+            with hasher.lock:
+                state['files'] = dict(hasher.known)
+
+            tmp = state_path.with_name(state_path.name + '.tmp')
+            tmp.write_text(json.dumps(state, indent=1, sort_keys=True))
+            tmp.replace(state_path)
+
+        def signature(step):
+            h = hashlib.blake2b()
+            h.update(repr((step.command, sorted(step.env.items()))).encode())
+
+            for i in step.inputs:
+                d = hasher.digest(self.path(i))
+
+                if d is None:
+                    raise BuildError(f'{step.name}: missing input `{i}`')
+
+                h.update(f'{i}={d}\n'.encode())
+
+            return h.hexdigest()
+
+        def execute(step):
+            missing = [i for i in step.inputs if not self.path(i).exists()]
+
+            if missing and dry_run and all(i in self.producers for i in missing):
+                # Would be produced by a step that hasn't run
+                sig = None
+            else:
+                sig = signature(step)
+                outputs_exist = all(self.path(o).exists() for o in step.outputs)
+
+                if outputs_exist and signatures.get(step.name) == sig:
+                    return False
+
+            print(f'[build] {step.name}: {" ".join(map(str, step.command))}', flush=True)
+
+            if dry_run:
+                return True
+
+            for o in step.outputs:
+                self.path(o).parent.mkdir(parents=True, exist_ok=True)
+
+            env = dict(os.environ)
+            env.update(step.env)
+
+            wanted = needed[step]
+            if len(wanted) < len(step.outputs):
+                env['TAISEI_EXPORT_ONLY'] = os.pathsep.join(str(o) for o in sorted(wanted))
+
+            t_begin = time.monotonic()
+            ret = subprocess.call(step.command, cwd=self.root, env=env)
+
+            if ret != 0:
+                raise BuildError(f'{step.name}: command failed with exit code {ret}')
+
+            missing = [str(o) for o in wanted if not self.path(o).exists()]
+            if missing:
+                raise BuildError(f'{step.name}: command did not produce {", ".join(missing)}')
+
+            print(f'[build] {step.name}: done in {time.monotonic() - t_begin:.1f}s', flush=True)
+
+            # Only remember the signature if every output was built
+            if len(wanted) == len(step.outputs):
+                with state_lock:
+                    signatures[step.name] = sig
+                    save_state()
+
+            return True
+
+        pending = set(needed)
+        stuck = []
+        done = set()
+        failed = set()
+        running = {}
+        pool_usage = {}
+        num_built = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+            while pending or running:
+                # Repeat until nothing more is skipped, failures propagate through whole chains
+                while True:
+                    skipped = sorted((s for s in pending if s.deps & failed), key=lambda s: s.name)
+
+                    if not skipped:
+                        break
+
+                    for step in skipped:
+                        print(f'[build] {step.name}: skipped due to failed dependencies')
+                        pending.discard(step)
+                        failed.add(step)
+
+                for step in sorted(pending, key=lambda s: s.name):
+                    if not step.deps <= done:
+                        continue
+
+                    limit = self.pool_limits.get(step.pool, jobs)
+                    if pool_usage.get(step.pool, 0) >= limit:
+                        continue
+
+                    pool_usage[step.pool] = pool_usage.get(step.pool, 0) + 1
+                    pending.discard(step)
+                    running[ex.submit(execute, step)] = step
+
+                if not running:
+                    # Nothing runs and nothing can start: the remaining steps wait on each other
+                    stuck = sorted(step.name for step in pending)
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for fut in finished:
+                    step = running.pop(fut)
+                    pool_usage[step.pool] -= 1
+
+                    try:
+                        num_built += fut.result()
+                        done.add(step)
+                    except (BuildError, OSError) as e:
+                        print(f'[build] ERROR: {e}', file=sys.stderr)
+                        failed.add(step)
+
+        if not dry_run:
+            with state_lock:
+                save_state()
+
+        if failed:
+            raise BuildError(f'{len(failed)} steps failed')
+
+        if stuck:
+            raise BuildError(f'{len(stuck)} steps can never run (dependency cycle?): {", ".join(stuck)}')
+
+        print(f'[build] {num_built} of {len(needed)} steps rebuilt')
+
+    def do_install(self, prefix):
+        for dest, files in self.installs:
+            dest_dir = pathlib.Path(prefix + dest)
+            dest_dir.mkdir(parents=True, exist_ok=True)
+
+            for f in files:
+                shutil.copy(self.path(f), dest_dir / f.name)
+
+    def do_clean(self, everything=False):
+        for step in self.steps:
+            for o in step.outputs:
+                # Renders and bakes take hours; only remove them if asked to
+                if step.pool == 'blender' and o.suffix != '.iqm' and not everything:
+                    continue
+
+                with contextlib.suppress(FileNotFoundError):
+                    self.path(o).unlink()
+
+        with contextlib.suppress(FileNotFoundError):
+            self.path(STATE_FILE).unlink()
+
+
+def load_rules(root):
+    rules_path = root / 'build_rules.py'
+    spec = importlib.util.spec_from_file_location('build_rules', rules_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, str(utils_dir))
+    spec.loader.exec_module(module)
+
+    b = Build(root)
+    module.rules(b)
+    return b
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Build exported models and textures', prog=args[0])
+
+    parser.add_argument('targets',
+        nargs='*',
+        help='files to build (default: everything that gets installed)',
+    )
+
+    parser.add_argument('-C', '--directory',
+        type=pathlib.Path,
+        default=pathlib.Path.cwd(),
+        help='scene directory containing build_rules.py',
+    )
+
+    parser.add_argument('-j', '--jobs',
+        type=int,
+        default=None,
+        help='maximum number of steps to run in parallel (default: number of CPUs)',
+    )
+
+    parser.add_argument('-n', '--dry-run',
+        default=False,
+        action='store_true',
+        help='print stale steps without running them',
+    )
+
+    parser.add_argument('--install',
+        metavar='PREFIX',
+        default=None,
+        help='build, then copy the results into PREFIX',
+    )
+
+    parser.add_argument('--clean',
+        default=False,
+        action='store_true',
+        help='remove build outputs, except for textures rendered by Blender',
+    )
+
+    parser.add_argument('--clean-all',
+        default=False,
+        action='store_true',
+        help='remove all build outputs',
+    )
+
+    args = parser.parse_args(args[1:])
+    b = load_rules(args.directory)
+
+    if args.clean or args.clean_all:
+        b.do_clean(everything=args.clean_all)
+        return 0
+
+    try:
+        b.run(args.targets, jobs=args.jobs, dry_run=args.dry_run)
+    except BuildError as e:
+        print(f'[build] {e}', file=sys.stderr)
+        return 1
+
+    if args.install is not None and not args.dry_run:
+        b.do_install(args.install)
+
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
@@ -1,4 +1,3 @@
-
 import bpy
 import bpy_types
 
@@ -8,8 +7,22 @@ import contextlib
 import dataclasses
 import datetime
 import collections
+import functools
+import hashlib
 import itertools
+import json
+import math
+import numpy
+import subprocess
+import sys
+import tempfile
+import threading
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import bake_denoise
+import bake_image
+from bake_cache import BakeCache
 
 def cleanup_mesh():
     bpy.ops.object.editmode_toggle()
@@ -48,7 +61,79 @@ def merge_objects(main, *rest):
 
     return main
 
+class ExportManifest:
+    '''
+    Fingerprints of the outputs produced by an export script. Used together with the
+    build driver (see build.py) to skip outputs that are up to date, or not requested.
+    '''
+
+    def __init__(self, path, only=None):
+        self.path = os.path.abspath(path)
+        self.root = os.path.dirname(self.path)
+        self.only = None if only is None else {self._key(p) for p in only}
+
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def _abspath(self, output):
+        return os.path.abspath(bpy.path.abspath(output))
+
+    def _key(self, output):
+        return os.path.relpath(self._abspath(output), self.root)
+
+    def wanted(self, output):
+        return self.only is None or self._key(output) in self.only
+
+    def is_current(self, output, digest):
+        return self.entries.get(self._key(output)) == digest and os.path.exists(self._abspath(output))
+
+    def update(self, output, digest):
+        self.entries[self._key(output)] = digest
+        tmp = self.path + '.tmp'
+
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+        os.replace(tmp, self.path)
+
+_export_manifest = None
+
+def get_export_manifest():
+    '''
+    Returns the ExportManifest configured by the build driver through
+    $TAISEI_EXPORT_MANIFEST and $TAISEI_EXPORT_ONLY, or None.
+    '''
+
+    global _export_manifest
+
+    if _export_manifest is None:
+        path = os.environ.get('TAISEI_EXPORT_MANIFEST')
+
+        if not path:
+            return None
+
+        only = os.environ.get('TAISEI_EXPORT_ONLY')
+        _export_manifest = ExportManifest(path, only.split(os.pathsep) if only else None)
+
+    return _export_manifest
+
 def export_obj(filepath):
+    manifest = get_export_manifest()
+
+    if manifest is not None:
+        if not manifest.wanted(filepath):
+            print(f'Skipping `{filepath}`: not requested')
+            return
+
+        digest = selection_digest()
+
+        if manifest.is_current(filepath, digest):
+            print(f'Skipping `{filepath}`: up to date')
+            return
+
     bpy.ops.export.iqm(
         filepath=filepath,
         usemesh=True,
@@ -58,6 +143,9 @@ def export_obj(filepath):
         usecol=False
     )
 
+    if manifest is not None:
+        manifest.update(filepath, digest)
+
 class PerPassBakeSetting:
     def __init__(self, setting_name, value_or_mapping, default_value=None):
         if isinstance(value_or_mapping, collections.abc.Mapping):
@@ -117,6 +205,21 @@ class PerPassBakeSizeSetting(PerPassBakeSetting):
 
         return int(w), int(h)
 
+class PerPassBakeBoolSetting(PerPassBakeSetting):
+    @staticmethod
+    def _process_value(value):
+        return bool(value)
+
+class PerPassBakeFloatSetting(PerPassBakeSetting):
+    @staticmethod
+    def _process_value(value):
+        return float(value)
+
+class PerPassBakeDistanceSetting(PerPassBakeSetting):
+    @staticmethod
+    def _process_value(value):
+        value = float(value)
+        return value if math.isinf(value) else int(value)
 
 def iter_objects(objects):
     if isinstance(objects, bpy.types.Object):
@@ -153,7 +256,7 @@ class BakeConfig:
 
     def __init__(self, object,
                  size=DEFAULT_SIZE, alpha=False, exclude_passes=None, margin=DEFAULT_MARGIN,
-                 output_name=None):
+                 output_name=None, tile_size=0, dilate=0, scale=1, samples=0, denoise=False):
         if output_name is None:
             if hasattr(object, 'name'):
                 output_name = object.name
@@ -170,6 +273,16 @@ class BakeConfig:
         self.output_name = output_name
         self.size = PerPassBakeSizeSetting('size', size, self.DEFAULT_SIZE)
         self.margin = PerPassBakeIntSetting('margin', margin, self.DEFAULT_MARGIN)
+        # 0 means no tiling; see bake_tiled
+        self.tile_size = PerPassBakeSizeSetting('tile_size', tile_size, 0)
+        # How far to extend the UV islands after baking, may be math.inf; see dilate_bake
+        self.dilate = PerPassBakeDistanceSetting('dilate', dilate, 0)
+        # Output size relative to the bake size; see postprocess_bake
+        self.scale = PerPassBakeFloatSetting('scale', scale, 1)
+        # 0 means the sample count of the bake_objects call or the pass
+        self.samples = PerPassBakeIntSetting('samples', samples, 0)
+        # Denoise after baking instead of with Cycles; see denoise_bakes
+        self.denoise = PerPassBakeBoolSetting('denoise', denoise, False)
         self.alpha = alpha
 
         if exclude_passes is None:
@@ -179,18 +292,475 @@ class BakeConfig:
                 (bake_passes[p] if isinstance(p, str) else p) for p in exclude_passes
             }
 
+def bake_output_size(size, scale):
+    w, h = size
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+def bake_output_filepath(texture_name, bake_pass):
+    return f'//textures/baked/{texture_name}_{bake_pass.name}.png'
+
+def bake_raw_filepath(texture_name, bake_pass):
+    # Noisy bakes, before denoise_bakes
+    return f'//textures/baked/.raw/{texture_name}_{bake_pass.name}.png'
+
+def bake_job_filepath(cfg, bake_pass):
+    '''
+    Where bake_objects_pass writes its result for texture set `cfg`.
+    '''
+
+    if bake_pass.is_denoise_sensible and cfg.denoise.get_value(bake_pass):
+        return bake_raw_filepath(cfg.output_name, bake_pass)
+
+    return bake_output_filepath(cfg.output_name, bake_pass)
+
 def create_bake_output_image(
-    texture_name, bake_pass, size, alpha=False, format='PNG'):
+    texture_name, bake_pass, size, alpha=False, format='PNG', float_buffer=False):
     name = f'bake.{texture_name}.{bake_pass.name}'
     w, h = size
 
-    img = bpy.data.images.new(name, w, h, alpha=alpha and bake_pass.may_have_alpha)
+    img = bpy.data.images.new(name, w, h, alpha=alpha and bake_pass.may_have_alpha,
+                              float_buffer=float_buffer)
+    setup_bake_output_image(img, texture_name, bake_pass, format)
+
+    return img
+
+def setup_bake_output_image(img, texture_name, bake_pass, format='PNG'):
     img.file_format = format
     img.colorspace_settings.name = bake_pass.colorspace
     img.colorspace_settings.is_data = (bake_pass.colorspace == 'Non-Color')
-    img.filepath_raw = f'//textures/baked/{texture_name}_{bake_pass.name}.png'
+    img.filepath_raw = bake_output_filepath(texture_name, bake_pass)
 
-    return img
+class BakeImagePool:
+    '''
+    Bake target images, kept around to be reused by later bakes of the same size instead
+    of allocating a new image datablock for every texture set and pass. Acquired images
+    are not cleared, so they must be baked into with `use_clear=True`.
+    '''
+
+    def __init__(self):
+        self.images = {}
+        self.free = collections.defaultdict(list)
+
+    def acquire(self, texture_name, bake_pass, size, alpha=False):
+        key = (tuple(size), bool(alpha and bake_pass.may_have_alpha))
+
+        if self.free[key]:
+            img = self.free[key].pop()
+            setup_bake_output_image(img, texture_name, bake_pass)
+        else:
+            img = create_bake_output_image(texture_name, bake_pass, size, alpha=alpha)
+            self.images[img.name] = (img, key)
+
+        return img
+
+    def release(self, img):
+        img, key = self.images[img.name]
+        self.free[key].append(img)
+
+    def clear(self):
+        for img, key in self.images.values():
+            bpy.data.images.remove(img)
+
+        self.images.clear()
+        self.free.clear()
+
+@contextlib.contextmanager
+def bake_target_image(cfg, img):
+    '''
+    Make `img` the bake target for all materials of the texture set `cfg`.
+    '''
+
+    junknodes = set()
+
+    mset = set()
+    for obj in cfg.objects:
+        for mat in obj.data.materials:
+            mset.add(mat)
+
+    for mat in mset:
+        node = mat.node_tree.nodes.new(type='ShaderNodeTexImage')
+        node.image = img
+        mat.node_tree.nodes.active = node
+        junknodes.add((mat.node_tree.nodes, node))
+
+    try:
+        yield
+    finally:
+        for nodeset, node in junknodes:
+            nodeset.remove(node)
+
+def _mib(nbytes):
+    return f'{nbytes / (1 << 20):.1f}'
+
+def _bake_buffer_bytes(w, h):
+    # Float RGBA bake result, plus the 8-bit RGBA target image
+    return w * h * (16 + 4)
+
+def _peak_rss_mib():
+    try:
+        import resource
+    except ImportError:
+        return '?'
+
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return _mib(rss)
+
+    return _mib(rss << 10)
+
+class BakeOutputWriter:
+    '''
+    Write bake results to PNG files in background threads, so that the next bake can run
+    while the previous result is being encoded (zlib and NumPy mostly release the GIL).
+
+    The pixels of the image are read back once when submitted, after which the image may
+    be baked into again. At most `max_pending` read back results are kept in memory.
+    '''
+
+    def __init__(self, workers=2, max_pending=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bake-writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = []
+
+    def submit(self, img, out_path, channels, bit_depth=8, done=None, postprocess=None):
+        '''
+        Queue the current contents of `img` to be written into `out_path`. `done(out_path)`
+        is called by join once the file is written. If given, `postprocess(pixels, size)`
+        is applied before writing, in the writer thread, and returns the new pixels and size.
+        Returns the size of the readback buffer.
+        '''
+
+        w, h = img.size
+        self.slots.acquire()
+
+        try:
+            pixels = numpy.empty(w * h * 4, dtype=numpy.float32)
+            img.pixels.foreach_get(pixels)
+            fut = self.executor.submit(
+                self._write, pixels, out_path, w, h, channels, bit_depth, postprocess)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        fut.add_done_callback(lambda fut: self.slots.release())
+        self.pending.append((fut, out_path, done))
+        return pixels.nbytes
+
+    @staticmethod
+    def _write(pixels, out_path, w, h, channels, bit_depth, postprocess, band_rows=256):
+        if postprocess is not None:
+            pixels, (w, h) = postprocess(pixels, (w, h))
+
+        # Blender images are stored bottom-up, PNG rows go top-down
+        rows = pixels.reshape(h, w, 4)[::-1, :, :channels]
+        bands = (bake_image.quantize(rows[y:y + band_rows], bit_depth) for y in range(0, h, band_rows))
+
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        tmp = out_path + '.tmp'
+
+        try:
+            bake_image.write_png(tmp, w, h, channels, bands, bit_depth)
+            os.replace(tmp, out_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+
+    def join(self):
+        '''
+        Wait for all queued writes and call their `done` callbacks on this thread.
+        Raises BakeError if any of them failed.
+        '''
+
+        pending, self.pending = self.pending, []
+        errors = []
+
+        for fut, out_path, done in pending:
+            try:
+                fut.result()
+            except Exception as e:
+                errors.append(f'`{out_path}`: {e}')
+                continue
+
+            if done is not None:
+                done(out_path)
+
+        if errors:
+            raise BakeError('Failed to write bake outputs:\n' + '\n'.join(errors))
+
+    def close(self):
+        self.executor.shutdown()
+
+def bake_coverage_mask(cfg, size):
+    '''
+    Rasterize the active UV layers of texture set `cfg` into a boolean mask of the texels
+    that are baked, bottom-up like Blender images.
+    '''
+
+    w, h = size
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    triangles = []
+
+    for obj in cfg.objects:
+        eval_obj = obj.evaluated_get(depsgraph)
+        mesh = eval_obj.to_mesh()
+
+        try:
+            mesh.calc_loop_triangles()
+            loops = numpy.empty(len(mesh.loop_triangles) * 3, dtype=numpy.int32)
+            mesh.loop_triangles.foreach_get('loops', loops)
+            uv = numpy.empty(len(mesh.loops) * 2, dtype=numpy.float32)
+            mesh.uv_layers.active.data.foreach_get('uv', uv)
+            triangles.append(uv.reshape(-1, 2)[loops].reshape(-1, 3, 2) * (w, h))
+        finally:
+            eval_obj.to_mesh_clear()
+
+    return bake_image.rasterize_coverage(numpy.concatenate(triangles), w, h)
+
+def dilate_bake(pixels, coverage, margin, distance):
+    '''
+    Extend the UV islands of a bake result (a flat RGBA array, as read from the image) up
+    to `distance` texels outwards, filling every texel with its nearest baked texel. This
+    does the job of a large bake margin much faster than Blender's margin extension; the
+    first `margin` texels around the islands are kept as baked.
+    '''
+
+    w, h = coverage.shape[1], coverage.shape[0]
+    bake_image.dilate(pixels.reshape(h, w, 4), coverage, margin, distance)
+    return pixels
+
+def postprocess_bake(pixels, size, bake_pass, dilate=None, out_size=None, srgb=False):
+    '''
+    Dilate (see dilate_bake; `dilate` is a tuple of its remaining arguments) and resample
+    to `out_size` a bake result: a flat RGBA array of `size`, as read from the image.
+    Returns the new pixels and their size.
+
+    Resampling is done in linear light: set `srgb` if the pixels are sRGB encoded, as
+    with byte images of sRGB passes (float images are always linear). Normals are
+    renormalized afterwards. The filter is the `resample_filter` of the pass.
+    '''
+
+    if dilate is not None:
+        dilate_bake(pixels, *dilate)
+
+    if out_size is None or tuple(out_size) == tuple(size):
+        return pixels, size
+
+    (w, h), (ow, oh) = size, out_size
+    pixels = pixels.reshape(h, w, 4)
+    rgb = pixels[..., :3]
+
+    if srgb:
+        rgb = bake_image.srgb_to_linear(rgb)
+    elif bake_pass.name == 'normal':
+        rgb = rgb * 2 - 1
+
+    out = numpy.empty((oh, ow, 4), dtype=numpy.float32)
+    out[..., :3] = bake_image.resample(rgb, ow, oh, bake_pass.resample_filter)
+    out[..., 3:] = bake_image.resample(pixels[..., 3:], ow, oh, bake_pass.resample_filter)
+    rgb = out[..., :3]
+
+    if srgb:
+        rgb[:] = bake_image.linear_to_srgb(rgb)
+    elif bake_pass.name == 'normal':
+        length = numpy.linalg.norm(rgb, axis=-1, keepdims=True)
+        numpy.divide(rgb, length, out=rgb, where=length > 0)
+        rgb *= 0.5
+        rgb += 0.5
+
+    return out.reshape(-1), out_size
+
+def bake_tiled(cfg, bake_pass, size, tile_size, bake_args, out_path):
+    '''
+    Bake texture set `cfg` into `out_path` one tile of the UV space at a time.
+
+    Each tile is baked into a small image by remapping the tile region to the unit
+    square in a temporary UV layer. The tile is baked with an overlap of up to `margin`
+    pixels on every side (capped at half the tile size), so that margin extension at the
+    seams sees the neighbouring islands. Tile cores are written to disk as they are
+    baked, then streamed into the final PNG, so peak memory depends on the tile size
+    rather than the texture size. For the same reason, tiled bakes can not be dilated or
+    scaled after baking (see postprocess_bake).
+
+    Only the active UV layer is swapped; the active render layer is left alone, so
+    image textures in the materials are still sampled with the original UVs.
+
+    Returns a short description of the memory used, for reporting.
+    '''
+
+    w, h = size
+    tw, th = min(tile_size[0], w), min(tile_size[1], h)
+    margin = bake_args['margin']
+    overlap = min(margin, tw // 2, th // 2)
+    pw, ph = tw + 2 * overlap, th + 2 * overlap
+    nx, ny = -(-w // tw), -(-h // th)
+    channels = 4 if cfg.alpha and bake_pass.may_have_alpha else 3
+
+    if overlap < margin:
+        print(f'[{bake_pass.name}] Tile overlap capped to {overlap}px (margin is {margin}px)')
+
+    uv_layers = []
+
+    for mesh in {obj.data for obj in cfg.objects}:
+        src_layer = mesh.uv_layers.active
+        uv = numpy.empty(len(src_layer.data) * 2, dtype=numpy.float32)
+        src_layer.data.foreach_get('uv', uv)
+        render_layer = next((l.name for l in mesh.uv_layers if l.active_render), None)
+
+        tile_layer = mesh.uv_layers.new(name='bake.tile', do_init=False)
+        mesh.uv_layers.active = tile_layer
+
+        if render_layer is not None:
+            mesh.uv_layers[render_layer].active_render = True
+
+        uv_layers.append((mesh, src_layer.name, tile_layer.name, uv))
+
+    img = create_bake_output_image(cfg.output_name, bake_pass, (pw, ph), alpha=cfg.alpha)
+    pixels = numpy.empty(pw * ph * 4, dtype=numpy.float32)
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='taisei-bake-tiles-') as tiledir:
+            def tile_path(ix, iy):
+                return os.path.join(tiledir, f'{ix}_{iy}.npy')
+
+            with bake_target_image(cfg, img):
+                for iy, ix in itertools.product(range(ny), range(nx)):
+                    x0, y0 = ix * tw, iy * th
+                    cw, ch = min(tw, w - x0), min(th, h - y0)
+                    ox, oy = x0 - overlap, y0 - overlap
+
+                    for mesh, src_name, tile_name, uv in uv_layers:
+                        tile_uv = numpy.empty_like(uv)
+                        tile_uv[0::2] = (uv[0::2] * w - ox) / pw
+                        tile_uv[1::2] = (uv[1::2] * h - oy) / ph
+                        mesh.uv_layers[tile_name].data.foreach_set('uv', tile_uv)
+                        mesh.update()
+
+                    print(f'[{bake_pass.name}] Baking tile {ix},{iy} of {nx}x{ny}')
+                    bpy.ops.object.bake(use_clear=True, **bake_args)
+
+                    img.pixels.foreach_get(pixels)
+                    core = pixels.reshape(ph, pw, 4)[
+                        overlap:overlap + ch, overlap:overlap + cw, :channels]
+                    numpy.save(tile_path(ix, iy), bake_image.quantize(core))
+
+            # Blender images are stored bottom-up, PNG rows go top-down
+            def bands():
+                for iy in reversed(range(ny)):
+                    band = numpy.concatenate([numpy.load(tile_path(ix, iy)) for ix in range(nx)], axis=1)
+                    yield band[::-1]
+
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            bake_image.write_png(out_path, w, h, channels, bands())
+    finally:
+        bpy.data.images.remove(img)
+
+        for mesh, src_name, tile_name, uv in uv_layers:
+            mesh.uv_layers.remove(mesh.uv_layers[tile_name])
+            mesh.uv_layers.active = mesh.uv_layers[src_name]
+
+    # Tiles also need a float readback buffer
+    tile_bytes = _bake_buffer_bytes(pw, ph) + pixels.nbytes
+    return (f'{nx * ny} tiles, bake buffers {_mib(tile_bytes)} MiB '
+            f'(untiled: {_mib(_bake_buffer_bytes(w, h))} MiB)')
+
+ADAPTIVE_BUDGET_DIR = '//textures/baked/.samples'
+
+def adaptive_budget_path(texture_name, bake_pass, budget_dir=ADAPTIVE_BUDGET_DIR):
+    return os.path.join(bpy.path.abspath(budget_dir), f'{texture_name}_{bake_pass.name}.json')
+
+def load_adaptive_budget(path):
+    try:
+        with open(path) as f:
+            return json.load(f)['samples']
+    except (FileNotFoundError, ValueError, KeyError):
+        return 0
+
+def bake_adaptive(cfg, bake_pass, size, bake_args, out_path, max_samples, noise_threshold,
+                  min_samples, budget_path, postprocess=None):
+    '''
+    Bake texture set `cfg` into `out_path` progressively, in batches of samples with
+    different seeds, until the estimated RMS noise drops to `noise_threshold` or
+    `max_samples` is reached.
+
+    Every batch after the first takes as many samples as all previous batches combined,
+    and is compared against their running average to estimate the noise. The number of
+    samples used is recorded in `budget_path`, and the next run starts from that budget
+    instead of `min_samples`. `postprocess` is as for BakeOutputWriter.submit.
+
+    Returns the number of samples used and the final noise estimate.
+    '''
+
+    w, h = size
+    channels = 4 if cfg.alpha and bake_pass.may_have_alpha else 3
+    budget = load_adaptive_budget(budget_path)
+    batch = max(1, (budget or min_samples) // 2)
+
+    img = create_bake_output_image(
+        cfg.output_name, bake_pass, size, alpha=cfg.alpha, float_buffer=True)
+    pixels = numpy.empty(w * h * 4, dtype=numpy.float32)
+    mean = None
+    total = 0
+    noise = float('inf')
+
+    cycles = bpy.context.scene.cycles
+    prev_seed = cycles.seed
+
+    try:
+        with bake_target_image(cfg, img):
+            for batch_idx in itertools.count():
+                n = min(batch, max_samples - total)
+                cycles.seed = prev_seed + batch_idx
+
+                with cycles_samples(n):
+                    bpy.ops.object.bake(use_clear=True, **bake_args)
+
+                img.pixels.foreach_get(pixels)
+
+                if mean is None:
+                    mean = pixels.copy()
+                else:
+                    noise = bake_image.estimate_noise(mean, total, pixels, n, channels)
+                    mean *= total / (total + n)
+                    pixels *= n / (total + n)
+                    mean += pixels
+
+                total += n
+
+                print(f'[{bake_pass.name}] Batch {batch_idx}: {n} samples, '
+                      f'{total} total, estimated noise {noise:.5f}')
+
+                if noise <= noise_threshold or total >= max_samples:
+                    break
+
+                batch = total
+
+        out_size = size
+
+        if postprocess is not None:
+            mean, out_size = postprocess(mean, size)
+
+        if tuple(out_size) != tuple(size):
+            bpy.data.images.remove(img)
+            img = create_bake_output_image(
+                cfg.output_name, bake_pass, out_size, alpha=cfg.alpha, float_buffer=True)
+
+        img.pixels.foreach_set(mean)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        img.filepath_raw = out_path
+        img.save()
+    finally:
+        cycles.seed = prev_seed
+        bpy.data.images.remove(img)
+
+    os.makedirs(os.path.dirname(budget_path), exist_ok=True)
+
+    with open(budget_path, 'w') as f:
+        json.dump({'samples': total, 'noise': noise, 'threshold': noise_threshold}, f)
+
+    return total, noise
 
 def get_material_output_node(m):
     if not m.use_nodes or not m.node_tree:
@@ -280,6 +850,11 @@ class BakePass:
     colorspace: str = 'Non-Color'
     samples: int = 0
     may_have_alpha: bool = False
+    # Whether the result depends on the rest of the scene (lighting, occluders),
+    # rather than just the baked objects and their materials.
+    scene_dependent: bool = False
+    # Used to downsample to the output size; see bake_image.RESAMPLE_FILTERS
+    resample_filter: str = 'lanczos'
     prepare: Callable[[set, set], None] = dataclasses.field(
         default_factory=lambda: lambda configs, mats: None, repr=False)
 
@@ -294,19 +869,305 @@ bake_passes = collections.OrderedDict((
     # NOTE: order matters. prepare functions have side effects!
 
     ('normal',      BakePass('normal',      'NORMAL',       None)), #, samples=1)),
-    ('ambient',     BakePass('ambient',     'COMBINED',     None,       'sRGB')),
-    ('ao',          BakePass('ao',          'AO',           None)),
-    ('roughness',   BakePass('roughness',   'ROUGHNESS',    None, samples=1, may_have_alpha=True)),
+    ('ambient',     BakePass('ambient',     'COMBINED',     None,       'sRGB',
+                             scene_dependent=True)),
+    ('ao',          BakePass('ao',          'AO',           None,       scene_dependent=True,
+                             resample_filter='gaussian')),
+    ('roughness',   BakePass('roughness',   'ROUGHNESS',    None, samples=1, may_have_alpha=True,
+                             resample_filter='catrom')),
     ('diffuse',     BakePass('diffuse',     'DIFFUSE',      {'COLOR'},  'sRGB',
                              samples=1, prepare=prepare_diffuse_bake)),
     ('depth',       BakePass('depth',       'EMIT',         None,
-                             samples=1, prepare=prepare_depth_bake)),
+                             samples=1, resample_filter='catrom', prepare=prepare_depth_bake)),
 ))
 
 class BakeError(RuntimeError):
     pass
 
-def bake_objects_pass(configs, bake_pass, samples=0, max_samples=0, denoise=None, normal_samples=1):
+# Node properties that only affect the node editor UI, not the shading result.
+_NODE_UI_PROPS = frozenset((
+    'location', 'width', 'width_hidden', 'height', 'dimensions', 'select',
+    'show_options', 'show_preview', 'show_texture', 'hide', 'use_custom_color', 'color',
+))
+
+def _plain(value):
+    if value is None or isinstance(value, (str, int, float, bool, bytes)):
+        return value
+
+    if isinstance(value, bpy.types.ID):
+        return f'{type(value).__name__}:{value.name}'
+
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+
+    try:
+        return tuple(_plain(x) for x in value)
+    except TypeError:
+        return repr(value)
+
+def _hash_value(h, *values):
+    for v in values:
+        h.update(repr(_plain(v)).encode())
+        h.update(b'\0')
+
+def _hash_rna(h, struct, skip=frozenset()):
+    for prop in struct.bl_rna.properties:
+        ident = prop.identifier
+
+        if ident == 'rna_type' or ident in skip or prop.type == 'COLLECTION':
+            continue
+
+        try:
+            value = getattr(struct, ident)
+        except AttributeError:
+            continue
+
+        if prop.type == 'POINTER' and not isinstance(value, bpy.types.ID):
+            continue
+
+        _hash_value(h, ident, value)
+
+def _hash_array(h, collection, attr, dtype, components=1):
+    arr = numpy.empty(len(collection) * components, dtype=dtype)
+    collection.foreach_get(attr, arr)
+    h.update(arr.tobytes())
+
+_file_digests = {}
+
+def _file_digest(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return b'missing'
+
+    key = (path, st.st_mtime_ns, st.st_size)
+
+    try:
+        return _file_digests[key]
+    except KeyError:
+        pass
+
+    h = hashlib.blake2b()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    d = _file_digests[key] = h.digest()
+    return d
+
+def _hash_image(h, img):
+    _hash_value(h, img.name, img.source, img.colorspace_settings.name, img.alpha_mode)
+
+    if img.packed_file is not None:
+        h.update(hashlib.blake2b(img.packed_file.data).digest())
+    elif img.source in ('FILE', 'SEQUENCE', 'TILED'):
+        h.update(_file_digest(bpy.path.abspath(img.filepath, library=img.library)))
+    elif img.source == 'GENERATED':
+        _hash_value(h, img.generated_type, img.generated_color,
+                    img.generated_width, img.generated_height, img.use_generated_float)
+
+def _node_tree_digest(tree, memo):
+    # Not keyed by name: the embedded node trees of materials are all "Shader Nodetree"
+    key = ('node_tree', tree.as_pointer())
+
+    try:
+        return memo[key]
+    except KeyError:
+        pass
+
+    h = hashlib.blake2b()
+
+    for node in sorted(tree.nodes, key=lambda n: n.name):
+        _hash_value(h, node.bl_idname, node.name)
+        _hash_rna(h, node, _NODE_UI_PROPS)
+
+        for sock in itertools.chain(node.inputs, node.outputs):
+            _hash_value(h, sock.identifier, getattr(sock, 'default_value', None))
+
+        subtree = getattr(node, 'node_tree', None)
+        if subtree is not None:
+            h.update(_node_tree_digest(subtree, memo))
+
+        img = getattr(node, 'image', None)
+        if img is not None:
+            _hash_image(h, img)
+
+    links = sorted(
+        (l.from_node.name, l.from_socket.identifier, l.to_node.name, l.to_socket.identifier)
+        for l in tree.links if not l.is_muted
+    )
+    _hash_value(h, links)
+
+    d = memo[key] = h.digest()
+    return d
+
+def _material_digest(mat, memo):
+    h = hashlib.blake2b()
+
+    if mat is None:
+        return h.digest()
+
+    _hash_rna(h, mat)
+
+    if mat.use_nodes and mat.node_tree:
+        h.update(_node_tree_digest(mat.node_tree, memo))
+
+    return h.digest()
+
+def _hash_mesh(h, obj, depsgraph):
+    eval_obj = obj.evaluated_get(depsgraph)
+    mesh = eval_obj.to_mesh()
+
+    try:
+        _hash_array(h, mesh.vertices, 'co', numpy.float32, 3)
+        _hash_array(h, mesh.loops, 'vertex_index', numpy.int32)
+        _hash_array(h, mesh.polygons, 'loop_start', numpy.int32)
+        _hash_array(h, mesh.polygons, 'material_index', numpy.int32)
+        _hash_array(h, mesh.polygons, 'use_smooth', bool)
+
+        for uv_layer in mesh.uv_layers:
+            _hash_value(h, uv_layer.name, uv_layer.active, uv_layer.active_render)
+            _hash_array(h, uv_layer.data, 'uv', numpy.float32, 2)
+    finally:
+        eval_obj.to_mesh_clear()
+
+def _object_digest(obj, depsgraph, memo):
+    key = ('object', obj.name)
+
+    try:
+        return memo[key]
+    except KeyError:
+        pass
+
+    h = hashlib.blake2b()
+    _hash_value(h, obj.name, obj.type, obj.matrix_world)
+
+    if obj.type == 'MESH':
+        _hash_mesh(h, obj, depsgraph)
+
+        for slot in obj.material_slots:
+            h.update(_material_digest(slot.material, memo))
+    elif obj.type == 'LIGHT':
+        _hash_rna(h, obj.data)
+
+    d = memo[key] = h.digest()
+    return d
+
+def _scene_digest(depsgraph, memo):
+    key = ('scene',)
+
+    try:
+        return memo[key]
+    except KeyError:
+        pass
+
+    scene = bpy.context.scene
+    h = hashlib.blake2b()
+
+    for obj in sorted(scene.objects, key=lambda o: o.name):
+        if obj.type in ('MESH', 'LIGHT') and obj.visible_get() and not obj.hide_render:
+            h.update(_object_digest(obj, depsgraph, memo))
+
+    if scene.world is not None:
+        h.update(_material_digest(scene.world, memo))
+
+    d = memo[key] = h.digest()
+    return d
+
+def selection_digest():
+    '''
+    Fingerprint the selected objects, i.e. what export_obj would export.
+    '''
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    memo = {}
+
+    h = hashlib.blake2b(digest_size=20)
+    _hash_value(h, 'taisei-iqm-v1', bpy.app.version_string, bpy.app.build_hash)
+
+    for obj in sorted(bpy.context.selected_objects, key=lambda o: o.name):
+        h.update(_object_digest(obj, depsgraph, memo))
+
+    return h.hexdigest()
+
+def bake_cache_key(cfg, bake_pass, settings, memo):
+    '''
+    Compute a fingerprint of everything that affects the result of baking `bake_pass`
+    for texture set `cfg`: object meshes, UVs and materials, the bake settings, and
+    the Blender version. Passes that depend on the scene lighting also include the
+    rest of the visible scene.
+
+    `memo` caches intermediate digests; it must not outlive a single bake pass,
+    since the pass `prepare` functions mutate materials.
+    '''
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    scene = bpy.context.scene
+
+    h = hashlib.blake2b(digest_size=20)
+    _hash_value(h, 'taisei-bake-v1', bpy.app.version_string, bpy.app.build_hash)
+    _hash_rna(h, scene.cycles)
+    _hash_rna(h, scene.render.bake)
+    _hash_value(h, sorted(settings.items()))
+
+    for obj in sorted(cfg.objects, key=lambda o: o.name):
+        h.update(_object_digest(obj, depsgraph, memo))
+
+    if bake_pass.scene_dependent:
+        h.update(_scene_digest(depsgraph, memo))
+
+    return h.hexdigest()
+
+@dataclasses.dataclass(eq=False)
+class BakeJob:
+    cfg: BakeConfig
+    size: tuple[int, int]
+    margin: int
+    tile_size: tuple[int, int] = None
+    out_file: str = None
+    cache_key: str = None
+    dilate: float = 0
+    out_size: tuple[int, int] = None
+    samples: int = 0
+    adaptive: bool = False
+    cycles_denoise: bool = False
+
+    @property
+    def materials(self):
+        return {mat for obj in self.cfg.objects for mat in obj.data.materials}
+
+def group_bake_jobs(jobs):
+    '''
+    Group bake jobs that can be baked with a single bake call: jobs with the same margin,
+    samples and denoising whose texture sets share no objects or materials (every
+    material can only have one active image node to bake into).
+    '''
+
+    groups = []
+
+    for job in jobs:
+        objects = set(job.cfg.objects)
+        mats = job.materials
+        settings = (job.margin, job.samples, job.cycles_denoise)
+
+        for group in groups:
+            if (group['settings'] == settings and
+                    not objects & group['objects'] and not mats & group['materials']):
+                break
+        else:
+            group = {'settings': settings, 'objects': set(), 'materials': set(), 'jobs': []}
+            groups.append(group)
+
+        group['objects'] |= objects
+        group['materials'] |= mats
+        group['jobs'].append(job)
+
+    return [g['jobs'] for g in groups]
+
+def bake_objects_pass(configs, bake_pass, samples=0, max_samples=0, denoise=None, normal_samples=1,
+                      cache=None, noise_threshold=0, adaptive_min_samples=16,
+                      budget_dir=ADAPTIVE_BUDGET_DIR, batch=True, image_pool=None):
     tsets_str = ', '.join(c.output_name for c in configs)
     print(f"Preparing to bake {bake_pass.name} pass for texture sets: {tsets_str}")
 
@@ -366,98 +1227,741 @@ def bake_objects_pass(configs, bake_pass, samples=0, max_samples=0, denoise=None
     samples = min(samples, max_samples)
     assert samples > 0
 
-    print(f'\n[{bake_pass.name}] Baking {bake_pass.blender_name}, {samples} samples, '
+    if denoise is None:
+        use_denoise = bpy.context.scene.cycles.use_denoising
+    else:
+        use_denoise = bool(denoise)
+
+    if not bake_pass.is_denoise_sensible:
+        use_denoise = False
+
+    # Adaptive sampling only makes sense if there is some room between the bounds
+    adaptive = noise_threshold > 0 and samples > adaptive_min_samples
+
+    print(f'\n[{bake_pass.name}] Baking {bake_pass.blender_name}, '
+          f'{f"up to {samples}" if adaptive else samples} samples, '
           f'colorspace: {bake_pass.colorspace}, pass filter: {bake_pass.blender_pass_filter}')
 
     t_begin = datetime.datetime.now()
+    cache_memo = {}
+    num_cached = 0
+    num_current = 0
+    manifest = get_export_manifest()
+    jobs = []
 
     for cfg in cfgs:
-        t_obj_begin = datetime.datetime.now()
+        sz = cfg.size.get_value(bake_pass)
+        margin = cfg.margin.get_value(bake_pass)
 
-        for obj in cfg.objects:
-            print(f'[{bake_pass.name}] Select object `{obj.name}`')
-            obj.select_set(True)
+        if manifest is not None and not manifest.wanted(
+                bake_output_filepath(cfg.output_name, bake_pass)):
+            print(f'[{bake_pass.name}] `{cfg.output_name}` skipped: not requested')
+            continue
 
-        sz = cfg.size.get_value(bake_pass)
-        img = create_bake_output_image(cfg.output_name, bake_pass, sz, alpha=cfg.alpha)
+        tile_size = cfg.tile_size.get_value(bake_pass)
+        dilate = cfg.dilate.get_value(bake_pass)
+        out_size = bake_output_size(sz, cfg.scale.get_value(bake_pass))
+
+        if tile_size[0] <= 0 or (tile_size[0] >= sz[0] and tile_size[1] >= sz[1]):
+            tile_size = None
+
+        # Tiles are streamed straight into the output file, there is no whole image to postprocess
+        if tile_size is not None and (dilate > margin or out_size != sz):
+            raise BakeError(f'`{cfg.output_name}`: tiled bakes do not support dilate or scale '
+                            f'(pass {bake_pass.name})')
+
+        # Texture sets denoised by denoise_bakes are baked noisy into a separate file
+        out_file = bake_job_filepath(cfg, bake_pass)
+        post_denoise = out_file != bake_output_filepath(cfg.output_name, bake_pass)
+        job_samples = min(cfg.samples.get_value(bake_pass) or samples, max_samples)
+        job_adaptive = noise_threshold > 0 and job_samples > adaptive_min_samples
+        cycles_denoise = use_denoise and not post_denoise
+
+        cache_key = None
+
+        if cache is not None or manifest is not None:
+            cache_key = bake_cache_key(cfg, bake_pass, {
+                'pass': bake_pass.name,
+                'type': bake_pass.blender_name,
+                'pass_filter': bake_pass.blender_pass_filter,
+                'colorspace': bake_pass.colorspace,
+                'size': sz,
+                'margin': margin,
+                'samples': job_samples,
+                'denoise': cycles_denoise,
+                'alpha': cfg.alpha and bake_pass.may_have_alpha,
+                'tile_size': cfg.tile_size.get_value(bake_pass),
+                'noise_threshold': noise_threshold if job_adaptive else 0,
+                # Adaptive bakes start from the budget of the previous run (see bake_adaptive)
+                'adaptive_budget': load_adaptive_budget(adaptive_budget_path(
+                    cfg.output_name, bake_pass, budget_dir)) if job_adaptive else 0,
+                'dilate': dilate,
+                'scale': cfg.scale.get_value(bake_pass),
+                'resample_filter': bake_pass.resample_filter,
+            }, cache_memo)
+
+        if manifest is not None and manifest.is_current(out_file, cache_key):
+            num_current += 1
+            print(f'[{bake_pass.name}] `{cfg.output_name}` is up to date')
+            continue
 
-        print(
-            f'[{bake_pass.name}] Baking `{cfg.output_name}` to '
-            f'`{img.filepath_raw}`, {sz[0]}x{sz[1]}')
+        if cache is not None:
+            out_path = bpy.path.abspath(out_file)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
 
-        junknodes = set()
+            if cache.fetch(cache_key, out_path):
+                num_cached += 1
+                print(f'[{bake_pass.name}] `{cfg.output_name}` restored from bake cache '
+                      f'({cache_key[:12]})')
 
-        mset = set()
-        for obj in cfg.objects:
-            for mat in obj.data.materials:
-                mset.add(mat)
+                if manifest is not None:
+                    manifest.update(out_file, cache_key)
 
-        for mat in mset:
-            node = mat.node_tree.nodes.new(type='ShaderNodeTexImage')
-            node.image = img
-            mat.node_tree.nodes.active = node
-            junknodes.add((mat.node_tree.nodes, node))
+                continue
 
-        bake_args = {
+        jobs.append(BakeJob(cfg, sz, margin, tile_size, out_file, cache_key, dilate, out_size,
+                            job_samples, job_adaptive, cycles_denoise))
+
+    def bake_args(margin):
+        args = {
             'normal_space': 'TANGENT',
             'type': bake_pass.blender_name,
-            'margin': cfg.margin.get_value(bake_pass),
+            'margin': margin,
         }
 
         if bake_pass.blender_pass_filter is not None:
-            bake_args['pass_filter'] = bake_pass.blender_pass_filter
+            args['pass_filter'] = bake_pass.blender_pass_filter
+
+        return args
+
+    def postprocess(job, srgb):
+        dilate = None
+
+        if job.dilate > job.margin:
+            dilate = bake_coverage_mask(job.cfg, job.size), job.margin, job.dilate
+
+        if dilate is None and job.out_size == job.size:
+            return None
 
-        prev_denoise = bpy.context.scene.cycles.use_denoising
+        return functools.partial(postprocess_bake, bake_pass=bake_pass,
+                                 dilate=dilate, out_size=job.out_size, srgb=srgb)
 
-        if denoise is not None:
-            bpy.context.scene.cycles.use_denoising = bool(denoise)
+    def size_str(job):
+        s = f'{job.size[0]}x{job.size[1]}'
 
-        if not bake_pass.is_denoise_sensible:
-            bpy.context.scene.cycles.use_denoising = False
+        if job.out_size != job.size:
+            s += f' (output {job.out_size[0]}x{job.out_size[1]})'
 
-        with cycles_samples(samples):
-            bpy.ops.object.bake(**bake_args)
+        if job.samples != samples:
+            s += f', {job.samples} samples'
 
+        return s
+
+    def store(job, out_path):
+        if cache is not None:
+            cache.store(job.cache_key, out_path)
+
+        if manifest is not None:
+            manifest.update(job.out_file, job.cache_key)
+
+    def finish(t_obj_begin, mem_str):
+        t_obj_end = datetime.datetime.now()
+        print(f'[{bake_pass.name}] Object bake finished in {str(t_obj_end - t_obj_begin)}, '
+              f'{mem_str}')
+
+    if image_pool is None:
+        pass_image_pool = image_pool = BakeImagePool()
+    else:
+        pass_image_pool = None
+
+    # Plain bakes are written out in the background, while the next one is baking
+    writer = BakeOutputWriter()
+    t_write_wait = datetime.timedelta()
+
+    prev_denoise = bpy.context.scene.cycles.use_denoising
+
+    try:
+        # Plain bakes of several texture sets share a single bake call (and scene sync)
+        plain = [job for job in jobs if job.tile_size is None and not job.adaptive]
+
+        if batch:
+            batches = group_bake_jobs(plain)
+        else:
+            batches = [[job] for job in plain]
+
+        for jobs_batch in batches:
+            t_obj_begin = datetime.datetime.now()
+            images = []
+            readback_bytes = 0
+
+            with contextlib.ExitStack() as stack:
+                for job in jobs_batch:
+                    img = image_pool.acquire(
+                        job.cfg.output_name, bake_pass, job.size, alpha=job.cfg.alpha)
+                    stack.callback(image_pool.release, img)
+                    images.append(img)
+
+                    print(
+                        f'[{bake_pass.name}] Baking `{job.cfg.output_name}` to '
+                        f'`{img.filepath_raw}`, {size_str(job)}')
+
+                    for obj in job.cfg.objects:
+                        print(f'[{bake_pass.name}] Select object `{obj.name}`')
+                        obj.select_set(True)
+
+                    stack.enter_context(bake_target_image(job.cfg, img))
+
+                if len(jobs_batch) > 1:
+                    print(f'[{bake_pass.name}] Baking {len(jobs_batch)} texture sets at once')
+
+                bpy.context.scene.cycles.use_denoising = jobs_batch[0].cycles_denoise
+
+                with cycles_samples(jobs_batch[0].samples):
+                    # Pooled images still hold the previous bake, regardless of the scene's settings
+                    bpy.ops.object.bake(use_clear=True, **bake_args(jobs_batch[0].margin))
+
+                for job, img in zip(jobs_batch, images):
+                    channels = 4 if job.cfg.alpha and bake_pass.may_have_alpha else 3
+                    readback_bytes += writer.submit(
+                        img, bpy.path.abspath(job.out_file), channels,
+                        done=lambda out_path, job=job: store(job, out_path),
+                        postprocess=postprocess(job, srgb=bake_pass.colorspace == 'sRGB'))
+
+            batch_str = f' (batch of {len(jobs_batch)})' if len(jobs_batch) > 1 else ''
+            bake_bytes = sum(_bake_buffer_bytes(*job.size) for job in jobs_batch)
+
+            for job in jobs_batch:
+                for obj in job.cfg.objects:
+                    obj.select_set(False)
+
+            finish(t_obj_begin, f'bake buffers {_mib(bake_bytes)} MiB, '
+                   f'readback {_mib(readback_bytes)} MiB{batch_str}')
+
+        for job in jobs:
+            if job in plain:
+                continue
+
+            t_obj_begin = datetime.datetime.now()
+            cfg, sz = job.cfg, job.size
+            out_path = bpy.path.abspath(job.out_file)
+
+            for obj in cfg.objects:
+                print(f'[{bake_pass.name}] Select object `{obj.name}`')
+                obj.select_set(True)
+
+            bpy.context.scene.cycles.use_denoising = job.cycles_denoise
+
+            with cycles_samples(job.samples):
+                if job.tile_size is None:
+                    budget_path = adaptive_budget_path(cfg.output_name, bake_pass, budget_dir)
+
+                    print(
+                        f'[{bake_pass.name}] Baking `{cfg.output_name}` to '
+                        f'`{out_path}`, {size_str(job)}, adaptive sampling')
+
+                    used_samples, noise = bake_adaptive(
+                        cfg, bake_pass, sz, bake_args(job.margin), out_path,
+                        max_samples=job.samples,
+                        noise_threshold=noise_threshold,
+                        min_samples=adaptive_min_samples,
+                        budget_path=budget_path,
+                        postprocess=postprocess(job, srgb=False))
+
+                    # Float bake result, float image, running average and readback buffer
+                    mem_str = (f'{used_samples}/{job.samples} samples, noise {noise:.5f}, '
+                               f'bake buffers {_mib(sz[0] * sz[1] * 16 * 4)} MiB')
+                else:
+                    print(
+                        f'[{bake_pass.name}] Baking `{cfg.output_name}` to '
+                        f'`{out_path}`, {sz[0]}x{sz[1]} in {job.tile_size[0]}x{job.tile_size[1]} tiles')
+
+                    mem_str = bake_tiled(cfg, bake_pass, sz, job.tile_size, bake_args(job.margin), out_path)
+
+            for obj in cfg.objects:
+                obj.select_set(False)
+
+            store(job, out_path)
+            finish(t_obj_begin, mem_str)
+
+        t_wait_begin = datetime.datetime.now()
+        writer.join()
+        t_write_wait = datetime.datetime.now() - t_wait_begin
+    finally:
         bpy.context.scene.cycles.use_denoising = prev_denoise
+        writer.close()
 
-        img.save()
+        if pass_image_pool is not None:
+            pass_image_pool.clear()
+
+    t_end = datetime.datetime.now()
+
+    if cache is not None or manifest is not None:
+        cache_str = f' ({num_current} up to date, {num_cached} cached)'
+    else:
+        cache_str = ''
+
+    print(f'[{bake_pass.name}] Bake pass finished in {str(t_end - t_begin)}{cache_str}, '
+          f'waited {str(t_write_wait)} for output writes, peak RSS {_peak_rss_mib()} MiB')
+
+def _bake_worker_main():
+    '''
+    Entry point of a bake worker spawned by bake_objects_sharded.
+    Bakes a single (texture set, pass) job described by a JSON file.
+    '''
+
+    job_path, result_path = sys.argv[sys.argv.index('--') + 1:][:2]
+
+    with open(job_path) as f:
+        job = json.load(f)
+
+    bake_pass = bake_passes[job['pass']]
+    cfg = BakeConfig(
+        job['objects'],
+        size=job['size'],
+        margin=job['margin'],
+        tile_size=job['tile_size'],
+        dilate=job['dilate'],
+        scale=job['scale'],
+        samples=job['texture_set_samples'],
+        denoise=job['denoise'],
+        alpha=job['alpha'],
+        output_name=job['output_name'],
+    )
+
+    if job['cache_path'] is not None:
+        cache = BakeCache(job['cache_path'], job['cache_max_size'])
+    else:
+        cache = None
+
+    bake_objects_pass(
+        configs=[cfg],
+        bake_pass=bake_pass,
+        samples=job['samples'],
+        max_samples=job['max_samples'],
+        denoise=job['cycles_denoise'],
+        normal_samples=job['normal_samples'],
+        cache=cache,
+        noise_threshold=job['noise_threshold'],
+        adaptive_min_samples=job['adaptive_min_samples'],
+        budget_dir=job['budget_dir'],
+        batch=job['batch'])
+
+    output = bpy.path.abspath(bake_job_filepath(cfg, bake_pass))
+
+    with open(result_path, 'w') as f:
+        json.dump({
+            'output': output if os.path.isfile(output) else None,
+            'cache_hits': cache.hits if cache is not None else 0,
+        }, f)
+
+def bake_objects_sharded(configs, passes, samples=0, max_samples=0, denoise=None,
+                         normal_samples=1, cache=None, noise_threshold=0,
+                         adaptive_min_samples=16, batch=True, workers=2, threads=None):
+    '''
+    Bake every (texture set, pass) combination in its own headless Blender process.
+
+    The current state of the scene is saved into a read-only temporary copy of the
+    .blend file, which the workers open independently. Since every worker runs a single
+    pass, the material changes done by the pass `prepare` functions stay isolated.
+
+    At most `workers` Blender instances run at the same time, sharing a total budget
+    of `threads` render threads (all CPUs by default).
+    '''
+
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    threads_per_worker = max(1, threads // workers)
+
+    jobs = []
+    manifest = get_export_manifest()
+
+    for bpass in passes:
+        for cfg in configs:
+            if bpass in cfg.exclude_passes or not cfg.objects:
+                print(f'[{bpass.name}] Texture set `{cfg.output_name}` skipped')
+                continue
+
+            if manifest is not None and not manifest.wanted(
+                    bake_output_filepath(cfg.output_name, bpass)):
+                print(f'[{bpass.name}] Texture set `{cfg.output_name}` skipped: not requested')
+                continue
+
+            jobs.append((cfg, bpass))
+
+    # Longest jobs first, so that the big bakes don't end up running last
+    def job_cost(job):
+        cfg, bpass = job
+        w, h = cfg.size.get_value(bpass)
+        return w * h * (cfg.samples.get_value(bpass) or bpass.samples or bpy.context.scene.cycles.samples)
+
+    jobs.sort(key=job_cost, reverse=True)
+
+    print(f'Baking {len(jobs)} jobs with {workers} workers, {threads_per_worker} threads each')
+
+    t_begin = datetime.datetime.now()
+
+    # Workers run in a copy of the .blend saved elsewhere, so resolve this here
+    budget_dir = bpy.path.abspath(ADAPTIVE_BUDGET_DIR)
+
+    with tempfile.TemporaryDirectory(prefix='taisei-bake-') as tmpdir:
+        blend_copy = os.path.join(tmpdir, 'scene.blend')
+        bpy.ops.wm.save_as_mainfile(filepath=blend_copy, copy=True)
+        os.chmod(blend_copy, 0o444)
+
+        def run_job(job_id, cfg, bpass):
+            job_path = os.path.join(tmpdir, f'job{job_id}.json')
+            result_path = os.path.join(tmpdir, f'job{job_id}.result.json')
+            log_path = os.path.join(tmpdir, f'job{job_id}.log')
+
+            with open(job_path, 'w') as f:
+                json.dump({
+                    'objects': [o.name for o in cfg.objects],
+                    'output_name': cfg.output_name,
+                    'pass': bpass.name,
+                    'size': cfg.size.get_value(bpass),
+                    'margin': cfg.margin.get_value(bpass),
+                    'tile_size': cfg.tile_size.get_value(bpass),
+                    'dilate': cfg.dilate.get_value(bpass),
+                    'scale': cfg.scale.get_value(bpass),
+                    'texture_set_samples': cfg.samples.get_value(bpass),
+                    'denoise': cfg.denoise.get_value(bpass),
+                    'alpha': cfg.alpha,
+                    'samples': samples,
+                    'max_samples': max_samples,
+                    'cycles_denoise': denoise,
+                    'normal_samples': normal_samples,
+                    'noise_threshold': noise_threshold,
+                    'adaptive_min_samples': adaptive_min_samples,
+                    'budget_dir': budget_dir,
+                    'batch': batch,
+                    'cache_path': str(cache.path) if cache is not None else None,
+                    'cache_max_size': cache.max_size if cache is not None else 0,
+                }, f)
+
+            expr = (
+                'import sys; '
+                f'sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); '
+                'import export_utils; '
+                'export_utils._bake_worker_main()'
+            )
+
+            cmd = [
+                bpy.app.binary_path,
+                '--background', blend_copy,
+                '--threads', str(threads_per_worker),
+                '--python-exit-code', '1',
+                '--python-expr', expr,
+                '--', job_path, result_path,
+            ]
+
+            t_job_begin = datetime.datetime.now()
+            print(f'[{bpass.name}] Baking `{cfg.output_name}` in worker {job_id}')
+
+            # Up to date outputs are skipped through the bake cache instead;
+            # the manifest is relative to the original .blend, not the copy.
+            env = dict(os.environ)
+            env.pop('TAISEI_EXPORT_MANIFEST', None)
+            env.pop('TAISEI_EXPORT_ONLY', None)
+
+            with open(log_path, 'w') as log:
+                ret = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+
+            if ret != 0:
+                with open(log_path) as log:
+                    tail = ''.join(log.readlines()[-30:])
+                raise BakeError(
+                    f'Worker {job_id} failed baking {bpass.name} pass '
+                    f'for `{cfg.output_name}` (exit code {ret}):\n{tail}')
+
+            with open(result_path) as f:
+                result = json.load(f)
+
+            t_job_end = datetime.datetime.now()
+
+            if result['output'] is None:
+                print(f'[{bpass.name}] Texture set `{cfg.output_name}` produced no output')
+            else:
+                dst = bpy.path.abspath(bake_job_filepath(cfg, bpass))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.move(result['output'], dst)
+                print(f'[{bpass.name}] `{cfg.output_name}` finished in '
+                      f'{str(t_job_end - t_job_begin)}')
+
+            return result
+
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(run_job, i, *job) for i, job in enumerate(jobs)]
+            results = [f.result() for f in futures]
+
+    t_end = datetime.datetime.now()
+
+    if cache is not None:
+        hits = sum(r['cache_hits'] for r in results)
+        print(f'Bake cache: {hits} hits, {len(results) - hits} misses')
+
+    print(f'All bake jobs finished in {str(t_end - t_begin)}')
+
+def read_bake_output(path):
+    '''
+    Load a baked 8-bit PNG as an RGBA uint8 array, bottom-up like Blender images.
+    '''
+
+    img = bpy.data.images.load(path, check_existing=False)
+
+    try:
+        w, h = img.size
+        pixels = numpy.empty(w * h * 4, dtype=numpy.float32)
+        img.pixels.foreach_get(pixels)
+    finally:
         bpy.data.images.remove(img)
 
-        for nodeset, node in junknodes:
-            nodeset.remove(node)
+    return bake_image.quantize(pixels.reshape(h, w, 4))
 
-        for obj in cfg.objects:
-            obj.select_set(False)
+# Bakes of the same texture set used to guide the denoiser, if they exist
+DENOISE_GUIDES = ('diffuse', 'normal')
 
-        t_obj_end = datetime.datetime.now()
-        print(f'[{bake_pass.name}] Object bake finished in {str(t_obj_end - t_obj_begin)}')
+def denoise_bakes(configs, passes, cache=None, workers=None, denoiser=None):
+    '''
+    Denoise the raw bakes of every texture set that has `denoise` enabled for a pass,
+    with the diffuse and normal bakes of the texture set as guides. The work is done by
+    bake_denoise in a separate Python process, with a pool of `workers` processes
+    (default: one per CPU). `denoiser` is 'oidn' or
+    'numpy' (default: see bake_denoise.denoiser_from_environment).
+
+    This runs after all passes are baked, so that the guides are available. Results
+    are cached and recorded in the export manifest like bakes, keyed by the contents
+    of the raw bake and the guides.
+    '''
+
+    if denoiser is None:
+        denoiser = bake_denoise.denoiser_from_environment()
+
+    manifest = get_export_manifest()
+    entries = []
+
+    for bpass in passes:
+        for cfg in configs:
+            if (bpass in cfg.exclude_passes or not cfg.objects or
+                    bake_job_filepath(cfg, bpass) == bake_output_filepath(cfg.output_name, bpass)):
+                continue
+
+            out_file = bake_output_filepath(cfg.output_name, bpass)
+
+            if manifest is not None and not manifest.wanted(out_file):
+                continue
+
+            raw_path = bpy.path.abspath(bake_raw_filepath(cfg.output_name, bpass))
+
+            if not os.path.isfile(raw_path):
+                print(f'[{bpass.name}] `{cfg.output_name}` not denoised: no raw bake')
+                continue
+
+            guides = {}
+
+            for name in DENOISE_GUIDES:
+                path = bpy.path.abspath(bake_output_filepath(cfg.output_name, bake_passes[name]))
+
+                if bake_passes[name] not in cfg.exclude_passes and os.path.isfile(path):
+                    guides[name] = path
+
+            h = hashlib.blake2b(digest_size=20)
+            _hash_value(h, 'taisei-denoise-v1', bpass.name, bpass.colorspace, denoiser, sorted(guides))
+            h.update(_file_digest(raw_path))
+
+            for name, path in sorted(guides.items()):
+                h.update(_file_digest(path))
+
+            entries.append((cfg, bpass, out_file, guides, h.hexdigest()))
+
+    pending = []
+
+    for cfg, bpass, out_file, guides, key in entries:
+        out_path = bpy.path.abspath(out_file)
+
+        if manifest is not None and manifest.is_current(out_file, key):
+            print(f'[{bpass.name}] `{cfg.output_name}` denoised result is up to date')
+            continue
+
+        if cache is not None and cache.fetch(key, out_path):
+            print(f'[{bpass.name}] `{cfg.output_name}` denoised result restored from bake cache '
+                  f'({key[:12]})')
+
+            if manifest is not None:
+                manifest.update(out_file, key)
+
+            continue
+
+        pending.append((cfg, bpass, out_file, guides, key))
+
+    if not pending:
+        return
+
+    print(f'Denoising {len(pending)} bakes with {denoiser}')
+    t_begin = datetime.datetime.now()
+
+    with tempfile.TemporaryDirectory(prefix='taisei-denoise-') as tmpdir:
+        jobs = []
+
+        def save_input(name, path):
+            npy = os.path.join(tmpdir, f'{len(jobs)}.{name}.npy')
+            numpy.save(npy, read_bake_output(path))
+            return npy
+
+        for cfg, bpass, out_file, guides, key in pending:
+            raw_path = bpy.path.abspath(bake_raw_filepath(cfg.output_name, bpass))
+            print(f'[{bpass.name}] Denoising `{cfg.output_name}` '
+                  f'(guides: {", ".join(guides) or "none"})')
+
+            jobs.append({
+                'color': save_input('color', raw_path),
+                'albedo': save_input('albedo', guides['diffuse']) if 'diffuse' in guides else None,
+                'normal': save_input('normal', guides['normal']) if 'normal' in guides else None,
+                'out_path': bpy.path.abspath(out_file),
+                'channels': 4 if cfg.alpha and bpass.may_have_alpha else 3,
+                'srgb': bpass.colorspace == 'sRGB',
+                'denoiser': denoiser,
+            })
+
+        jobs_path = os.path.join(tmpdir, 'jobs.json')
+        results_path = os.path.join(tmpdir, 'results.json')
+
+        with open(jobs_path, 'w') as f:
+            json.dump(jobs, f)
+
+        # Forking worker processes from Blender, which runs threads of its own, is not safe.
+        # Its bundled Python interpreter runs them from a fresh process instead.
+        cmd = [sys.executable, bake_denoise.__file__, jobs_path, results_path]
+
+        if workers is not None:
+            cmd += ['--workers', str(workers)]
+
+        ret = subprocess.call(cmd)
+
+        if ret != 0:
+            raise BakeError(f'Denoiser process failed with exit code {ret}')
+
+        with open(results_path) as f:
+            results = json.load(f)
+
+    errors = []
+
+    for (cfg, bpass, out_file, guides, key), error in zip(pending, results):
+        if error is not None:
+            errors.append(f'`{out_file}`: {error}')
+            continue
+
+        if cache is not None:
+            cache.store(key, bpy.path.abspath(out_file))
+
+        if manifest is not None:
+            manifest.update(out_file, key)
 
     t_end = datetime.datetime.now()
-    print(f'[{bake_pass.name}] Bake pass finished in {str(t_end - t_begin)}')
+    print(f'Denoising finished in {str(t_end - t_begin)}')
+
+    if errors:
+        raise BakeError('Failed to denoise bakes:\n' + '\n'.join(errors))
+
+def bake_objects(*configs, passes=None, samples=0, max_samples=0, denoise=None, normal_samples=1,
+                 cache=True, noise_threshold=None, adaptive_min_samples=16, workers=None,
+                 threads=None, batch=None):
+    '''
+    Bake all `passes` for every texture set in `configs`.
+
+    `cache` may be a BakeCache, True to use the cache configured through the
+    environment (see BakeCache.from_environment), or False to always bake.
+
+    If `workers` (default: $TAISEI_BAKE_WORKERS, or 1) is greater than 1, the bake is
+    sharded across multiple Blender processes with bake_objects_sharded, sharing
+    `threads` (default: $TAISEI_BAKE_THREADS, or all CPUs) render threads.
+
+    If `noise_threshold` (default: $TAISEI_BAKE_NOISE_THRESHOLD, or 0) is positive,
+    multi-sample passes are baked with adaptive sampling (see bake_adaptive), using
+    between `adaptive_min_samples` and the usual sample count.
+
+    Unless `batch` (default: $TAISEI_BAKE_BATCH, or on) is false, texture sets that
+    can be baked together (see group_bake_jobs) are baked with a single bake call per
+    pass, so that the scene is only synced once.
+
+    `denoise` turns the Cycles denoiser on or off (default: as set in the scene).
+    Texture sets with `denoise` enabled for a pass are baked without the Cycles
+    denoiser, and denoised after all passes with denoise_bakes instead.
+    '''
+
+    if cache is True:
+        cache = BakeCache.from_environment()
+    elif cache is False:
+        cache = None
+
+    if workers is None:
+        workers = int(os.environ.get('TAISEI_BAKE_WORKERS', 1))
+
+    if threads is None and 'TAISEI_BAKE_THREADS' in os.environ:
+        threads = int(os.environ['TAISEI_BAKE_THREADS'])
+
+    if noise_threshold is None:
+        noise_threshold = float(os.environ.get('TAISEI_BAKE_NOISE_THRESHOLD', 0))
+
+    if batch is None:
+        batch = os.environ.get('TAISEI_BAKE_BATCH', '1').strip().lower() not in ('0', 'off', 'no', 'false')
 
-def bake_objects(*configs, passes=None, samples=0, max_samples=0, normal_samples=1):
     if passes is None:
         passes = tuple(bake_passes.values())
     else:
         passes = [(bake_passes[p] if isinstance(p, str) else p) for p in passes]
 
-    t_begin = datetime.datetime.now()
-
     configs = tuple(
         (cfg if isinstance(cfg, BakeConfig) else BakeConfig(**cfg))
         for cfg in configs
     )
 
-    for bpass in passes:
-        bake_objects_pass(
+    if workers > 1:
+        bake_objects_sharded(
             configs=configs,
-            bake_pass=bpass,
+            passes=passes,
             samples=samples,
             max_samples=max_samples,
-            normal_samples=normal_samples)
+            denoise=denoise,
+            normal_samples=normal_samples,
+            cache=cache,
+            noise_threshold=noise_threshold,
+            adaptive_min_samples=adaptive_min_samples,
+            batch=batch,
+            workers=workers,
+            threads=threads)
+        denoise_bakes(configs, passes, cache)
+        return
+
+    t_begin = datetime.datetime.now()
+
+    # Bake target images are shared by all passes
+    image_pool = BakeImagePool()
+
+    try:
+        for bpass in passes:
+            bake_objects_pass(
+                configs=configs,
+                bake_pass=bpass,
+                samples=samples,
+                max_samples=max_samples,
+                denoise=denoise,
+                normal_samples=normal_samples,
+                cache=cache,
+                noise_threshold=noise_threshold,
+                adaptive_min_samples=adaptive_min_samples,
+                batch=batch,
+                image_pool=image_pool)
+    finally:
+        image_pool.clear()
+
+    denoise_bakes(configs, passes, cache)
 
     t_end = datetime.datetime.now()
 
+    if cache is not None:
+        print(f'Bake cache: {cache.stats_str()}')
+
     print(f'All bake passes finished in {str(t_end - t_begin)}')
 
 def find_node_by_label(node_tree, label):
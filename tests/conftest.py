@@ -0,0 +1,8 @@
+import pathlib
+import sys
+
+# The scripts import each other as top-level modules from their own directories
+root = pathlib.Path(__file__).resolve().parent.parent
+
+for d in ('models/utils', 'gfx/utils', 'gfx/cutscenes', 'gfx/dialog/afens'):
+    sys.path.insert(0, str(root / d))
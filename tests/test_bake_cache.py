@@ -0,0 +1,104 @@
+import os
+import shutil
+
+import pytest
+
+import bake_cache
+from bake_cache import BakeCache
+
+
+def make_entry(cache, key, size, mtime, tmp_path):
+    src = tmp_path / f'{key}.src'
+    src.write_bytes(bytes(size))
+    cache.store(key, src)
+    os.utime(cache.entry_path(key), (mtime, mtime))
+
+
+@pytest.mark.parametrize('s, size', [
+    ('123', 123),
+    ('4k', 4 << 10),
+    (' 1.5M ', 3 << 19),
+    ('2G', 2 << 30),
+    ('1T', 1 << 40),
+])
+def test_parse_size(s, size):
+    assert bake_cache.parse_size(s) == size
+
+
+def test_store_fetch(tmp_path):
+    cache = BakeCache(tmp_path / 'cache')
+    src = tmp_path / 'src.png'
+    src.write_bytes(b'baked')
+
+    assert not cache.fetch('ab' * 20, tmp_path / 'miss.png')
+    assert not (tmp_path / 'miss.png').exists()
+
+    cache.store('ab' * 20, src)
+    assert cache.entry_path('ab' * 20).parent.name == 'ab'
+    assert cache.fetch('ab' * 20, tmp_path / 'hit.png')
+    assert (tmp_path / 'hit.png').read_bytes() == b'baked'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # No temporary files are left behind
+    assert [p.name for p in cache.entry_path('ab' * 20).parent.iterdir()] == [f'{"ab" * 20}.png']
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = BakeCache(tmp_path / 'cache', max_size=1 << 30)
+
+    for i, key in enumerate(('aa1', 'bb2', 'cc3')):
+        make_entry(cache, key, 100, 1000 + i, tmp_path)
+
+    # A hit makes the oldest entry the most recently used one
+    assert cache.fetch('aa1', tmp_path / 'out.png')
+    cache.evict(250)
+
+    assert cache.entry_path('aa1').exists()
+    assert not cache.entry_path('bb2').exists()
+    assert cache.entry_path('cc3').exists()
+    assert (cache.evicted, cache.evicted_bytes) == (1, 100)
+
+
+def test_evict_on_store(tmp_path):
+    cache = BakeCache(tmp_path / 'cache', max_size=150)
+    make_entry(cache, 'aa1', 100, 1000, tmp_path)
+    make_entry(cache, 'bb2', 100, 2000, tmp_path)
+
+    assert not cache.entry_path('aa1').exists()
+    assert cache.entry_path('bb2').exists()
+
+
+def test_fetch_evicted_meanwhile(tmp_path, monkeypatch):
+    cache = BakeCache(tmp_path / 'cache')
+    make_entry(cache, 'aa1', 10, 1000, tmp_path)
+
+    copyfile = shutil.copyfile
+
+    def copy_then_evict(src, dst):
+        copyfile(src, dst)
+        os.unlink(src)
+
+    monkeypatch.setattr(shutil, 'copyfile', copy_then_evict)
+    assert cache.fetch('aa1', tmp_path / 'out.png')
+    assert (tmp_path / 'out.png').stat().st_size == 10
+
+
+@pytest.mark.parametrize('value', ['off', '0', 'no', 'false', ''])
+def test_from_environment_disabled(monkeypatch, value):
+    monkeypatch.setenv('TAISEI_BAKE_CACHE', value)
+    assert BakeCache.from_environment() is None
+
+
+def test_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv('TAISEI_BAKE_CACHE', str(tmp_path))
+    monkeypatch.setenv('TAISEI_BAKE_CACHE_SIZE', '64M')
+    cache = BakeCache.from_environment()
+
+    assert cache.path == tmp_path
+    assert cache.max_size == 64 << 20
+
+
+def test_default_cache_dir(monkeypatch, tmp_path):
+    monkeypatch.delenv('TAISEI_BAKE_CACHE', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert BakeCache.from_environment().path == tmp_path / 'taisei-rawmedia' / 'bake'
@@ -0,0 +1,145 @@
+import json
+import subprocess
+import sys
+
+import numpy
+import PIL.Image
+import pytest
+
+import bake_denoise
+
+
+def noisy(h, w, sigma, seed=0):
+    '''
+    Two flat regions split down the middle, with Gaussian noise.
+    '''
+
+    clean = numpy.zeros((h, w, 3), dtype=numpy.float32)
+    clean[:, :w // 2] = 0.2
+    clean[:, w // 2:] = 0.8
+    rng = numpy.random.default_rng(seed)
+    return clean, clean + rng.normal(0, sigma, clean.shape).astype(numpy.float32)
+
+
+def rms(a, b):
+    return float(numpy.sqrt(numpy.mean(numpy.square(a - b))))
+
+
+def test_pfm_round_trip(tmp_path):
+    img = numpy.random.default_rng(0).random((5, 7, 3), dtype=numpy.float32)
+    bake_denoise.write_pfm(tmp_path / 'img.pfm', img)
+    numpy.testing.assert_array_equal(bake_denoise.read_pfm(tmp_path / 'img.pfm'), img)
+
+
+def test_read_pfm_big_endian(tmp_path):
+    img = numpy.arange(6, dtype=numpy.float32).reshape(2, 3, 1)
+    (tmp_path / 'img.pfm').write_bytes(b'Pf\n3 2\n1.0\n' + img.astype('>f4').tobytes())
+    numpy.testing.assert_array_equal(bake_denoise.read_pfm(tmp_path / 'img.pfm'), img)
+
+
+def test_bilateral_reduces_noise():
+    clean, color = noisy(40, 40, 0.05)
+    out = bake_denoise.denoise_bilateral(color)
+
+    assert out.shape == color.shape
+    assert rms(out, clean) < 0.5 * rms(color, clean)
+
+
+def test_bilateral_keeps_edges():
+    clean, color = noisy(20, 20, 0.01)
+    out = bake_denoise.denoise_bilateral(color)
+
+    # Averaging across the edge would pull these towards 0.5
+    assert numpy.abs(out[:, 9] - 0.2).max() < 0.02
+    assert numpy.abs(out[:, 10] - 0.8).max() < 0.02
+
+
+def test_bilateral_guides():
+    # An edge in the albedo that the noise hides in the color
+    clean = numpy.zeros((20, 20, 3), dtype=numpy.float32)
+    clean[:, 10:] = 0.1
+    albedo = numpy.zeros_like(clean)
+    albedo[:, 10:] = 1
+    color = clean + numpy.random.default_rng(1).normal(0, 0.1, clean.shape).astype(numpy.float32)
+
+    unguided = bake_denoise.denoise_bilateral(color, sigma_color=1.0)
+    guided = bake_denoise.denoise_bilateral(color, albedo, sigma_color=1.0)
+
+    assert rms(guided, clean) < rms(unguided, clean)
+
+
+def test_bilateral_bands():
+    clean, color = noisy(23, 17, 0.05)
+    numpy.testing.assert_allclose(
+        bake_denoise.denoise_bilateral(color, band_rows=4),
+        bake_denoise.denoise_bilateral(color), rtol=1e-6)
+
+
+def test_denoiser_from_environment(monkeypatch):
+    monkeypatch.setenv('TAISEI_BAKE_DENOISER', 'NumPy')
+    assert bake_denoise.denoiser_from_environment() == 'numpy'
+
+    monkeypatch.setenv('TAISEI_BAKE_DENOISER', 'magic')
+    with pytest.raises(ValueError):
+        bake_denoise.denoiser_from_environment()
+
+    monkeypatch.delenv('TAISEI_BAKE_DENOISER')
+    monkeypatch.setenv('OIDN_DENOISE', 'no-such-oidnDenoise')
+    assert bake_denoise.denoiser_from_environment() == 'numpy'
+
+
+def bake(h=16, w=24):
+    '''
+    A noisy 8-bit RGBA bake, bottom-up like Blender images, with a gradient in alpha.
+    '''
+
+    clean, color = noisy(h, w, 0.03)
+    rgba = numpy.empty((h, w, 4), dtype=numpy.uint8)
+    rgba[..., :3] = numpy.rint(numpy.clip(color, 0, 1) * 255)
+    rgba[..., 3] = numpy.arange(h, dtype=numpy.uint8)[:, numpy.newaxis] * 10
+    return rgba
+
+
+@pytest.mark.parametrize('channels', [3, 4])
+def test_denoise_bake(tmp_path, channels):
+    color = bake()
+    out_path = str(tmp_path / 'sub' / 'out.png')
+    # Half-size guides get resampled
+    albedo = bake(8, 12)
+
+    assert bake_denoise.denoise_bake(color, out_path, channels, srgb=True, albedo=albedo) == out_path
+
+    with PIL.Image.open(out_path) as img:
+        assert img.size == (24, 16)
+        out = numpy.asarray(img)
+
+    assert out.shape[2] == channels
+    # Flipped to top-down, alpha kept
+    if channels == 4:
+        numpy.testing.assert_array_equal(out[::-1, :, 3], color[..., 3])
+
+    assert numpy.abs(out[::-1, :, :3].astype(int) - color[..., :3]).mean() < 10
+    assert list((tmp_path / 'sub').iterdir()) == [tmp_path / 'sub' / 'out.png']
+
+
+def test_main(tmp_path):
+    color = tmp_path / 'color.npy'
+    numpy.save(color, bake())
+
+    jobs = [
+        {'color': str(color), 'out_path': str(tmp_path / 'ok.png'), 'channels': 3,
+         'srgb': False, 'albedo': None, 'normal': str(color), 'denoiser': 'numpy'},
+        {'color': str(color), 'out_path': str(tmp_path / 'bad.png'), 'channels': 3,
+         'srgb': False, 'albedo': None, 'normal': None, 'denoiser': 'oidn'},
+    ]
+
+    (tmp_path / 'jobs.json').write_text(json.dumps(jobs))
+
+    results = tmp_path / 'results.json'
+    subprocess.run([
+        sys.executable, bake_denoise.__file__, str(tmp_path / 'jobs.json'), str(results), '--workers', '1',
+    ], check=True, env={'OIDN_DENOISE': 'no-such-oidnDenoise', 'PATH': ''})
+
+    ok, bad = json.loads(results.read_text())
+    assert ok is None and (tmp_path / 'ok.png').is_file()
+    assert bad is not None and not (tmp_path / 'bad.png').exists()
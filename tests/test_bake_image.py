@@ -0,0 +1,360 @@
+import struct
+import zlib
+
+import numpy
+import PIL.Image
+import pytest
+
+import bake_image
+
+
+def read_png(path):
+    '''
+    Minimal PNG decoder for checking write_png independently of PIL, which reads
+    16-bit colour images as 8-bit. Returns the header fields, the filter type of
+    every row, and the pixels as an array of shape (height, width, channels).
+    '''
+
+    data = path.read_bytes()
+    assert data[:8] == bake_image.PNG_SIGNATURE
+
+    pos = 8
+    chunks = []
+
+    while pos < len(data):
+        length, = struct.unpack('>I', data[pos:pos + 4])
+        tag = data[pos + 4:pos + 8]
+        body = data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(tag + body), tag
+        chunks.append((tag, body))
+        pos += 12 + length
+
+    assert chunks[0][0] == b'IHDR' and chunks[-1] == (b'IEND', b'')
+    width, height, bit_depth, color_type, *rest = struct.unpack('>IIBBBBB', chunks[0][1])
+    assert rest == [0, 0, 0]
+
+    channels = {v: k for k, v in bake_image.PNG_COLOR_TYPES.items()}[color_type]
+    bpp = channels * bit_depth // 8
+    stride = width * bpp
+    raw = zlib.decompress(b''.join(body for tag, body in chunks if tag == b'IDAT'))
+    assert len(raw) == height * (stride + 1)
+
+    rows = []
+    filters = []
+    prev = bytearray(stride)
+
+    for y in range(height):
+        ftype = raw[y * (stride + 1)]
+        row = bytearray(raw[y * (stride + 1) + 1:(y + 1) * (stride + 1)])
+
+        for i in range(stride):
+            a = row[i - bpp] if i >= bpp else 0
+            b = prev[i]
+            c = prev[i - bpp] if i >= bpp else 0
+
+            if ftype == 1:
+                row[i] = (row[i] + a) & 0xFF
+            elif ftype == 2:
+                row[i] = (row[i] + b) & 0xFF
+            elif ftype == 3:
+                row[i] = (row[i] + (a + b) // 2) & 0xFF
+            elif ftype == 4:
+                p = a + b - c
+                pred = min((abs(p - a), 0, a), (abs(p - b), 1, b), (abs(p - c), 2, c))[2]
+                row[i] = (row[i] + pred) & 0xFF
+            else:
+                assert ftype == 0, ftype
+
+        rows.append(bytes(row))
+        filters.append(ftype)
+        prev = row
+
+    dtype = numpy.uint8 if bit_depth == 8 else numpy.dtype('>u2')
+    pixels = numpy.frombuffer(b''.join(rows), dtype=dtype).reshape(height, width, channels)
+    return (width, height, bit_depth, channels), filters, pixels
+
+
+def test_quantize():
+    pixels = numpy.array([-0.5, 0, 0.5 / 255, 0.499, 0.5, 1, 2], dtype=numpy.float32)
+
+    q8 = bake_image.quantize(pixels)
+    assert q8.dtype == numpy.uint8
+    assert q8.tolist() == [0, 0, 0, 127, 128, 255, 255]
+
+    q16 = bake_image.quantize(pixels, 16)
+    assert q16.dtype == numpy.uint16
+    assert q16.tolist() == [0, 0, 128, 32702, 32768, 65535, 65535]
+
+
+def test_png_filter_rows():
+    rows = numpy.array([
+        [10, 10, 10, 10, 10, 10],   # flat: Sub
+        [10, 11, 12, 13, 14, 15],   # ramp: Sub
+        [10, 11, 12, 13, 14, 15],   # same as the previous row: Up
+    ], dtype=numpy.uint8)
+
+    out = bake_image._png_filter_rows(rows, numpy.zeros(6, dtype=numpy.uint8), 1)
+
+    assert out[:, 0].tolist() == [1, 1, 2]
+    assert out[0, 1:].tolist() == [10, 0, 0, 0, 0, 0]
+    assert out[1, 1:].tolist() == [10, 1, 1, 1, 1, 1]
+    assert out[2, 1:].tolist() == [0] * 6
+
+
+@pytest.mark.parametrize('channels', [1, 2, 3, 4])
+def test_write_png_8bit(tmp_path, channels):
+    rng = numpy.random.default_rng(channels)
+    w, h = 37, 23
+
+    # Noise and gradients, so that every filter type gets picked
+    img = rng.integers(0, 256, (h, w, channels), dtype=numpy.uint8)
+    img[:8] = (numpy.arange(w)[:, numpy.newaxis] * 7 % 256).astype(numpy.uint8)
+    img[8:12] = img[7]
+
+    path = tmp_path / 'out.png'
+    bands = [img[y:y + 5] for y in range(0, h, 5)]
+    bake_image.write_png(path, w, h, channels, bands)
+
+    header, filters, pixels = read_png(path)
+    assert header == (w, h, 8, channels)
+    assert set(filters) == {0, 1, 2}
+    numpy.testing.assert_array_equal(pixels, img)
+
+    with PIL.Image.open(path) as pil:
+        assert pil.mode == {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[channels]
+        numpy.testing.assert_array_equal(numpy.asarray(pil).reshape(h, w, channels), img)
+
+
+@pytest.mark.parametrize('channels', [1, 4])
+def test_write_png_16bit(tmp_path, channels):
+    rng = numpy.random.default_rng(16)
+    w, h = 19, 11
+    img = rng.integers(0, 1 << 16, (h, w, channels), dtype=numpy.uint16)
+
+    path = tmp_path / 'out.png'
+    bake_image.write_png(path, w, h, channels, [img[:4], img[4:]], bit_depth=16)
+
+    header, filters, pixels = read_png(path)
+    assert header == (w, h, 16, channels)
+    numpy.testing.assert_array_equal(pixels, img)
+
+    if channels == 1:
+        with PIL.Image.open(path) as pil:
+            numpy.testing.assert_array_equal(numpy.asarray(pil.convert('I')), img[..., 0])
+
+
+def test_write_png_2d_bands(tmp_path):
+    img = numpy.arange(12, dtype=numpy.uint8).reshape(3, 4)
+    path = tmp_path / 'out.png'
+    bake_image.write_png(path, 4, 3, 1, [img])
+
+    with PIL.Image.open(path) as pil:
+        numpy.testing.assert_array_equal(numpy.asarray(pil), img)
+
+
+def test_write_png_wrong_height(tmp_path):
+    with pytest.raises(AssertionError):
+        bake_image.write_png(tmp_path / 'out.png', 4, 3, 1, [numpy.zeros((2, 4), dtype=numpy.uint8)])
+
+
+@pytest.mark.parametrize('mean_samples, batch_samples', [(16, 16), (64, 16), (16, 256)])
+def test_estimate_noise(mean_samples, batch_samples):
+    rng = numpy.random.default_rng(mean_samples + batch_samples)
+    sigma = 0.3
+    n = 200000
+
+    truth = rng.uniform(0.2, 0.8, (n, 4))
+    truth[:, 3] = 1
+    mean = truth + rng.normal(0, sigma / numpy.sqrt(mean_samples), truth.shape)
+    batch = truth + rng.normal(0, sigma / numpy.sqrt(batch_samples), truth.shape)
+
+    # Empty texels outside of the UV islands must not dilute the estimate
+    mean[:n // 4] = 0
+    batch[:n // 4] = 0
+
+    noise = bake_image.estimate_noise(mean.ravel(), mean_samples, batch.ravel(), batch_samples)
+    assert noise == pytest.approx(sigma / numpy.sqrt(mean_samples + batch_samples), rel=0.02)
+
+
+def test_estimate_noise_empty():
+    empty = numpy.zeros(4 * 16, dtype=numpy.float32)
+    assert bake_image.estimate_noise(empty, 16, empty, 16) == 0.0
+
+
+def test_estimate_noise_converged():
+    pixels = numpy.tile(numpy.array([0.5, 0.25, 0.125, 1], dtype=numpy.float32), 16)
+    assert bake_image.estimate_noise(pixels, 16, pixels.copy(), 64) == 0.0
+
+
+def brute_force_coverage(triangles, width, height):
+    cy, cx = numpy.mgrid[0:height, 0:width] + 0.5
+    mask = numpy.zeros((height, width), dtype=bool)
+
+    for a, b, c in numpy.asarray(triangles, dtype=numpy.float64):
+        d = [(q[0] - p[0]) * (cy - p[1]) - (q[1] - p[1]) * (cx - p[0]) for p, q in ((a, b), (b, c), (c, a))]
+        mask |= (d[0] >= 0) & (d[1] >= 0) & (d[2] >= 0) | (d[0] <= 0) & (d[1] <= 0) & (d[2] <= 0)
+
+    return mask
+
+
+@pytest.mark.parametrize('chunk_texels', [1, 37, 1 << 22])
+def test_rasterize_coverage(chunk_texels):
+    rng = numpy.random.default_rng(23)
+    # Includes triangles reaching outside of the image, and both windings
+    triangles = rng.uniform(-8, 72, (40, 3, 2))
+
+    mask = bake_image.rasterize_coverage(triangles, 64, 48, chunk_texels)
+    numpy.testing.assert_array_equal(mask, brute_force_coverage(triangles, 64, 48))
+
+
+def test_rasterize_shared_edge():
+    # Two triangles splitting a square along the diagonal through texel centres
+    square = [[(0, 0), (16, 0), (16, 16)], [(0, 0), (16, 16), (0, 16)]]
+    mask = bake_image.rasterize_coverage(square, 20, 20)
+
+    assert mask[:16, :16].all()
+    assert not mask[16:].any() and not mask[:, 16:].any()
+
+
+def test_rasterize_degenerate():
+    triangles = [[(1, 1), (5, 5), (9, 9)], [(3, 3), (3, 3), (3, 3)]]
+    assert not bake_image.rasterize_coverage(triangles, 10, 10).any()
+    assert not bake_image.rasterize_coverage(numpy.zeros((0, 3, 2)), 10, 10).any()
+
+
+def brute_force_edt(seeds):
+    sy, sx = numpy.nonzero(seeds)
+    y, x = numpy.mgrid[0:seeds.shape[0], 0:seeds.shape[1]]
+    d2 = (y[..., numpy.newaxis] - sy) ** 2 + (x[..., numpy.newaxis] - sx) ** 2
+    return d2.min(axis=-1)
+
+
+@pytest.mark.parametrize('shape, density, band_cols', [
+    ((37, 53), 0.02, 1024),
+    ((37, 53), 0.02, 7),
+    ((64, 16), 0.3, 5),
+    ((1, 40), 0.1, 1024),
+    ((40, 1), 0.1, 1),
+    ((50, 50), 0.0004, 16),
+])
+def test_nearest_seed(shape, density, band_cols):
+    rng = numpy.random.default_rng(shape[0] * shape[1])
+    seeds = rng.random(shape) < density
+    seeds.flat[rng.integers(seeds.size)] = True
+
+    dist2, seed_y, seed_x = bake_image.nearest_seed(seeds, band_cols)
+
+    numpy.testing.assert_array_equal(dist2, brute_force_edt(seeds))
+    # Ties may resolve to any of the nearest seeds
+    assert seeds[seed_y, seed_x].all()
+    y, x = numpy.mgrid[0:shape[0], 0:shape[1]]
+    numpy.testing.assert_array_equal((seed_y - y) ** 2 + (seed_x - x) ** 2, dist2)
+
+
+def test_nearest_seed_no_seeds():
+    dist2, seed_y, seed_x = bake_image.nearest_seed(numpy.zeros((4, 5), dtype=bool))
+    assert numpy.isinf(dist2).all()
+
+
+def test_dilate():
+    pixels = numpy.zeros((9, 9, 2), dtype=numpy.float32)
+    coverage = numpy.zeros((9, 9), dtype=bool)
+    coverage[4, 2:4] = True
+    pixels[4, 2] = (1, 2)
+    pixels[4, 3] = (3, 4)
+    # Already filled by the bake margin
+    pixels[4, 4] = (9, 9)
+
+    out = bake_image.dilate(pixels.copy(), coverage, margin=1, distance=3)
+
+    numpy.testing.assert_array_equal(out[4, 4], (9, 9))
+    numpy.testing.assert_array_equal(out[4, 5], (3, 4))
+    numpy.testing.assert_array_equal(out[4, 6], (3, 4))
+    numpy.testing.assert_array_equal(out[4, 0], (1, 2))
+    numpy.testing.assert_array_equal(out[2, 2], (1, 2))
+    numpy.testing.assert_array_equal(out[3, 1], (1, 2))
+    # 1 is within the margin, 4 is beyond the distance
+    numpy.testing.assert_array_equal(out[3, 2], (0, 0))
+    numpy.testing.assert_array_equal(out[4, 7], (0, 0))
+    numpy.testing.assert_array_equal(out[coverage], pixels[coverage])
+
+
+def test_dilate_unbounded():
+    pixels = numpy.zeros((6, 7, 4), dtype=numpy.float32)
+    coverage = numpy.zeros((6, 7), dtype=bool)
+    coverage[0, 0] = True
+    pixels[0, 0] = 1
+
+    assert (bake_image.dilate(pixels, coverage) == 1).all()
+
+
+def test_dilate_nothing_to_do():
+    pixels = numpy.ones((4, 4, 4), dtype=numpy.float32)
+    coverage = numpy.zeros((4, 4), dtype=bool)
+
+    numpy.testing.assert_array_equal(bake_image.dilate(pixels.copy(), coverage), pixels)
+    coverage[0, 0] = True
+    pixels[1:] = 0
+    numpy.testing.assert_array_equal(bake_image.dilate(pixels.copy(), coverage, margin=4, distance=2), pixels)
+
+
+def test_srgb_round_trip():
+    c = numpy.linspace(0, 1, 1001, dtype=numpy.float32)
+    linear = bake_image.srgb_to_linear(c)
+
+    assert linear.dtype == numpy.float32
+    assert bake_image.srgb_to_linear(numpy.float32([0.5]))[0] == pytest.approx(0.214041, abs=1e-6)
+    numpy.testing.assert_allclose(bake_image.linear_to_srgb(linear), c, atol=1e-6)
+    assert bake_image.linear_to_srgb(numpy.float32([-1]))[0] == 0
+
+
+@pytest.mark.parametrize('filter', sorted(bake_image.RESAMPLE_FILTERS))
+@pytest.mark.parametrize('n_in, n_out', [(64, 16), (100, 37), (16, 64), (5, 1), (8, 8)])
+def test_resample_taps(filter, n_in, n_out):
+    idx, weights = bake_image._resample_taps(n_in, n_out, filter)
+
+    assert idx.shape == weights.shape and idx.shape[0] == n_out
+    assert idx.min() >= 0 and idx.max() < n_in
+    numpy.testing.assert_allclose(weights.sum(axis=1), 1, rtol=1e-6)
+
+
+@pytest.mark.parametrize('filter', sorted(bake_image.RESAMPLE_FILTERS))
+def test_resample_constant(filter):
+    pixels = numpy.empty((40, 24, 4), dtype=numpy.float32)
+    pixels[:] = (0.25, 0.5, 0.75, 1)
+
+    for w, h in ((6, 10), (48, 80), (13, 7)):
+        out = bake_image.resample(pixels, w, h, filter)
+        assert out.shape == (h, w, 4)
+        numpy.testing.assert_allclose(out, numpy.broadcast_to(pixels[0, 0], out.shape), rtol=1e-5)
+
+
+def test_resample_box():
+    pixels = numpy.random.default_rng(24).random((8, 12, 3), dtype=numpy.float32)
+    out = bake_image.resample(pixels, 6, 4, 'box')
+
+    numpy.testing.assert_allclose(out, pixels.reshape(4, 2, 6, 2, 3).mean(axis=(1, 3)), rtol=1e-5)
+
+
+def test_resample_taps_interpolate():
+    # Interpolating filters keep the samples when the size doesn't change
+    pixels = numpy.random.default_rng(24).random((9, 7, 2), dtype=numpy.float32)
+
+    for filter in ('catrom', 'lanczos'):
+        idx, weights = bake_image._resample_taps(7, 7, filter)
+        out = (pixels[:, idx] * weights[..., numpy.newaxis]).sum(axis=2)
+        numpy.testing.assert_allclose(out, pixels, atol=1e-6)
+
+
+def test_resample_same_size():
+    pixels = numpy.random.default_rng(24).random((9, 7, 2), dtype=numpy.float32)
+    numpy.testing.assert_array_equal(bake_image.resample(pixels, 7, 9), pixels)
+
+
+@pytest.mark.parametrize('filter', ['box', 'gaussian', 'catrom', 'lanczos'])
+def test_resample_preserves_mean(filter):
+    pixels = numpy.random.default_rng(24).random((96, 128, 1), dtype=numpy.float32)
+    out = bake_image.resample(pixels, 32, 24, filter)
+
+    assert out.mean() == pytest.approx(pixels.mean(), abs=2e-3)
@@ -0,0 +1,169 @@
+import pytest
+
+import build
+from build import Build, BuildError
+
+
+def sh(b, outputs, inputs, script):
+    '''
+    Add a step running `script`, which also records the name of the step in `log`.
+    '''
+
+    return b.command(outputs, inputs, 'sh', '-c', f'echo {outputs[0]} >> log; {script}')
+
+
+def runs(root):
+    log = root / 'log'
+    lines = log.read_text().split() if log.exists() else []
+    log.unlink(missing_ok=True)
+    return lines
+
+
+def chain(root):
+    b = Build(root)
+    sh(b, ['a'], ['src'], 'cat src > a')
+    sh(b, ['b'], ['a'], 'cat a a > b')
+    sh(b, ['c'], [], 'echo c > c')
+    b.install(['b', 'c'], '/')
+    return b
+
+
+def test_incremental(tmp_path):
+    (tmp_path / 'src').write_text('1')
+    chain(tmp_path).run(jobs=2)
+    assert sorted(runs(tmp_path)) == ['a', 'b', 'c']
+    assert (tmp_path / 'b').read_text() == '11'
+
+    # Nothing changed
+    chain(tmp_path).run(jobs=2)
+    assert runs(tmp_path) == []
+
+    # A changed input rebuilds everything downstream of it
+    (tmp_path / 'src').write_text('2')
+    chain(tmp_path).run(jobs=2)
+    assert runs(tmp_path) == ['a', 'b']
+    assert (tmp_path / 'b').read_text() == '22'
+
+    # A missing output is rebuilt
+    (tmp_path / 'c').unlink()
+    chain(tmp_path).run(jobs=2)
+    assert runs(tmp_path) == ['c']
+
+
+def test_touch_without_change(tmp_path):
+    (tmp_path / 'src').write_text('1')
+    chain(tmp_path).run()
+    runs(tmp_path)
+
+    # Same content, new mtime: rehashed, but not rebuilt
+    (tmp_path / 'src').write_text('1')
+    chain(tmp_path).run()
+    assert runs(tmp_path) == []
+
+
+def test_changed_command(tmp_path):
+    (tmp_path / 'src').write_text('1')
+    chain(tmp_path).run()
+    runs(tmp_path)
+
+    b = Build(tmp_path)
+    sh(b, ['a'], ['src'], 'cat src src > a')
+    sh(b, ['b'], ['a'], 'cat a a > b')
+    b.run(['b'])
+    assert runs(tmp_path) == ['a', 'b']
+
+
+def test_targets(tmp_path):
+    (tmp_path / 'src').write_text('1')
+    chain(tmp_path).run(['a'])
+    assert runs(tmp_path) == ['a']
+
+
+def test_dry_run(tmp_path):
+    (tmp_path / 'src').write_text('1')
+    chain(tmp_path).run(dry_run=True)
+    assert runs(tmp_path) == []
+    assert not (tmp_path / 'a').exists()
+
+
+def test_failed_dependencies(tmp_path, capsys):
+    b = Build(tmp_path)
+    sh(b, ['a'], [], 'exit 3')
+    sh(b, ['b'], ['a'], 'cat a > b')
+    sh(b, ['c'], ['b'], 'cat b > c')
+    sh(b, ['d'], [], 'echo d > d')
+
+    with pytest.raises(BuildError, match='3 steps failed'):
+        b.run(['c', 'd'])
+
+    assert sorted(runs(tmp_path)) == ['a', 'd']
+    err = capsys.readouterr()
+    assert 'a: command failed with exit code 3' in err.err
+    assert 'b: skipped due to failed dependencies' in err.out
+    assert 'c: skipped due to failed dependencies' in err.out
+
+
+def test_missing_output(tmp_path):
+    b = Build(tmp_path)
+    sh(b, ['a'], [], 'true')
+
+    with pytest.raises(BuildError, match='1 steps failed'):
+        b.run(['a'])
+
+
+def test_missing_input(tmp_path):
+    b = Build(tmp_path)
+    sh(b, ['a'], ['src'], 'cat src > a')
+
+    with pytest.raises(BuildError):
+        b.run(['a'])
+
+
+def test_cycle(tmp_path):
+    b = Build(tmp_path)
+    sh(b, ['a'], ['b'], 'cat b > a')
+    sh(b, ['b'], ['a'], 'cat a > b')
+
+    with pytest.raises(BuildError, match='2 steps can never run'):
+        b.run(['a'])
+
+
+def test_duplicate_output(tmp_path):
+    b = Build(tmp_path)
+    sh(b, ['a'], [], 'echo > a')
+
+    with pytest.raises(BuildError, match='multiple steps'):
+        sh(b, ['a'], [], 'echo > a')
+
+
+def test_unknown_target(tmp_path):
+    with pytest.raises(BuildError, match='No rule'):
+        Build(tmp_path).run(['nothing'])
+
+
+def test_mkbasis_args(tmp_path, monkeypatch):
+    monkeypatch.setenv('MKBASIS', 'mkbasis-test')
+    monkeypatch.setenv('MKBASIS_ARGS', '--uastc  --mipmaps')
+    step = Build(tmp_path).mkbasis('out.basis', 'in.png', '--normal')
+
+    assert step.command == ['mkbasis-test', 'in.png', '--normal', '--uastc', '--mipmaps', '-o', 'out.basis']
+
+
+def test_blender_pool(tmp_path, monkeypatch):
+    monkeypatch.setenv('BLENDER', 'blender-test')
+    b = Build(tmp_path)
+    step = b.blender('scene.blend', 'export.py', ['a.iqm'])
+
+    assert step.pool == 'blender'
+    assert step.command == ['blender-test', '--background', 'scene.blend', '--python', 'export.py']
+    assert step.env['TAISEI_EXPORT_MANIFEST'] == '.export-manifest.scene.json'
+    assert set(build.blender_support_files) <= set(step.inputs)
+
+
+def test_clean(tmp_path):
+    (tmp_path / 'src').write_text('1')
+    chain(tmp_path).run()
+    chain(tmp_path).do_clean()
+
+    assert not any((tmp_path / f).exists() for f in ('a', 'b', 'c', build.STATE_FILE))
+    assert (tmp_path / 'src').exists()
@@ -0,0 +1,214 @@
+import json
+import pathlib
+import zipfile
+
+import numpy
+import PIL.Image
+import pytest
+
+import compositor
+from compositor import Group, Input, Recipe, UnsupportedTemplate
+
+
+template_kra = pathlib.Path(compositor.__file__).parent / 'template.kra'
+
+values = numpy.linspace(0, 1, 11, dtype=numpy.float32)
+s, d = numpy.meshgrid(values, values)
+
+
+def rgba(*color, shape=(2, 3)):
+    return numpy.broadcast_to(numpy.array(color, dtype=numpy.float32), shape + (4,)).copy()
+
+
+def test_blend_identities():
+    ones, zeros, half = numpy.ones_like(d), numpy.zeros_like(d), numpy.full_like(d, 0.5)
+
+    numpy.testing.assert_array_equal(compositor.blend_normal(s, d), s)
+    numpy.testing.assert_allclose(compositor.blend_multiply(ones, d), d)
+    numpy.testing.assert_allclose(compositor.blend_screen(zeros, d), d)
+    numpy.testing.assert_allclose(compositor.blend_overlay(s, d), compositor.blend_hard_light(d, s))
+    numpy.testing.assert_allclose(compositor.blend_super_light(half, d), d, atol=1e-6)
+
+
+# Super light leaves the range, like in Krita, and is clamped by Group.render
+@pytest.mark.parametrize('op', sorted(set(compositor.blend_modes) - {'super_light'}))
+def test_blend_range(op):
+    out = compositor.blend_modes[op](s, d)
+    assert out.min() >= -1e-6 and out.max() <= 1 + 1e-6
+
+
+def test_group_render_clamps():
+    recipe = Recipe(Group('root', children=[Input('bottom'), Input('top', 'super_light')]))
+    out = recipe.composite({'bottom': rgba(0.9, 0.1, 0.5, 1), 'top': rgba(1, 0, 0.5, 1)})
+    numpy.testing.assert_allclose(out, rgba(1, 0, 0.5, 1), atol=1e-6)
+
+
+def test_hard_light_continuous():
+    below = compositor.blend_hard_light(numpy.float32(0.5), values)
+    above = compositor.blend_hard_light(numpy.float32(0.5 + 1e-6), values)
+    numpy.testing.assert_allclose(below, above, atol=1e-5)
+
+
+def test_composite_over():
+    dst = rgba(0.2, 0.4, 0.6, 1)
+    compositor.composite_over(dst, rgba(1, 0, 0, 1), 'normal', 1.0)
+    numpy.testing.assert_allclose(dst, rgba(1, 0, 0, 1))
+
+    dst = rgba(0.2, 0.4, 0.6, 1)
+    compositor.composite_over(dst, rgba(1, 0, 0, 1), 'normal', 0.0)
+    numpy.testing.assert_allclose(dst, rgba(0.2, 0.4, 0.6, 1))
+
+    dst = rgba(0.2, 0.4, 0.6, 1)
+    compositor.composite_over(dst, rgba(1, 0, 0, 1), 'normal', 0.25)
+    numpy.testing.assert_allclose(dst, rgba(0.4, 0.3, 0.45, 1))
+
+    # The blend mode only applies where both layers are present
+    dst = rgba(0, 0, 0, 0)
+    compositor.composite_over(dst, rgba(0.5, 0.5, 0.5, 1), 'multiply', 1.0)
+    numpy.testing.assert_allclose(dst, rgba(0.5, 0.5, 0.5, 1))
+
+    dst = rgba(0.5, 0.5, 0.5, 1)
+    compositor.composite_over(dst, rgba(0.5, 1, 0, 1), 'multiply', 1.0)
+    numpy.testing.assert_allclose(dst, rgba(0.25, 0.5, 0, 1))
+
+    dst = rgba(1, 0, 0, 0.5)
+    compositor.composite_over(dst, rgba(0, 0, 1, 0.5), 'normal', 1.0)
+    numpy.testing.assert_allclose(dst, rgba(1 / 3, 0, 2 / 3, 0.75))
+
+
+@pytest.mark.parametrize('kind, gray', [
+    (0, 0.5),
+    (1, 0.2126 * 0.9 + 0.7152 * 0.5 + 0.0722 * 0.1),
+    (2, 0.299 * 0.9 + 0.587 * 0.5 + 0.114 * 0.1),
+    (3, 0.5),
+    (4, 0.1),
+    (5, 0.9),
+])
+def test_filter_desaturate(kind, gray):
+    img = rgba(0.9, 0.5, 0.1, 0.5)
+    compositor.filter_desaturate(img, {'type': str(kind)})
+    numpy.testing.assert_allclose(img, rgba(gray, gray, gray, 0.5), rtol=1e-6)
+
+
+def test_filter_burn():
+    factor = 0.75 * 0.333333
+    img = rgba(0.1, 0.5, 0.9, 1)
+    compositor.filter_burn(img, {'type': '0', 'exposure': '0.75'})
+    numpy.testing.assert_allclose(img, rgba(0, (0.5 - factor) / (1 - factor), (0.9 - factor) / (1 - factor), 1), rtol=1e-6)
+
+    img = rgba(0.1, 0.5, 0.9, 1)
+    compositor.filter_burn(img, {'type': '1', 'exposure': '0.75'})
+    numpy.testing.assert_allclose(img, rgba(0.1 ** (1 + factor), 0.5 ** (1 + factor), 0.9 ** (1 + factor), 1), rtol=1e-6)
+
+    img = rgba(0.1, 0.5, 0.9, 1)
+    compositor.filter_burn(img, {'type': '2', 'exposure': '0.75'})
+    numpy.testing.assert_allclose(img, rgba(0.1 * (1 - factor), 0.5 * (1 - factor), 0.9 * (1 - factor), 1), rtol=1e-6)
+
+
+def test_group_render():
+    recipe = Recipe(Group('root', children=[
+        Input('bottom'),
+        Group('top', 'multiply', 0.5, children=[Input('top')], masks=[('desaturate', {'type': '4'})]),
+    ]))
+
+    out = recipe.composite({'bottom': rgba(0.8, 0.8, 0.8, 1), 'top': rgba(0.5, 1, 0.5, 1)})
+
+    # Desaturated to 0.5, multiplied at half opacity: 0.8 * (0.5 + 0.5 * 0.5)
+    numpy.testing.assert_allclose(out, rgba(0.6, 0.6, 0.6, 1), rtol=1e-6)
+    assert json.loads(json.dumps(recipe.to_dict()))['children'][1]['masks'][0]['filter'] == 'desaturate'
+
+
+def test_composite_size_mismatch():
+    recipe = Recipe(Group('root', children=[Input('a'), Input('b')]))
+
+    with pytest.raises(ValueError, match='differ in size'):
+        recipe.composite({'a': rgba(0, 0, 0, 1), 'b': rgba(0, 0, 0, 1, shape=(3, 3))})
+
+
+def test_template():
+    recipe = Recipe.from_kra(template_kra)
+    inputs = set()
+
+    def collect(node):
+        if isinstance(node, Input):
+            inputs.add(node.name)
+        else:
+            for c in node.children:
+                collect(c)
+
+    collect(recipe.root)
+    assert inputs == {'dequantized', 'denoised'}
+    json.dumps(recipe.to_dict())
+
+
+def write_kra(path, layers, colorspace='RGBA'):
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('maindoc.xml',
+            '<DOC xmlns="http://www.calligra.org/DTD/krita">'
+            f'<IMAGE name="doc" colorspacename="{colorspace}"><layers>{layers}</layers></IMAGE>'
+            '</DOC>')
+
+
+def test_from_kra(tmp_path):
+    # Topmost first, like Krita
+    write_kra(tmp_path / 't.kra',
+        '<layer name="top" nodetype="grouplayer" compositeop="screen" opacity="128"/>'
+        '<layer name="hidden" nodetype="paintlayer" visible="0"/>'
+        '<layer name="bottom" nodetype="grouplayer"/>')
+
+    root = Recipe.from_kra(tmp_path / 't.kra').root
+
+    assert [c.name for c in root.children] == ['bottom', 'top']
+    assert root.children[1].compositeop == 'screen'
+    assert root.children[1].opacity == pytest.approx(128 / 255)
+
+
+@pytest.mark.parametrize('layers, colorspace, error', [
+    ('<layer name="paint" nodetype="paintlayer"/>', 'RGBA', 'unsupported layer type'),
+    ('<layer name="g" nodetype="grouplayer" compositeop="dissolve"/>', 'RGBA', 'unsupported blend mode'),
+    ('<layer name="g" nodetype="grouplayer" passthrough="1"/>', 'RGBA', 'pass-through'),
+    ('<layer name="g" nodetype="grouplayer" x="4"/>', 'RGBA', 'offset'),
+    ('<mask name="m" nodetype="transparencymask"/>', 'RGBA', 'unsupported mask type'),
+    ('<mask name="m" nodetype="filtermask" filtername="blur"/>', 'RGBA', 'unsupported filter'),
+    ('', 'RGBA16', 'color space'),
+])
+def test_from_kra_unsupported(tmp_path, layers, colorspace, error):
+    write_kra(tmp_path / 't.kra', layers, colorspace)
+
+    with pytest.raises(UnsupportedTemplate, match=error):
+        Recipe.from_kra(tmp_path / 't.kra')
+
+
+def save(path, img):
+    PIL.Image.fromarray(img, 'RGBA').save(path)
+    return path
+
+
+def test_verify(tmp_path):
+    recipe = Recipe(Group('root', children=[Input('dequantized'), Input('denoised', 'multiply', 0.5)]))
+    rng = numpy.random.default_rng(17)
+    inputs = {
+        name: save(tmp_path / f'{name}.png', rng.integers(0, 256, (8, 8, 4), dtype=numpy.uint8))
+        for name in ('dequantized', 'denoised')
+    }
+
+    compositor.composite_files(recipe, inputs, tmp_path / 'ref.png')
+    msg, ok = compositor.verify(recipe, inputs, tmp_path / 'ref.png')
+    assert ok and 'max 0' in msg
+
+    with PIL.Image.open(tmp_path / 'ref.png') as img:
+        ref = numpy.asarray(img).copy()
+
+    # Within the default tolerance of 3 levels
+    ref[2, 3, 1] = ref[2, 3, 1] + 3 if ref[2, 3, 1] < 128 else ref[2, 3, 1] - 3
+    save(tmp_path / 'close.png', ref)
+    assert compositor.verify(recipe, inputs, tmp_path / 'close.png')[1]
+
+    ref[5, 5, 0] = (int(ref[5, 5, 0]) + 128) % 256
+    save(tmp_path / 'far.png', ref)
+    msg, ok = compositor.verify(recipe, inputs, tmp_path / 'far.png')
+    assert not ok and '1 pixels over tolerance' in msg
+
+    save(tmp_path / 'small.png', ref[:4])
+    msg, ok = compositor.verify(recipe, inputs, tmp_path / 'small.png')
+    assert not ok and msg.startswith('Size mismatch')
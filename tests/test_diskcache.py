@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+import diskcache
+
+
+@pytest.mark.parametrize('s, size', [
+    ('0', 0),
+    ('512', 512),
+    ('8K', 8 << 10),
+    ('2g', 2 << 30),
+])
+def test_parse_size(s, size):
+    assert diskcache.parse_size(s) == size
+
+
+@pytest.mark.parametrize('value, disabled', [
+    (None, False),
+    ('/tmp/cache', False),
+    ('', True),
+    ('off', True),
+    (' No ', True),
+    ('0', True),
+    ('false', True),
+])
+def test_is_disabled(value, disabled):
+    assert diskcache.is_disabled(value) == disabled
+
+
+def test_default_cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert diskcache.default_cache_dir('portraits') == tmp_path / 'taisei-rawmedia' / 'portraits'
+
+
+def test_copy_atomic(tmp_path):
+    src = tmp_path / 'src.png'
+    src.write_bytes(b'data')
+    dst = tmp_path / 'a' / 'b' / 'dst.png'
+
+    diskcache.copy_atomic(src, dst)
+
+    assert dst.read_bytes() == b'data'
+    assert [p.name for p in dst.parent.iterdir()] == ['dst.png']
+
+
+def test_copy_atomic_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        diskcache.copy_atomic(tmp_path / 'missing.png', tmp_path / 'cache' / 'dst.png')
+
+    assert list((tmp_path / 'cache').iterdir()) == []
+
+
+def test_touch(tmp_path):
+    p = tmp_path / 'entry'
+    p.write_bytes(b'')
+    os.utime(p, (1000, 1000))
+
+    assert diskcache.touch(p)
+    assert p.stat().st_mtime > 1000
+    assert not diskcache.touch(tmp_path / 'evicted')
+
+
+def test_evict(tmp_path):
+    paths = []
+
+    for i, name in enumerate(('old', 'mid', 'new', '.tmp-partial')):
+        p = tmp_path / name
+        p.write_bytes(bytes(100))
+        os.utime(p, (1000 + i, 1000 + i))
+        paths.append(p)
+
+    # Listed but already gone, as if evicted by another process
+    paths.append(tmp_path / 'gone')
+
+    assert diskcache.evict(paths, 150) == (2, 200)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['.tmp-partial', 'new']
+    assert diskcache.evict(paths, 150) == (0, 0)
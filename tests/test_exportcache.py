@@ -0,0 +1,163 @@
+import zipfile
+
+import pytest
+
+import exportcache
+from exportcache import ExportCache, KraContents
+
+
+def write_kra(path, layers, annotations=b'icc', image_attrs=''):
+    '''
+    Write a minimal .kra with `layers`, a list of (uuid, filename, attrs, content).
+    '''
+
+    nodes = ''.join(
+        f'<layer uuid="{uuid}" filename="{filename}" name="{filename}" {attrs}/>'
+        for uuid, filename, attrs, content in layers)
+
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('maindoc.xml',
+            '<DOC xmlns="http://www.calligra.org/DTD/krita">'
+            f'<IMAGE name="doc" width="64" height="64" {image_attrs}><layers>{nodes}</layers></IMAGE>'
+            '</DOC>')
+        z.writestr('doc/annotations/icc', annotations)
+
+        for uuid, filename, attrs, content in layers:
+            z.writestr(f'doc/layers/{filename}', content)
+            z.writestr(f'doc/layers/{filename}.defaultpixel', b'\0\0\0\0')
+
+
+BASE = [
+    ('{a}', 'layer1', 'visible="1" opacity="255"', b'base'),
+    ('{b}', 'layer2', 'visible="1" opacity="255"', b'face'),
+]
+
+A = [('body', '{a}')]
+AB = [('body', '{a}'), ('body/face', '{b}')]
+
+
+def signatures(tmp_path, layers, **kwargs):
+    path = tmp_path / 'test.kra'
+    write_kra(path, layers, **kwargs)
+    contents = KraContents(path)
+    return contents.signature(A), contents.signature(AB)
+
+
+def test_digest():
+    assert exportcache.digest(1, 'a', [2]) == exportcache.digest(1, 'a', [2])
+    assert exportcache.digest(1, 'a', [2]) != exportcache.digest(1, 'a', [3])
+    assert exportcache.digest({'x': 1, 'y': 2}) == exportcache.digest({'y': 2, 'x': 1})
+
+
+def test_file_digest(tmp_path):
+    p = tmp_path / 'f'
+    p.write_bytes(b'x' * (3 << 20))
+    d = exportcache.file_digest(p)
+
+    p.write_bytes(b'x' * (3 << 20) + b'y')
+    assert exportcache.file_digest(p) != d
+
+
+def test_signature_stable(tmp_path):
+    assert signatures(tmp_path, BASE) == signatures(tmp_path, BASE)
+
+
+def test_signature_layer_content(tmp_path):
+    a, ab = signatures(tmp_path, BASE)
+    a2, ab2 = signatures(tmp_path, [BASE[0], BASE[1][:3] + (b'other face',)])
+
+    # Only the targets in which the edited layer is visible are affected
+    assert a2 == a
+    assert ab2 != ab
+
+
+def test_signature_layer_attrs(tmp_path):
+    a, ab = signatures(tmp_path, BASE)
+
+    hidden = [(uuid, filename, 'visible="0" selected="true" opacity="255"', content)
+        for uuid, filename, attrs, content in BASE]
+    assert signatures(tmp_path, hidden) == (a, ab)
+
+    faded = [BASE[0], BASE[1][:2] + ('visible="1" opacity="128"', BASE[1][3])]
+    a2, ab2 = signatures(tmp_path, faded)
+    assert a2 == a
+    assert ab2 != ab
+
+
+def test_signature_stacking_order(tmp_path):
+    path = tmp_path / 'test.kra'
+    write_kra(path, BASE)
+    contents = KraContents(path)
+
+    assert contents.signature(AB) != contents.signature(AB[::-1])
+
+
+def test_signature_document(tmp_path):
+    a, ab = signatures(tmp_path, BASE)
+
+    assert signatures(tmp_path, BASE, annotations=b'other icc')[0] != a
+    assert signatures(tmp_path, BASE, image_attrs='x-res="300"')[0] != a
+
+
+def test_signature_opaque_layers(tmp_path):
+    clone = BASE + [('{c}', 'layer3', 'nodetype="clonelayer"', b'')]
+    path = tmp_path / 'test.kra'
+    write_kra(path, clone)
+    contents = KraContents(path)
+    sig = contents.signature(A + [('clone', '{c}')])
+
+    # Clones depend on anything in the document
+    write_kra(path, [BASE[0], BASE[1][:3] + (b'other face',), clone[2]])
+    assert KraContents(path).signature(A + [('clone', '{c}')]) != sig
+    assert KraContents(path).signature(A) == contents.signature(A)
+
+
+def test_signature_unknown_layer(tmp_path):
+    path = tmp_path / 'test.kra'
+    write_kra(path, BASE)
+    sig = KraContents(path).signature([('missing', '{z}')])
+
+    write_kra(path, [BASE[0], BASE[1][:3] + (b'other face',)])
+    assert KraContents(path).signature([('missing', '{z}')]) != sig
+
+
+def test_export_cache(tmp_path):
+    cache = ExportCache(tmp_path / 'char')
+    assert cache.kra is None and cache.plan is None
+    assert cache.target('a.png') == {}
+
+    cache.set_plan('kra1', [{'name': 'a.png'}])
+    cache.update('a.png', render='r1')
+    cache.update('a.png', output='o1')
+    cache.update('b.png', render='r2')
+
+    reloaded = ExportCache(tmp_path / 'char')
+    assert reloaded.kra == 'kra1'
+    assert reloaded.plan == [{'name': 'a.png'}]
+    assert reloaded.target('a.png') == {'render': 'r1', 'output': 'o1'}
+
+    # Returns a copy
+    reloaded.target('a.png')['render'] = 'changed'
+    assert reloaded.target('a.png')['render'] == 'r1'
+
+
+def test_export_cache_prune(tmp_path):
+    cache = ExportCache(tmp_path / 'char')
+    cache.layers_dir.mkdir(parents=True)
+
+    for name in ('a.png', 'b.png'):
+        cache.update(name, render=name)
+        (cache.layers_dir / name).write_bytes(b'')
+
+    cache.prune({'a.png'})
+
+    assert sorted(p.name for p in cache.layers_dir.iterdir()) == ['a.png']
+    assert ExportCache(tmp_path / 'char').targets == {'a.png': {'render': 'a.png'}}
+
+
+@pytest.mark.parametrize('manifest', ['', '{not json'])
+def test_export_cache_broken_manifest(tmp_path, manifest):
+    (tmp_path / 'manifest.json').write_text(manifest)
+    cache = ExportCache(tmp_path)
+
+    assert cache.plan is None and cache.targets == {}
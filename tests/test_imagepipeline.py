@@ -0,0 +1,136 @@
+import numpy
+import PIL.Image
+import pytest
+
+import imagepipeline
+from imagepipeline import Geometry, Layer
+
+
+@pytest.mark.parametrize('filter', sorted(imagepipeline.cubic_filters))
+def test_cubic_partition_of_unity(filter):
+    b, c = imagepipeline.cubic_filters[filter]
+    x = numpy.linspace(0, 1, 101)
+    total = sum(imagepipeline.cubic_bc(x + k, b, c) for k in range(-3, 4))
+    numpy.testing.assert_allclose(total, 1, atol=1e-12)
+
+
+def test_catrom_interpolates():
+    b, c = imagepipeline.cubic_filters['Catrom']
+    assert imagepipeline.cubic_bc(numpy.array([0.0, 1.0, 2.0, 2.5]), b, c).tolist() == [1, 0, 0, 0]
+
+
+@pytest.mark.parametrize('src, dst', [(10, 10), (100, 37), (37, 100), (5, 1)])
+def test_resize_taps(src, dst):
+    idx, w = imagepipeline.resize_taps(src, dst, 'RobidouxSharp')
+
+    assert idx.shape == w.shape and idx.shape[0] == dst
+    assert idx.min() >= 0 and idx.max() < src
+    numpy.testing.assert_allclose(w.sum(axis=1), 1, rtol=1e-6)
+
+
+def test_resize_axis_identity():
+    img = numpy.random.default_rng(0).random((7, 9, 4), dtype=numpy.float32)
+    out = imagepipeline.resize_axis(img, 9, 1, 'Catrom')
+    numpy.testing.assert_allclose(out, img, atol=1e-6)
+
+
+@pytest.mark.parametrize('rgb, lab', [
+    ((0, 0, 0), (0, 0, 0)),
+    ((1, 1, 1), (100, 0, 0)),
+    ((1, 0, 0), (53.24, 80.09, 67.20)),
+    ((0, 0, 1), (32.30, 79.19, -107.86)),
+])
+def test_srgb_to_lab(rgb, lab):
+    out = imagepipeline.srgb_to_lab(numpy.array(rgb, dtype=numpy.float32))
+    numpy.testing.assert_allclose(out, lab, atol=0.05)
+
+
+def test_lab_round_trip():
+    rgb = numpy.random.default_rng(1).random((64, 3), dtype=numpy.float32)
+    out = imagepipeline.lab_to_srgb(imagepipeline.srgb_to_lab(rgb))
+    numpy.testing.assert_allclose(out, rgb, atol=1e-4)
+
+
+def test_resize_constant():
+    img = numpy.empty((40, 30, 4), dtype=numpy.float32)
+    img[:] = (0.8, 0.4, 0.1, 1)
+
+    out = imagepipeline.resize(img, 0.25, 'RobidouxSharp')
+
+    assert out.shape == (10, 8, 4)
+    numpy.testing.assert_allclose(out, numpy.broadcast_to(img[0, 0], out.shape), atol=1e-4)
+
+
+def test_resize_ignores_transparent_colors():
+    # Opaque red next to transparent green: the green must not bleed into the edge
+    img = numpy.zeros((16, 16, 4), dtype=numpy.float32)
+    img[:, :8] = (1, 0, 0, 1)
+    img[:, 8:] = (0, 1, 0, 0)
+
+    out = imagepipeline.quantize(imagepipeline.resize(img, 0.5, 'RobidouxSharp'))
+    visible = out[..., 3] > 0
+
+    assert visible[:, 3:5].all()
+    assert (out[visible][:, :3] == (255, 0, 0)).all()
+
+
+def test_preprocess(tmp_path):
+    img = numpy.zeros((20, 10, 4), dtype=numpy.uint8)
+    img[:, :5] = (255, 255, 255, 255)
+    path = tmp_path / 'in.png'
+    PIL.Image.fromarray(img, 'RGBA').save(path)
+
+    out = imagepipeline.preprocess(path, 0.5, 'RobidouxSharp', flop=True)
+
+    assert out.shape == (10, 5, 4) and out.dtype == numpy.uint8
+    assert out.flags.c_contiguous
+    assert (out[:, 0, 3] == 0).all() and (out[:, -1] == 255).all()
+
+
+def test_premultiplied():
+    img = numpy.array([[[255, 128, 0, 128], [200, 200, 200, 0]]], dtype=numpy.uint8)
+    assert imagepipeline.premultiplied(img).tolist() == [[[128, 64, 0, 128], [0, 0, 0, 0]]]
+
+
+def test_geometry():
+    assert str(Geometry(10, 20, 3, -4)) == '10x20+3-4'
+    assert str(Geometry.from_box((2, 3, 12, 8))) == '10x5+2+3'
+
+
+def test_content_box():
+    mask = numpy.zeros((6, 8), dtype=bool)
+    assert imagepipeline.content_box(mask) is None
+
+    mask[2, 3] = mask[4, 6] = True
+    assert imagepipeline.content_box(mask) == (3, 2, 7, 5)
+
+
+def test_differs_fuzz():
+    a = numpy.array([[[100, 100, 100, 255]]], dtype=numpy.uint8)
+    b = numpy.array([110, 100, 100, 255], dtype=numpy.uint8)
+
+    assert imagepipeline.differs(a, b)[0, 0]
+    assert imagepipeline.differs(a, b, fuzz=0.03)[0, 0]
+    assert not imagepipeline.differs(a, b, fuzz=0.05)[0, 0]
+
+
+def test_trim_geometry():
+    # Transparent pixels of any color count as background
+    img = numpy.random.default_rng(2).integers(0, 256, (10, 12, 4), dtype=numpy.uint8)
+    img[..., 3] = 0
+    img[3:6, 4:9] = (10, 20, 30, 255)
+
+    assert str(imagepipeline.trim_geometry(Layer(img))) == '5x3+4+3'
+
+
+def test_trim_geometry_empty():
+    img = numpy.zeros((10, 12, 4), dtype=numpy.uint8)
+    assert str(imagepipeline.trim_geometry(Layer(img))) == '1x1+0+0'
+
+
+def test_crop():
+    img = numpy.arange(5 * 6).reshape(5, 6)
+
+    assert imagepipeline.crop(img, Geometry(2, 3, 1, 1)).tolist() == [[7, 8], [13, 14], [19, 20]]
+    # Clamped to the image, like -crop
+    assert imagepipeline.crop(img, Geometry(4, 4, -2, 3)).tolist() == [[18, 19], [24, 25]]
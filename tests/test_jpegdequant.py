@@ -0,0 +1,167 @@
+import numpy
+import PIL.Image
+import pytest
+
+import jpegdequant
+
+
+def smooth_image(h, w, seed=0):
+    '''
+    Smooth gradients and soft blobs, the kind of content JPEG blocking is visible in.
+    '''
+
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.mgrid[0:h, 0:w].astype(numpy.float64)
+    img = 60 + 100 * x / w + 40 * y / h
+
+    blobs = zip(rng.uniform(0, h, 4), rng.uniform(0, w, 4), rng.uniform(6, 20, 4), rng.uniform(-60, 60, 4))
+
+    for cy, cx, r, a in blobs:
+        img += a * numpy.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * r * r))
+
+    return numpy.clip(img, 0, 255)
+
+
+def encode(tmp_path, img, name='in.jpg', **kwargs):
+    path = tmp_path / name
+    PIL.Image.fromarray(numpy.rint(img).astype(numpy.uint8)).save(path, **kwargs)
+    return path
+
+
+def decode(path):
+    with PIL.Image.open(path) as img:
+        img.draft(img.mode, img.size)
+        return numpy.asarray(img), img.quantization[0]
+
+
+def rms(a, b):
+    return numpy.sqrt(numpy.mean(numpy.square(a.astype(numpy.float64) - b)))
+
+
+def test_dct_orthonormal():
+    numpy.testing.assert_allclose(jpegdequant.DCT @ jpegdequant.DCT.T, numpy.eye(8), atol=1e-6)
+
+
+def test_block_dct_round_trip():
+    x = numpy.random.default_rng(0).uniform(-128, 127, (24, 40)).astype(numpy.float32)
+    c = jpegdequant.block_dct(x)
+
+    assert c.shape == (3, 5, 8, 8)
+    numpy.testing.assert_allclose(jpegdequant.block_idct(c), x, atol=1e-3)
+
+    # The DC coefficient of an orthonormal DCT is 8 times the block mean
+    numpy.testing.assert_allclose(c[..., 0, 0], 8 * x.reshape(3, 8, 5, 8).mean(axis=(1, 3)), rtol=1e-4)
+
+
+def test_block_dct_separable():
+    # A horizontal cosine of frequency 3 only has coefficients in row 0, column 3
+    n = numpy.arange(8)
+    x = numpy.tile(numpy.cos((2 * n + 1) * 3 * numpy.pi / 16), (8, 1)).astype(numpy.float32)
+    c = jpegdequant.block_dct(x)[0, 0]
+
+    assert abs(c[0, 3]) == pytest.approx(numpy.sqrt(32), rel=1e-5)
+    c[0, 3] = 0
+    assert numpy.abs(c).max() < 1e-5
+
+
+def test_smooth():
+    flat = numpy.full((5, 7), 42.0)
+    numpy.testing.assert_allclose(jpegdequant.smooth(flat, 1.0), flat)
+
+    x = numpy.random.default_rng(0).random((5, 7))
+    numpy.testing.assert_array_equal(jpegdequant.smooth(x, 0.0), x)
+
+    spike = numpy.zeros((5, 5))
+    spike[2, 2] = 16
+    s = jpegdequant.smooth(spike, 1.0)
+    assert s.sum() == pytest.approx(16)
+    assert s[2, 2] == 4 and s[1, 2] == 2 and s[1, 1] == 1
+
+
+def test_dequantize_zero_iterations(tmp_path):
+    plane, qtable = decode(encode(tmp_path, smooth_image(64, 48), quality=30))
+    numpy.testing.assert_array_equal(jpegdequant.dequantize_plane(plane, qtable, iterations=0), plane)
+
+
+@pytest.mark.parametrize('quality', [15, 40])
+def test_dequantize_reduces_error(tmp_path, quality):
+    original = smooth_image(128, 160)
+    plane, qtable = decode(encode(tmp_path, original, quality=quality))
+
+    out = jpegdequant.dequantize_plane(plane, qtable)
+
+    assert out.dtype == numpy.uint8 and out.shape == plane.shape
+    assert rms(out, original) < 0.9 * rms(plane, original)
+
+
+def test_dequantize_stays_consistent(tmp_path):
+    # The result must still be (close to) an image that encodes to the same JPEG
+    plane, qtable = decode(encode(tmp_path, smooth_image(64, 64), quality=20))
+    out = jpegdequant.dequantize_plane(plane, qtable)
+
+    q = numpy.asarray(qtable, dtype=numpy.float32).reshape(8, 8)
+    k_in = numpy.rint(jpegdequant.block_dct(plane.astype(numpy.float32) - 128) / q)
+    c_out = jpegdequant.block_dct(out.astype(numpy.float32) - 128)
+
+    # Rounding the result to integers moves coefficients by at most 4
+    assert numpy.all(numpy.abs(c_out - k_in * q) <= q / 2 + 4)
+
+
+def test_dequantize_tile_independent(tmp_path):
+    plane, qtable = decode(encode(tmp_path, smooth_image(120, 72), quality=20))
+    whole = jpegdequant.dequantize_plane(plane, qtable, iterations=4, tile_rows=64)
+
+    for tile_rows in (1, 3, 7):
+        strips = jpegdequant.dequantize_plane(plane, qtable, iterations=4, tile_rows=tile_rows)
+
+        # Identical up to the float rounding of the DCTs, which may depend on the strip shape
+        assert numpy.abs(strips.astype(int) - whole).max() <= 1
+        assert numpy.count_nonzero(strips != whole) <= plane.size // 1000
+
+
+def test_dequantize_partial_blocks(tmp_path):
+    plane, qtable = decode(encode(tmp_path, smooth_image(45, 70), quality=20))
+    out = jpegdequant.dequantize_plane(plane, qtable)
+
+    numpy.testing.assert_array_equal(out[40:], plane[40:])
+    numpy.testing.assert_array_equal(out[:, 64:], plane[:, 64:])
+    assert (out[:40, :64] != plane[:40, :64]).any()
+
+
+def test_dequantize_file_gray(tmp_path):
+    original = smooth_image(64, 96)
+    src = encode(tmp_path, original, quality=20)
+    dst = tmp_path / 'out.png'
+
+    assert jpegdequant.dequantize_file(src, dst) == dst
+
+    with PIL.Image.open(dst) as img:
+        assert img.format == 'PNG' and img.mode == 'L'
+        out = numpy.asarray(img)
+
+    assert rms(out, original) < rms(decode(src)[0], original)
+
+
+@pytest.mark.parametrize('subsampling', [0, 2])
+def test_dequantize_file_rgb(tmp_path, subsampling):
+    original = numpy.stack([smooth_image(64, 96, seed) for seed in range(3)], axis=-1)
+    src = encode(tmp_path, original, quality=20, subsampling=subsampling)
+    dst = tmp_path / 'out.png'
+    jpegdequant.dequantize_file(src, dst)
+
+    with PIL.Image.open(src) as img:
+        decoded = numpy.asarray(img)
+
+    with PIL.Image.open(dst) as img:
+        assert img.mode == 'RGB' and img.size == (96, 64)
+        out = numpy.asarray(img)
+
+    assert rms(out, original) < rms(decoded, original)
+
+
+def test_dequantize_file_not_jpeg(tmp_path):
+    src = tmp_path / 'in.png'
+    PIL.Image.new('RGB', (8, 8)).save(src)
+
+    with pytest.raises(ValueError, match='not a JPEG'):
+        jpegdequant.dequantize_file(src, tmp_path / 'out.png')
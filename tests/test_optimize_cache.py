@@ -0,0 +1,140 @@
+import os
+
+import numpy
+import PIL.Image
+import pytest
+
+import optimize_cache
+from optimize_cache import Optimizer
+
+
+@pytest.fixture
+def script(tmp_path):
+    '''
+    Stand-in for optimize-img.sh: counts its runs, and "optimizes" by truncating.
+    '''
+
+    p = tmp_path / 'optimize-img.sh'
+    p.write_text(f'#!/bin/sh\necho "$1" >> {tmp_path / "calls"}\nprintf optimized > "$1"\n')
+    p.chmod(0o755)
+    return p
+
+
+def calls(tmp_path):
+    log = tmp_path / 'calls'
+    n = len(log.read_text().splitlines()) if log.exists() else 0
+    log.unlink(missing_ok=True)
+    return n
+
+
+def write_image(path, seed=0, **kwargs):
+    pixels = numpy.random.default_rng(seed).integers(0, 256, (16, 16, 4), dtype=numpy.uint8)
+    PIL.Image.fromarray(pixels, 'RGBA').save(path, **kwargs)
+    return path
+
+
+def test_key_decoded_pixels(tmp_path, script):
+    opt = Optimizer(script)
+
+    # The same pixels, encoded differently
+    a = write_image(tmp_path / 'a.png', compress_level=0)
+    b = write_image(tmp_path / 'b.png', compress_level=9)
+    assert a.read_bytes() != b.read_bytes()
+    assert opt.key(a) == opt.key(b)
+
+    c = write_image(tmp_path / 'c.png', seed=1)
+    assert opt.key(a) != opt.key(c)
+
+
+def test_key_palette(tmp_path, script):
+    opt = Optimizer(script)
+    keys = []
+
+    for palette in ([0, 0, 0, 255, 255, 255], [0, 0, 0, 255, 0, 0]):
+        img = PIL.Image.new('P', (4, 4))
+        img.putpalette(palette)
+        img.putpixel((1, 1), 1)
+        img.save(tmp_path / 'p.png')
+        keys.append(opt.key(tmp_path / 'p.png'))
+
+    assert keys[0] != keys[1]
+
+
+def test_key_version(tmp_path, script, monkeypatch):
+    img = write_image(tmp_path / 'a.png')
+    key = Optimizer(script).key(img)
+
+    monkeypatch.setenv('TAISEI_OPTIMIZER_VERSION', 'pngquant 3')
+    assert Optimizer(script).key(img) != key
+
+    monkeypatch.delenv('TAISEI_OPTIMIZER_VERSION')
+    script.write_text(script.read_text() + '# changed\n')
+    assert Optimizer(script).key(img) != key
+
+
+def test_optimize_cached(tmp_path, script):
+    opt = Optimizer(script, tmp_path / 'cache')
+
+    result = opt(write_image(tmp_path / 'a.png'))
+    assert not result.hit
+    assert result.size_after == len(b'optimized')
+    assert calls(tmp_path) == 1
+
+    # A fresh export of the same image is copied from the cache
+    result = opt(write_image(tmp_path / 'b.png'))
+    assert result.hit
+    assert (tmp_path / 'b.png').read_bytes() == b'optimized'
+    assert calls(tmp_path) == 0
+
+    opt(write_image(tmp_path / 'c.png', seed=1))
+    assert calls(tmp_path) == 1
+
+    assert (opt.stats.hits, opt.stats.misses) == (1, 2)
+    assert str(opt.stats).startswith('1 of 3 optimized images from cache (33% hit rate)')
+
+
+def test_optimize_uncached(tmp_path, script):
+    opt = Optimizer(script)
+
+    for i in range(2):
+        assert not opt(write_image(tmp_path / 'a.png')).hit
+
+    assert calls(tmp_path) == 2
+
+
+def test_evict(tmp_path, script):
+    opt = Optimizer(script, tmp_path / 'cache', max_size=2 * len(b'optimized'))
+
+    for seed in range(3):
+        opt(write_image(tmp_path / 'a.png', seed))
+        entry = opt.entry_path(opt.key(write_image(tmp_path / 'k.png', seed)), '.png')
+        os.utime(entry, (1000 + seed, 1000 + seed))
+
+    calls(tmp_path)
+    assert len(list((tmp_path / 'cache').glob('??/*'))) == 2
+
+    # The oldest one was evicted
+    opt(write_image(tmp_path / 'a.png', 0))
+    assert calls(tmp_path) == 1
+
+
+def test_from_environment(tmp_path, script, monkeypatch):
+    monkeypatch.setenv('TAISEI_OPTIMIZE_CACHE', 'off')
+    assert Optimizer.from_environment(script).cache_dir is None
+
+    monkeypatch.setenv('TAISEI_OPTIMIZE_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.setenv('TAISEI_OPTIMIZE_CACHE_SIZE', '1M')
+    opt = Optimizer.from_environment(script)
+    assert opt.cache_dir == tmp_path / 'cache'
+    assert opt.max_size == 1 << 20
+
+    monkeypatch.delenv('TAISEI_OPTIMIZE_CACHE')
+    monkeypatch.delenv('TAISEI_OPTIMIZE_CACHE_SIZE')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    opt = Optimizer.from_environment(script)
+    assert opt.cache_dir == tmp_path / 'taisei-rawmedia' / 'optimized'
+    assert opt.max_size == Optimizer.DEFAULT_MAX_SIZE
+
+
+def test_stats_empty():
+    assert str(optimize_cache.OptimizeStats()).startswith('0 of 0 optimized images from cache (0% hit rate)')
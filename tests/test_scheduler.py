@@ -0,0 +1,181 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import Scheduler, TaskCancelled
+
+
+def test_dependencies():
+    sched = Scheduler({'a': 4, 'b': 4})
+    order = []
+
+    def step(name, delay=0):
+        time.sleep(delay)
+        order.append(name)
+        return name
+
+    t1 = sched.add('a', step, 'first', 0.05)
+    t2 = sched.add('b', step, 'second', deps=[t1])
+    t3 = sched.add('a', step, 'third', deps=[t1, t2])
+    t4 = sched.add('b', step, 'unrelated')
+    sched.wait()
+
+    assert order.index('first') < order.index('second') < order.index('third')
+    assert [t.result() for t in (t1, t2, t3, t4)] == ['first', 'second', 'third', 'unrelated']
+
+
+def test_stage_limits():
+    sched = Scheduler({'limited': 2, 'other': 8})
+    lock = threading.Lock()
+    running = {'limited': 0, 'other': 0}
+    peak = {'limited': 0, 'other': 0}
+
+    def step(stage):
+        with lock:
+            running[stage] += 1
+            peak[stage] = max(peak[stage], running[stage])
+
+        time.sleep(0.05)
+
+        with lock:
+            running[stage] -= 1
+
+    for i in range(6):
+        sched.add('limited', step, 'limited')
+        sched.add('other', step, 'other')
+
+    sched.wait()
+
+    assert peak['limited'] == 2
+    assert peak['other'] > 2
+
+
+def test_stages_independent():
+    # A blocked stage doesn't hold up the tasks of another one
+    sched = Scheduler({'slow': 1, 'fast': 1})
+    release = threading.Event()
+    done = []
+
+    sched.add('slow', release.wait, 5)
+
+    for i in range(3):
+        sched.add('fast', done.append, i)
+
+    deadline = time.monotonic() + 5
+
+    while len(done) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert done == [0, 1, 2]
+    release.set()
+    sched.wait()
+
+
+def test_failure_cancels_dependents(capsys):
+    sched = Scheduler({'a': 2})
+    ran = []
+
+    def fail():
+        raise ValueError('broken')
+
+    t_fail = sched.add('a', fail)
+    t_dep = sched.add('a', ran.append, 'dep', deps=[t_fail])
+    t_dep2 = sched.add('a', ran.append, 'dep2', deps=[t_dep])
+    t_ok = sched.add('a', ran.append, 'ok')
+
+    with pytest.raises(ValueError, match='broken'):
+        sched.wait()
+
+    assert ran == ['ok']
+    assert t_ok.error is None
+    assert isinstance(t_dep.error, TaskCancelled)
+    assert isinstance(t_dep2.error, TaskCancelled)
+    assert sched.cancelled == [t_dep, t_dep2]
+    assert sched.failed == [t_fail]
+
+    with pytest.raises(TaskCancelled):
+        t_dep2.result()
+
+    assert '2 tasks cancelled' in capsys.readouterr().out
+
+
+def test_add_after_failure():
+    sched = Scheduler({'a': 1})
+
+    def fail():
+        raise ValueError('broken')
+
+    t_fail = sched.add('a', fail)
+
+    while not t_fail.finished:
+        time.sleep(0.01)
+
+    t_dep = sched.add('a', print, deps=[t_fail])
+    assert t_dep.finished and isinstance(t_dep.error, TaskCancelled)
+
+    with pytest.raises(ValueError):
+        sched.wait()
+
+
+def test_ignore_failed_deps():
+    sched = Scheduler({'a': 2})
+
+    def fail():
+        raise ValueError('broken')
+
+    t_fail = sched.add('a', fail)
+
+    @sched.task('a', deps=[t_fail], ignore_failed_deps=True, name='cleanup')
+    def t_cleanup():
+        return repr(t_fail.error)
+
+    with pytest.raises(ValueError):
+        sched.wait()
+
+    assert t_cleanup.name == 'cleanup'
+    assert t_cleanup.result() == "ValueError('broken')"
+
+
+def test_tasks_adding_tasks():
+    sched = Scheduler({'a': 2, 'b': 1})
+    results = []
+
+    def spawn(n):
+        if n:
+            sched.add('b', spawn, n - 1)
+
+        time.sleep(0.01)
+        results.append(n)
+
+    sched.add('a', spawn, 3)
+    sched.wait()
+
+    assert sorted(results) == [0, 1, 2, 3]
+
+
+def test_critical_path():
+    sched = Scheduler({'a': 4})
+
+    t_short = sched.add('a', time.sleep, 0.01, name='short')
+    t_long = sched.add('a', time.sleep, 0.1, name='long')
+    t_mid = sched.add('a', time.sleep, 0.02, deps=[t_long], name='mid')
+    t_end = sched.add('a', time.sleep, 0.01, deps=[t_short, t_mid], name='end')
+    sched.wait()
+
+    path, total = t_end.critical_path()
+    assert path == [t_long, t_mid, t_end]
+    assert total == pytest.approx(sum(t.duration for t in path))
+    assert total >= 0.13
+
+
+def test_report(capsys):
+    sched = Scheduler({'encode': 2})
+    sched.add('encode', time.sleep, 0.01)
+    sched.add('encode', time.sleep, 0.01)
+    sched.wait()
+    sched.report()
+
+    assert sched.stats['encode'].count == 2
+    assert sched.stats['encode'].busy >= 0.02
+    assert 'encode' in capsys.readouterr().out